@@ -0,0 +1,141 @@
+"""
+Counts the AWS API calls issued by each edamame command.
+
+The commands run against moto, with docker and ssh replaced by mocks, so the
+numbers only reflect the AWS round trips made by the provisioning code.
+
+Usage:
+    python benchmarks/aws_calls.py
+"""
+import os
+import sys
+import io
+import json
+import tempfile
+import contextlib
+import collections
+from unittest import mock
+
+import boto3
+import botocore.client
+from moto import mock_aws
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from eki_dev.aws_service import reset_pool  # noqa: E402
+
+CONFIG = {
+    "ImageId": "ami-12345678",
+    "KeyName": "test_key",
+    "InstanceType": "t2.micro",
+    "TagSpecifications": [{"ResourceType": "instance",
+                           "Tags": [{"Key": "user", "Value": "default"}]}],
+}
+
+
+class CallCounter:
+    """Counts botocore API calls by service and operation"""
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self._make_api_call = botocore.client.BaseClient._make_api_call
+
+    def __enter__(self):
+        counter = self
+
+        def _counted(client, operation_name, api_params):
+            service = client.meta.service_model.service_name
+            counter.calls[f"{service}.{operation_name}"] += 1
+            return counter._make_api_call(client, operation_name, api_params)
+
+        self._patch = mock.patch.object(botocore.client.BaseClient, "_make_api_call", _counted)
+        self._patch.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._patch.stop()
+
+    def reset(self):
+        # every CLI invocation starts with an empty service pool
+        reset_pool()
+        self.calls.clear()
+
+    def total(self):
+        return sum(self.calls.values())
+
+
+def _setup_account():
+    boto3.client("s3").create_bucket(Bucket="eki-dev-machine-config")
+    boto3.client("s3").put_object(Bucket="eki-dev-machine-config",
+                                  Body=b"dev,test_project",
+                                  Key="project_tags.txt")
+    boto3.client("iam").create_instance_profile(InstanceProfileName="AccessECR")
+
+
+def _mock_docker_and_ssh(stack):
+    stack.enter_context(mock.patch("subprocess.Popen"))
+    stack.enter_context(mock.patch("eki_dev.dev_machine.get_docker_client"))
+    stack.enter_context(mock.patch("eki_dev.dev_machine.wait_until_ready"))
+    stack.enter_context(mock.patch("eki_dev.dev_machine.wait_for_token", return_value="abc123"))
+    stack.enter_context(mock.patch("eki_dev.dev_machine.ssh_tunnel", return_value="ssh -f -N"))
+
+
+def run():
+    from eki_dev import dev_machine as dev_m
+
+    results = {}
+    with CallCounter() as counter:
+        counter.reset()
+        _setup_account()
+        counter.reset()
+
+        with contextlib.ExitStack() as stack:
+            _mock_docker_and_ssh(stack)
+
+            dev_m.create_ec2_instance(name="bench_blank", project_tag="dev", **CONFIG)
+            results["blank"] = dict(counter.calls)
+            counter.reset()
+
+            dev_m.create_instance_pull_start_server(name="bench_explorer", project_tag="dev", **CONFIG)
+            results["explorer-machine"] = dict(counter.calls)
+            counter.reset()
+
+            lst = dev_m.list_instances()
+            results["list"] = dict(counter.calls)
+            counter.reset()
+
+            dev_m.clean_dangling_contexts()
+            results["clean-dangling-contexts"] = dict(counter.calls)
+            counter.reset()
+
+            dev_m.terminate_instance(lst[0].id if hasattr(lst[0], "id") else lst[0]["InstanceId"])
+            results["remove"] = dict(counter.calls)
+            counter.reset()
+
+    return results
+
+
+def main():
+    with tempfile.TemporaryDirectory() as home:
+        os.environ["HOME"] = home
+        # docker keeps its contexts relative to the working directory when
+        # there is no docker config file
+        os.chdir(home)
+        os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+        os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+        os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+        # moto issues ECR tokens that expired in 2015
+        with mock_aws(), contextlib.redirect_stdout(io.StringIO()), \
+                mock.patch("eki_dev.credential_cache.time") as mtime:
+            mtime.time.return_value = 1388534400
+            results = run()
+
+    print(f"{'command':<26}{'aws calls':>10}")
+    for command, calls in results.items():
+        print(f"{command:<26}{sum(calls.values()):>10}")
+    if "--json" in sys.argv:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,456 @@
+"""
+End-to-end provisioning latency of edamame against local stand-ins.
+
+AWS is moto. The instances are reached through a fake endpoint on localhost:
+a TCP server answering with an ssh banner for the port probes, a fake remote
+command runner for the cloud-init and docker probes, and a fake docker client
+for the ECR login, the image pull, the container start and the Jupyter token.
+Each stand-in waits for its configurable latency, so the results show where
+the provisioning code spends its time for given network and daemon delays.
+
+For each scale N, N blank machines and N explorer machines are created one
+after the other, like N CLI invocations, then listed, checked for dangling
+contexts and terminated one by one. Every operation reports its wall time and
+AWS calls, and the pipelines report the wall time of each of their phases.
+
+Each operation starts with an empty session pool, so it makes the AWS calls of
+a CLI invocation. The botocore service models are however parsed once and
+shared by every session: their loading time depends on the disk, not on the
+provisioning code, and would otherwise dominate the results.
+
+Usage:
+    python benchmarks/provisioning.py [--scales 1 10 100] [--ssh-latency 0.02] ...
+        [--output results.json] [--compare previous.json [--tolerance 0.2]]
+"""
+import os
+import re
+import sys
+import io
+import json
+import time
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+import collections
+import socketserver
+import threading
+from unittest import mock
+
+import boto3
+import botocore.client
+import botocore.loaders
+from moto import mock_aws
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+from eki_dev import describe_cache, project_tags, readiness  # noqa: E402
+from eki_dev.aws_service import reset_pool  # noqa: E402
+from eki_dev.pipeline import Pipeline  # noqa: E402
+
+SCALES = (1, 10, 100)
+
+CONFIG = {
+    "ImageId": "ami-12345678",
+    "KeyName": "test_key",
+    "InstanceType": "t2.micro",
+    "TagSpecifications": [{"ResourceType": "instance",
+                           "Tags": [{"Key": "user", "Value": "default"}]}],
+}
+
+
+class Latency:
+    """
+    Seconds injected by the stand-ins.
+
+    Args:
+        aws: added to every AWS API call, on top of moto's own time.
+        ssh: ssh banner of the port probes, every remote command and the tunnel.
+        docker: every docker API call (login, pull request, container start).
+        pull: transfer time of the image, spread over `layers` layers.
+        jupyter: time from the container start to the token in its logs.
+        layers: number of image layers.
+    """
+
+    def __init__(self, aws: float = 0.0, ssh: float = 0.02, docker: float = 0.02, pull: float = 0.2,
+                 jupyter: float = 0.1, layers: int = 4):
+        self.aws = aws
+        self.ssh = ssh
+        self.docker = docker
+        self.pull = pull
+        self.jupyter = jupyter
+        self.layers = layers
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+
+class CallCounter:
+    """Counts botocore API calls by service and operation, after waiting `latency` seconds for each"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+        self._make_api_call = botocore.client.BaseClient._make_api_call
+
+    def __enter__(self):
+        counter = self
+
+        def _counted(client, operation_name, api_params):
+            with counter._lock:
+                counter.calls[f"{client.meta.service_model.service_name}.{operation_name}"] += 1
+            if counter.latency:
+                time.sleep(counter.latency)
+            return counter._make_api_call(client, operation_name, api_params)
+
+        self._patch = mock.patch.object(botocore.client.BaseClient, "_make_api_call", _counted)
+        self._patch.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._patch.stop()
+
+    def take(self) -> dict:
+        """returns the calls counted since the last take and starts counting again"""
+        with self._lock:
+            calls = dict(self.calls)
+            self.calls.clear()
+        return calls
+
+
+class _BannerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        time.sleep(self.server.latency.ssh)
+        self.request.sendall(b"SSH-2.0-OpenSSH_edamame_benchmark\r\n")
+
+
+class FakeEndpoint:
+    """
+    The instances as seen from edamame: an ssh banner on a localhost port,
+    remote commands, and a docker daemon. Counts the calls of each kind.
+    """
+
+    TOKEN = "0123456789abcdef"
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _BannerHandler)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        self.port = self.server.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def call(self, kind: str, seconds: float):
+        with self._lock:
+            self.calls[kind] += 1
+        time.sleep(seconds)
+
+    def take(self) -> dict:
+        with self._lock:
+            calls = dict(self.calls)
+            self.calls.clear()
+        return calls
+
+    # ssh
+    def default_probes(self, user: str, host: str, port: int = 22) -> list:
+        return readiness.default_probes(user, "127.0.0.1", self.port)
+
+    def run_command(self, user: str, host: str, command: str, timeout: float = 30, port: int = 22) -> tuple:
+        self.call("ssh", self.latency.ssh)
+        if command.startswith("cloud-init"):
+            return 0, b"status: done\n", b""
+        return 0, b"24.0.5\n", b""
+
+    def ssh_tunnel(self, user: str, host: str, jupyter_port: int, dask_port: int) -> str:
+        self.call("ssh", self.latency.ssh)
+        return f"ssh -f -N -L {jupyter_port}:localhost:{jupyter_port} {user}@{host}"
+
+    # docker
+    def get_docker_client(self, user: str, host: str, port: int = 22, timeout: int = 60):
+        return FakeDockerClient(self)
+
+
+class FakeContainer:
+    def __init__(self, endpoint: FakeEndpoint):
+        self.endpoint = endpoint
+
+    def logs(self, stream=False, follow=False):
+        time.sleep(self.endpoint.latency.jupyter)
+        yield f"    http://127.0.0.1:8888/lab?token={FakeEndpoint.TOKEN}\n".encode()
+
+
+class FakeDockerClient:
+    """The parts of docker.DockerClient used by the provisioning"""
+
+    def __init__(self, endpoint: FakeEndpoint):
+        self.endpoint = endpoint
+        self.api = self
+        self.containers = self
+
+    def login(self, **kwargs) -> dict:
+        self.endpoint.call("docker", self.endpoint.latency.docker)
+        return {"Status": "Login Succeeded"}
+
+    def pull(self, repository: str, tag: str = None, stream: bool = False, decode: bool = False, **kwargs):
+        self.endpoint.call("docker", self.endpoint.latency.docker)
+        latency = self.endpoint.latency
+        size = 50 * 10 ** 6
+        yield {"status": f"Pulling from {repository}", "id": tag}
+        for n in range(latency.layers):
+            layer = f"layer{n:08d}"
+            yield {"status": "Downloading", "id": layer, "progressDetail": {"current": 0, "total": size}}
+            time.sleep(latency.pull / latency.layers)
+            yield {"status": "Download complete", "id": layer}
+            yield {"status": "Pull complete", "id": layer}
+        yield {"status": "Digest: sha256:" + "0" * 64}
+
+    def run(self, **kwargs) -> FakeContainer:
+        self.endpoint.call("docker", self.endpoint.latency.docker)
+        return FakeContainer(self.endpoint)
+
+
+class _SearchPaths(list):
+    # every boto3 session appends its resource models path to the loader
+    def append(self, path):
+        if path not in self:
+            super().append(path)
+
+
+@contextlib.contextmanager
+def _shared_models():
+    """makes every botocore session use one loader, which caches the parsed service models"""
+    loader = botocore.loaders.create_loader()
+    loader._search_paths = _SearchPaths(loader.search_paths)
+    with mock.patch("botocore.session.create_loader", lambda search_path_string=None: loader):
+        yield
+
+
+def _setup_account():
+    boto3.client("s3").create_bucket(Bucket="eki-dev-machine-config")
+    boto3.client("s3").put_object(Bucket="eki-dev-machine-config", Body=b"dev,test_project",
+                                  Key="project_tags.txt")
+    boto3.client("iam").create_instance_profile(InstanceProfileName="AccessECR")
+
+
+def _percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _stats(times: list) -> dict:
+    return {"mean_s": round(sum(times) / len(times), 4),
+            "p95_s": round(_percentile(times, 0.95), 4),
+            "max_s": round(max(times), 4)}
+
+
+class Recorder:
+    """Wall time, AWS calls and endpoint calls of each operation, and the phase times of the pipelines"""
+
+    def __init__(self, counter: CallCounter, endpoint: FakeEndpoint):
+        self.counter = counter
+        self.endpoint = endpoint
+        self.operations = {}
+        self.pipelines = []
+
+    def run(self, operation: str, func, *args, **kwargs):
+        # every CLI invocation starts with an empty service pool
+        reset_pool()
+        self.counter.take()
+        self.endpoint.take()
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            entry = self.operations.setdefault(operation, {"times": [], "aws_calls": collections.Counter(),
+                                                           "endpoint_calls": collections.Counter()})
+            entry["times"].append(elapsed)
+            entry["aws_calls"].update(self.counter.take())
+            entry["endpoint_calls"].update(self.endpoint.take())
+
+    def result(self) -> dict:
+        operations = {}
+        for name, entry in self.operations.items():
+            n = len(entry["times"])
+            aws_calls = sum(entry["aws_calls"].values())
+            operations[name] = {"invocations": n,
+                                "total_s": round(sum(entry["times"]), 4),
+                                **_stats(entry["times"]),
+                                "aws_calls": aws_calls,
+                                "aws_calls_per_invocation": round(aws_calls / n, 2),
+                                "aws_calls_by_operation": dict(sorted(entry["aws_calls"].items())),
+                                "endpoint_calls": dict(sorted(entry["endpoint_calls"].items()))}
+
+        phases = {}
+        for pipeline in self.pipelines:
+            for phase in pipeline.phases.values():
+                if phase.duration is not None:
+                    phases.setdefault(pipeline.name, {}).setdefault(phase.name, []).append(phase.duration)
+        return {"operations": operations,
+                "phases": {pipeline: {phase: _stats(times) for phase, times in pipeline_phases.items()}
+                           for pipeline, pipeline_phases in phases.items()}}
+
+
+@contextlib.contextmanager
+def _stand_ins(endpoint: FakeEndpoint, recorder: Recorder):
+    run = Pipeline.run
+
+    def _recorded_run(pipeline):
+        recorder.pipelines.append(pipeline)
+        return run(pipeline)
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.object(Pipeline, "run", _recorded_run))
+        stack.enter_context(mock.patch("eki_dev.dev_machine.default_probes", endpoint.default_probes))
+        stack.enter_context(mock.patch("eki_dev.readiness.run_command", endpoint.run_command))
+        stack.enter_context(mock.patch("eki_dev.dev_machine.get_docker_client", endpoint.get_docker_client))
+        stack.enter_context(mock.patch("eki_dev.dev_machine.ssh_tunnel", endpoint.ssh_tunnel))
+        # moto issues ECR tokens that expired in 2015
+        mtime = stack.enter_context(mock.patch("eki_dev.credential_cache.time"))
+        mtime.time.return_value = 1388534400
+        yield
+
+
+def run_scale(n: int, latency: Latency) -> dict:
+    """provisions, lists and terminates `n` blank and `n` explorer machines. Returns the measures"""
+    from eki_dev import dev_machine as dev_m
+
+    with mock_aws(), _shared_models(), CallCounter(latency.aws) as counter, FakeEndpoint(latency) as endpoint:
+        reset_pool()
+        describe_cache.reset_cache()
+        project_tags.reset_cache()
+        _setup_account()
+        recorder = Recorder(counter, endpoint)
+        with _stand_ins(endpoint, recorder):
+            instances = []
+            for i in range(n):
+                instances.append(recorder.run("create_ec2_instance", dev_m.create_ec2_instance,
+                                              name=f"bench-{n}-blank-{i}", project_tag="dev", **CONFIG))
+            for i in range(n):
+                instances.append(recorder.run("create_instance_pull_start_server",
+                                              dev_m.create_instance_pull_start_server,
+                                              name=f"bench-{n}-explorer-{i}", project_tag="dev",
+                                              progress="quiet", **CONFIG))
+            rows = recorder.run("list_instances", dev_m.list_instances)
+            if len(rows) != 2 * n:
+                raise RuntimeError(f"Listed {len(rows)} instances instead of {2 * n}")
+            recorder.run("clean_dangling_contexts", dev_m.clean_dangling_contexts, force=True)
+            for instance in instances:
+                recorder.run("terminate_instance", dev_m.terminate_instance, instance.id)
+        return recorder.result()
+
+
+def _version() -> dict:
+    with open(os.path.join(ROOT, "setup.py"), encoding="utf8") as f:
+        version = re.search(r"'version':\s*'([^']+)'", f.read())
+    proc = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+    return {"version": version.group(1) if version else None,
+            "commit": proc.stdout.strip() or None}
+
+
+def run(scales=SCALES, latency: Latency = None) -> dict:
+    latency = latency or Latency()
+    results = {**_version(), "python": platform.python_version(), "latency": latency.as_dict(), "scales": {}}
+    home = os.environ.get("HOME")
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update(HOME=tmp, AWS_DEFAULT_REGION="us-east-1", AWS_ACCESS_KEY_ID="testing",
+                          AWS_SECRET_ACCESS_KEY="testing")
+        # docker keeps its contexts relative to the working directory when
+        # there is no docker config file
+        os.chdir(tmp)
+        try:
+            for n in scales:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    results["scales"][str(n)] = run_scale(n, latency)
+        finally:
+            os.chdir(cwd)
+            if home is not None:
+                os.environ["HOME"] = home
+    return results
+
+
+def compare(previous: dict, current: dict, tolerance: float = 0.2) -> list:
+    """
+    returns the regressions of `current` over `previous`: operations whose mean
+    time grew by more than `tolerance` (a fraction) or that make more AWS calls
+    """
+    regressions = []
+    for scale, result in current["scales"].items():
+        before = previous["scales"].get(scale)
+        if before is None:
+            continue
+        for name, op in result["operations"].items():
+            old = before["operations"].get(name)
+            if old is None:
+                continue
+            if op["mean_s"] > old["mean_s"] * (1 + tolerance):
+                regressions.append(f"{name} x{scale}: mean {old['mean_s']:.3f}s -> {op['mean_s']:.3f}s")
+            if op["aws_calls_per_invocation"] > old["aws_calls_per_invocation"]:
+                regressions.append(f"{name} x{scale}: aws calls {old['aws_calls_per_invocation']} -> "
+                                   f"{op['aws_calls_per_invocation']} per invocation")
+    return regressions
+
+
+def display(results: dict):
+    for scale, result in results["scales"].items():
+        print(f"{scale} instance(s)")
+        print(f"\t{'operation':<36}{'calls':>6}{'mean s':>9}{'p95 s':>9}{'total s':>9}{'aws/call':>10}")
+        for name, op in result["operations"].items():
+            print(f"\t{name:<36}{op['invocations']:>6}{op['mean_s']:>9.3f}{op['p95_s']:>9.3f}"
+                  f"{op['total_s']:>9.2f}{op['aws_calls_per_invocation']:>10.1f}")
+        for pipeline, phases in result["phases"].items():
+            print(f"\t{pipeline} phases")
+            for phase, s in phases.items():
+                print(f"\t\t{phase:<28}{s['mean_s']:>9.3f}{s['p95_s']:>9.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=list(SCALES), help="numbers of instances")
+    parser.add_argument("--aws-latency", type=float, default=0.0, help="seconds added to every AWS call")
+    parser.add_argument("--ssh-latency", type=float, default=0.02, help="seconds per ssh round trip")
+    parser.add_argument("--docker-latency", type=float, default=0.02, help="seconds per docker API call")
+    parser.add_argument("--pull-latency", type=float, default=0.2, help="seconds to transfer the image")
+    parser.add_argument("--jupyter-latency", type=float, default=0.1, help="seconds until the Jupyter token")
+    parser.add_argument("--output", "-o", type=str, help="write the results to this JSON file")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--compare", type=str, help="JSON results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown over the previous run reported as a regression, as a fraction")
+    args = parser.parse_args()
+
+    latency = Latency(aws=args.aws_latency, ssh=args.ssh_latency, docker=args.docker_latency,
+                      pull=args.pull_latency, jupyter=args.jupyter_latency)
+    results = run(args.scales, latency)
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            json.dump(results, f, indent=2)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        display(results)
+
+    if args.compare:
+        with open(args.compare, encoding="utf8") as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
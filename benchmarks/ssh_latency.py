@@ -0,0 +1,74 @@
+"""
+Per-call latency of remote commands and docker API calls over ssh, with a
+fresh connection per call versus the shared transport of eki_dev.ssh_transport.
+
+Usage:
+    python benchmarks/ssh_latency.py ubuntu@<host> [--calls 20]
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+import docker
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from eki_dev.ssh_transport import SshConnection, get_connection, get_docker_client, close_all  # noqa: E402
+
+
+def _timed(func, calls: int) -> list:
+    times = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _fresh_command(user, host):
+    conn = SshConnection(user, host)
+    try:
+        conn.run("true")
+    finally:
+        conn.close()
+
+
+def _fresh_docker_ping(user, host):
+    client = docker.DockerClient(base_url=f"ssh://{user}@{host}")
+    try:
+        client.ping()
+    finally:
+        client.close()
+
+
+def _summary(name: str, times: list):
+    times = sorted(times)
+    p95 = times[min(len(times) - 1, int(0.95 * len(times)))]
+    print(f"{name:<28}{statistics.mean(times) * 1000:>10.1f}{statistics.median(times) * 1000:>10.1f}"
+          f"{p95 * 1000:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("target", help="user@host")
+    parser.add_argument("--calls", type=int, default=20)
+    args = parser.parse_args()
+    user, _, host = args.target.rpartition("@")
+    user = user or "ubuntu"
+
+    print(f"{'call':<28}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    _summary("command, fresh connection", _timed(lambda: _fresh_command(user, host), args.calls))
+    get_connection(user, host).ensure_connected()
+    _summary("command, shared transport", _timed(lambda: get_connection(user, host).run("true"), args.calls))
+
+    _summary("docker ping, fresh client", _timed(lambda: _fresh_docker_ping(user, host), args.calls))
+    client = get_docker_client(user, host)
+    client.ping()
+    _summary("docker ping, shared", _timed(client.ping, args.calls))
+    close_all()
+
+
+if __name__ == "__main__":
+    main()
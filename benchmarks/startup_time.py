@@ -0,0 +1,76 @@
+"""
+Import cost of edamame commands, measured with `python -X importtime`.
+
+Each command runs in a fresh interpreter. The reported time is the cumulative
+import time of every top-level import made by bin/edamame, leaving out the
+interpreter's own startup (`site` and what it imports). Commands that do not
+talk to AWS or to an instance must stay under the budget and must not import
+the heavy client libraries.
+
+Usage: python benchmarks/startup_time.py [--json] [--check]
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EDAMAME = os.path.join(ROOT, "bin", "edamame")
+
+# milliseconds of import time allowed for the commands below
+BUDGET_MS = 250
+HEAVY_MODULES = ("boto3", "botocore", "docker", "paramiko", "rich")
+COMMANDS = {
+    "--help": ["--help"],
+    "generate-makefile": ["generate-makefile", "--image-name", "image", "--repo-name", "repo"],
+}
+
+
+def import_profile(argv: list) -> dict:
+    """runs `edamame *argv` with -X importtime. Returns the import time in ms and the imported modules"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.join(ROOT, "src"), os.environ.get("PYTHONPATH", "")]))
+    with tempfile.TemporaryDirectory() as cwd:
+        proc = subprocess.run([sys.executable, "-X", "importtime", EDAMAME] + argv,
+                              cwd=cwd, env=env, capture_output=True, text=True)
+    total_us = 0
+    modules = []
+    after_site = False
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        top_level = not name[1:].startswith(" ")
+        modules.append(name.strip())
+        if top_level and after_site:
+            total_us += int(cumulative)
+        if top_level and name.strip() == "site":
+            after_site = True
+    return {"returncode": proc.returncode,
+            "import_ms": round(total_us / 1000, 1),
+            "heavy_modules": sorted({m.split(".")[0] for m in modules if m.split(".")[0] in HEAVY_MODULES})}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--check", action="store_true", help="exit with 1 if a command is over budget")
+    args = parser.parse_args()
+
+    results = {name: import_profile(argv) for name, argv in COMMANDS.items()}
+    failed = [name for name, r in results.items()
+              if r["returncode"] != 0 or r["import_ms"] > BUDGET_MS or r["heavy_modules"]]
+
+    if args.json:
+        print(json.dumps({"budget_ms": BUDGET_MS, "commands": results, "failed": failed}))
+    else:
+        print(f"{'command':<22}{'import ms':>10}  heavy modules (budget {BUDGET_MS} ms)")
+        for name, r in results.items():
+            print(f"{name:<22}{r['import_ms']:>10.1f}  {', '.join(r['heavy_modules']) or '-'}")
+    if args.check and failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,7 +17,7 @@ config = {
     'download_url': '',
     'include_package_data': True,
     'install_requires': [ # 
-        'importlib_resources', 'pyyaml', 'botocore', 'boto3', 'docker', 'rich', 'paramiko'
+        'importlib_resources', 'pyyaml', 'botocore', 'boto3', 'docker>=7.0,<8', 'rich', 'paramiko'
     ],
     'extras_require': {
         'test': ['pytest', 'pytest-mock', 'moto', 'black']
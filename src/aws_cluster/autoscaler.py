@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import urllib.request
+from pathlib import Path
+
+from eki_dev.state import StateStore
+from eki_dev.dev_machine import terminate_instances
+
+from aws_cluster.dask_cluster import add_workers, find_scheduler_address
+
+
+class SchedulerAPI:
+    """
+    Client of the dask scheduler JSON API (distributed.http.scheduler.api),
+    served with the dashboard and reached through the ssh tunnel of its port.
+
+    Args:
+        url: dashboard URL, e.g. http://localhost:8889.
+        timeout: seconds to wait for an answer.
+    """
+
+    def __init__(self, url: str = "http://localhost:8889", timeout: float = 10):
+        self.url = url.rstrip("/") + "/api/v1"
+        self.timeout = timeout
+
+    def _request(self, path: str, body: dict = None):
+        data = None if body is None else json.dumps(body).encode("utf8")
+        request = urllib.request.Request(f"{self.url}/{path}", data=data,
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def adaptive_target(self) -> int:
+        """number of workers the scheduler wants for its backlog and the occupancy of the workers"""
+        return self._request("adaptive_target")["workers"]
+
+    def workers(self) -> list:
+        """returns the connected workers, as dicts with `name` and `address`"""
+        return self._request("get_workers")["workers"]
+
+    def retire_workers(self, n: int) -> dict:
+        """
+        retires `n` workers chosen by the scheduler, after moving their data to
+        the others. Returns {address: worker info} of the retired workers
+        """
+        return self._request("retire_workers", {"n": n})
+
+
+class ScalingPolicy:
+    """
+    Bounds and cooldowns of the worker count.
+
+    A scale up is allowed `scale_up_cooldown` seconds after the previous one.
+    A scale down is allowed `scale_down_cooldown` seconds after any scaling, so
+    a burst following an idle stretch does not retire the workers just added.
+
+    Args:
+        min_workers: workers kept when idle.
+        max_workers: upper bound of the worker count.
+        scale_up_cooldown: seconds between two scale ups.
+        scale_down_cooldown: seconds between a scaling and the next scale down.
+        max_scale_up: largest number of instances added at once.
+    """
+
+    def __init__(self, min_workers: int = 0, max_workers: int = 10, scale_up_cooldown: float = 60,
+                 scale_down_cooldown: float = 300, max_scale_up: int = None):
+        if not 0 <= min_workers <= max_workers:
+            raise ValueError(f"Invalid bounds: min {min_workers}, max {max_workers}")
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.scale_up_cooldown = scale_up_cooldown
+        self.scale_down_cooldown = scale_down_cooldown
+        self.max_scale_up = max_scale_up
+        self.last_scale_up = None
+        self.last_scale_down = None
+
+    def decide(self, target: int, current: int, now: float) -> tuple:
+        """returns (change of the worker count, reason)"""
+        desired = min(max(target, self.min_workers), self.max_workers)
+        if desired > current:
+            if self.last_scale_up is not None and now - self.last_scale_up < self.scale_up_cooldown:
+                return 0, "scale up cooldown"
+            return min(desired - current, self.max_scale_up or desired), f"target {target}"
+        if desired < current:
+            last = max([t for t in (self.last_scale_up, self.last_scale_down) if t is not None], default=None)
+            if last is not None and now - last < self.scale_down_cooldown:
+                return 0, "scale down cooldown"
+            return desired - current, f"target {target}"
+        return 0, "at target"
+
+    def record(self, change: int, now: float):
+        if change > 0:
+            self.last_scale_up = now
+        elif change < 0:
+            self.last_scale_down = now
+
+
+class Autoscaler:
+    """
+    Adds and retires the worker instances of dask cluster `name` following the
+    scheduler's adaptive target, within the bounds of `policy`.
+
+    Workers are retired through the scheduler, which moves their data away
+    first, before their instances are terminated. Every decision is printed
+    and appended to ~/CONFIG_DIR/autoscaler-<name>.jsonl with its latency.
+
+    Args:
+        name: cluster name.
+        project_tag: project identification tag of the new workers.
+        api: SchedulerAPI of the cluster.
+        policy: ScalingPolicy.
+        container: ECR image and tag of the workers.
+        CONFIG_DIR: folder of the decision log, under the home directory.
+        **instance_params: Parameters for creating the worker instances.
+    """
+
+    def __init__(self, name: str, project_tag: str, api: SchedulerAPI, policy: ScalingPolicy,
+                 container: str = "data_explorer:prod", CONFIG_DIR='.dev_machine', clock=time.monotonic,
+                 **instance_params):
+        self.name = name
+        self.project_tag = project_tag
+        self.api = api
+        self.policy = policy
+        self.container = container
+        self.config_dir = CONFIG_DIR
+        self.clock = clock
+        self.instance_params = instance_params
+        self.log_path = os.path.join(os.path.expanduser("~"), CONFIG_DIR, f"autoscaler-{name}.jsonl")
+        self._scheduler_address = None
+
+    def _log(self, record: dict):
+        print(f"[{self.name}] {record['action']} {record.get('change', 0):+d} "
+              f"(workers {record.get('workers')}, {record['reason']}) in {record['latency_s']:.1f}s")
+        Path(self.log_path).parent.mkdir(parents=False, exist_ok=True)
+        with open(self.log_path, "a", encoding='utf8') as f:
+            f.write(json.dumps(record) + "\n")
+
+    def scale_up(self, n: int):
+        if self._scheduler_address is None:
+            self._scheduler_address = find_scheduler_address(self.name)
+        add_workers(self.name, n, self.project_tag, container=self.container,
+                    scheduler_address=self._scheduler_address, **self.instance_params)
+
+    def scale_down(self, n: int) -> list:
+        """retires `n` workers, then terminates their instances. Returns the terminated instance ids"""
+        retired = self.api.retire_workers(n)
+        store = StateStore(CONFIG_DIR=self.config_dir)
+        try:
+            entries = [store.get(str(info.get("name"))) for info in retired.values()]
+        finally:
+            store.close()
+        instance_ids = [e["instance_id"] for e in entries if e and e["instance_id"]]
+        if len(instance_ids) < len(retired):
+            print(f"Instances of some retired workers not found: {[i.get('name') for i in retired.values()]}")
+        return terminate_instances(instance_ids) if instance_ids else []
+
+    def step(self) -> dict:
+        """takes one scaling decision and carries it out. Returns the logged record"""
+        start = self.clock()
+        record = {"time": time.time(), "cluster": self.name}
+        try:
+            record["target"] = self.api.adaptive_target()
+            record["workers"] = len(self.api.workers())
+            change, record["reason"] = self.policy.decide(record["target"], record["workers"], start)
+            record["change"] = change
+            record["action"] = "up" if change > 0 else "down" if change < 0 else "hold"
+            try:
+                if change > 0:
+                    self.scale_up(change)
+                elif change < 0:
+                    record["terminated"] = self.scale_down(-change)
+            finally:
+                # a failed attempt starts the cooldown too, so it is not retried at every step
+                self.policy.record(change, self.clock())
+        except Exception as e:
+            record.update(action="error", reason=f"{type(e).__name__}: {e}")
+        record["latency_s"] = self.clock() - start
+        self._log(record)
+        return record
+
+    def run(self, interval: float = 15, steps: int = None, sleep=time.sleep):
+        """takes a decision every `interval` seconds, `steps` times or until interrupted"""
+        n = 0
+        while steps is None or n < steps:
+            started = self.clock()
+            self.step()
+            n += 1
+            if steps is None or n < steps:
+                sleep(max(0.0, interval - (self.clock() - started)))
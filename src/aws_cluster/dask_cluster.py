@@ -0,0 +1,323 @@
+import copy
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from eki_dev import describe_cache, tracing
+from eki_dev.aws_service import AwsService
+from eki_dev.docker_utils import login_into_ecr, get_ecr_credentials, ecr_auth_config
+from eki_dev.pipeline import Pipeline
+from eki_dev.pull_progress import pull_image
+from eki_dev.readiness import wait_until_ready, default_probes
+from eki_dev.ssh_transport import get_docker_client
+from eki_dev.utils import ssh_tunnel
+from eki_dev.dev_machine import _run_jupyter_notebook, terminate_instances
+
+from aws_cluster.ec2_fleets import create_fleet
+
+SCHEDULER_PORT = 8786
+# the default dashboard routes and the JSON API (adaptive_target, retire_workers) used by the autoscaler
+SCHEDULER_ENVIRONMENT = {
+    "DASK_DISTRIBUTED__SCHEDULER__HTTP__ROUTES": json.dumps([
+        "distributed.http.scheduler.prometheus",
+        "distributed.http.scheduler.info",
+        "distributed.http.scheduler.json",
+        "distributed.http.health",
+        "distributed.http.proxy",
+        "distributed.http.statics",
+        "distributed.http.scheduler.api",
+    ])
+}
+# share of the instance memory given to the dask worker, the rest is left to the OS and docker
+MEMORY_FRACTION = 0.9
+
+
+class DaskCluster:
+    """
+    A dask scheduler instance and its worker instances.
+
+    The scheduler instance also runs the Jupyter server, whose dask `Client()`
+    connects to the scheduler without arguments (DASK_SCHEDULER_ADDRESS).
+
+    Args:
+        name: cluster name, used as `cluster` tag and as prefix of the fleets.
+        scheduler: Ec2Fleet of the scheduler instance.
+        workers: Ec2Fleet of the worker instances.
+    """
+
+    def __init__(self, name: str, scheduler, workers):
+        self.name = name
+        self.scheduler = scheduler
+        self.workers = workers
+
+    @property
+    def scheduler_address(self) -> str:
+        return f"tcp://{self.scheduler.instances[0]['private_ip']}:{SCHEDULER_PORT}"
+
+    @property
+    def instance_ids(self) -> list:
+        return self.scheduler.instance_ids + self.workers.instance_ids
+
+    def display(self):
+        print(f"Dask cluster {self.name}: scheduler at {self.scheduler_address}")
+        self.scheduler.display()
+        self.workers.display()
+
+
+def scheduler_fleet_name(name: str) -> str:
+    return f"{name}-scheduler"
+
+
+def worker_fleet_name(name: str) -> str:
+    return f"{name}-worker"
+
+
+def _add_cluster_tag(name: str, **instance_params):
+    spec = instance_params['TagSpecifications'][0]
+    tags = [t for t in spec['Tags'] if t['Key'] != 'cluster'] + [{'Key': 'cluster', 'Value': name}]
+    specs = [dict(spec, Tags=tags)] + instance_params['TagSpecifications'][1:]
+    return dict(instance_params, TagSpecifications=specs)
+
+
+def worker_resources(instance_type: str, memory_fraction: float = MEMORY_FRACTION) -> dict:
+    """
+    returns the dask worker settings for `instance_type`: a thread per vCPU and
+    `memory_fraction` of the instance memory, in bytes
+    """
+    ec2 = AwsService.from_service("ec2")
+    info = ec2.client.describe_instance_types(InstanceTypes=[instance_type])["InstanceTypes"][0]
+    return {"nthreads": info["VCpuInfo"]["DefaultVCpus"],
+            "memory_limit": int(info["MemoryInfo"]["SizeInMiB"] * 2 ** 20 * memory_fraction)}
+
+
+def _start_dask_container(name: str,
+                          host: str,
+                          image: str,
+                          command: str,
+                          user: str = "ubuntu",
+                          readiness_deadline: float = 900,
+                          environment: dict = None):
+    """
+    Waits for `host` to finish bootstrapping, pulls `image` from ECR and runs
+    `command` in it, on the host network so the scheduler and the workers
+    reach each other on their private IPs.
+    """
+    registry = image.split("/")[0]
+    repository, tag = image.rsplit(":", 1)
+    report = wait_until_ready(default_probes(user, host), deadline=readiness_deadline)
+    report.display()
+    docker_client = login_into_ecr(registry, docker_client=get_docker_client(user, host))
+    pull_image(docker_client, repository, tag, auth_config=ecr_auth_config(registry), mode="quiet")
+    print(f"Starting {name} on {host}: {command}")
+    with tracing.span("docker run", image=image, host=host, container=name):
+        return docker_client.containers.run(image=image,
+                                            command=command,
+                                            name=name,
+                                            user=0,
+                                            detach=True,
+                                            network_mode="host",
+                                            volumes=['/home/ubuntu/efs:/home/eki/efs'],
+                                            environment=environment,
+                                            # a retired worker exits cleanly and must not come back
+                                            restart_policy={"Name": "on-failure"})
+
+
+def _ecr_image(account: str, region: str, container: str) -> str:
+    return f"{account}.dkr.ecr.{region}.amazonaws.com/{container}"
+
+
+def start_workers(fleet, image: str, scheduler_address: str, resources: dict, max_workers: int = 16) -> list:
+    """starts a dask worker connected to `scheduler_address` on every instance of `fleet`"""
+    def start(node):
+        return _start_dask_container("dask-worker", node["ip"], image,
+                                     f"dask worker {scheduler_address} --name {node['name']} "
+                                     f"--nthreads {resources['nthreads']} "
+                                     f"--memory-limit {resources['memory_limit']}")
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(tracing.run_in_context(start), fleet.instances))
+
+
+def find_scheduler_address(name: str) -> str:
+    """returns the address of the scheduler of cluster `name`"""
+    filters = [{"Name": "tag:fleet", "Values": [scheduler_fleet_name(name)]},
+               {"Name": "instance-state-name", "Values": ["running"]}]
+    for inst in describe_cache.describe_instances(filters):
+        return f"tcp://{inst['PrivateIpAddress']}:{SCHEDULER_PORT}"
+    raise ValueError(f"No running scheduler for cluster {name}")
+
+
+def add_workers(name: str,
+                count: int,
+                project_tag: str,
+                container: str = "data_explorer:prod",
+                scheduler_address: str = None,
+                max_workers: int = 16,
+                **instance_params):
+    """
+    Launches `count` more worker instances for cluster `name` and starts their
+    dask workers. The instances are terminated if a worker fails to start.
+
+    Returns:
+        The Ec2Fleet of the new workers.
+    """
+    instance_params = copy.deepcopy(instance_params)
+    instance_params["IamInstanceProfile"] = {"Name": "AccessECR"}
+    instance_params = _add_cluster_tag(name, **instance_params)
+    svc = AwsService.from_service("ec2")
+    image = _ecr_image(svc.get_account_id(), svc.get_region(), container)
+    scheduler_address = scheduler_address or find_scheduler_address(name)
+
+    # a fleet per scale up, so the docker contexts do not collide
+    fleet = create_fleet(f"{worker_fleet_name(name)}-{int(time.time())}", count, project_tag,
+                         max_workers=max_workers, **instance_params)
+    try:
+        get_ecr_credentials(image.split("/")[0])
+        start_workers(fleet, image, scheduler_address, worker_resources(fleet.instances[0]["instance_type"]),
+                      max_workers=max_workers)
+    except (ClientError, Exception, KeyboardInterrupt):
+        print(f"Terminating the new workers of cluster {name}")
+        terminate_instances(fleet.instance_ids)
+        raise
+    return fleet
+
+
+def create_cluster(name: str,
+                   workers: int,
+                   project_tag: str,
+                   worker_type: str = None,
+                   container: str = "data_explorer:prod",
+                   jupyter_port: int = 8888,
+                   dask_port: int = 8889,
+                   progress: str = "rich",
+                   max_workers: int = 16,
+                   instance_types: list = (),
+                   subnet_ids: list = (),
+                   **instance_params) -> DaskCluster:
+    """
+    Creates a dask cluster: one scheduler instance, which also runs the Jupyter
+    server, and `workers` worker instances, all running `container` from ECR.
+
+    Both fleets are launched at once and the nodes are provisioned while the
+    others boot. Workers get a thread per vCPU and most of the memory of
+    `worker_type`. The security group must allow traffic between its members.
+
+    Args:
+        name: cluster name. The nodes get the docker contexts `name-scheduler-0`
+            and `name-worker-0` ... `name-worker-{workers-1}`.
+        workers: number of worker instances.
+        project_tag: project identification tag.
+        worker_type: instance type of the workers. Defaults to `InstanceType`,
+            the scheduler's.
+        container: ECR image and tag run on every node.
+        jupyter_port: Jupyter port, forwarded to localhost.
+        dask_port: scheduler dashboard port, forwarded to localhost.
+        progress: pull progress display of the Jupyter image.
+        max_workers: threads used to provision the workers.
+        instance_types: scheduler instance types acceptable if EC2 lacks capacity
+            for `InstanceType`, also used for the workers without `worker_type`.
+        subnet_ids: subnets acceptable if EC2 lacks capacity in the requested one.
+        **instance_params: Parameters for creating the EC2 instances.
+
+    Returns:
+        The DaskCluster.
+
+    Raises:
+        ClientError: If the creation fails. Every node already launched is terminated.
+    """
+    instance_params["IamInstanceProfile"] = {"Name": "AccessECR"}
+    instance_params = _add_cluster_tag(name, **instance_params)
+    # both fleets are created at once and each one edits its tags
+    scheduler_params = copy.deepcopy(instance_params)
+    worker_params = copy.deepcopy(instance_params)
+    worker_params["InstanceType"] = worker_type or instance_params["InstanceType"]
+    region = AwsService.from_service("ec2").get_region()
+
+    def _dask_scheduler(scheduler, account, **_):
+        node = scheduler.instances[0]
+        _start_dask_container("dask-scheduler", node["ip"], _ecr_image(account, region, container),
+                              f"dask scheduler --port {SCHEDULER_PORT} --dashboard-address :{dask_port}",
+                              environment=SCHEDULER_ENVIRONMENT)
+        return f"tcp://{node['private_ip']}:{SCHEDULER_PORT}"
+
+    def _dask_workers(workers, account, dask_scheduler, resources, **_):
+        return start_workers(workers, _ecr_image(account, region, container), dask_scheduler, resources,
+                             max_workers=max_workers)
+
+    def _jupyter(scheduler, account, dask_scheduler, **_):
+        _run_jupyter_notebook(account,
+                              container_name=container,
+                              host_ip=scheduler.instances[0]["ip"],
+                              jupyter_port=jupyter_port,
+                              dask_port=None,
+                              region=region,
+                              progress=progress,
+                              environment={"DASK_SCHEDULER_ADDRESS": dask_scheduler})
+
+    def _tunnel(scheduler, **_):
+        try:
+            return ssh_tunnel(user="ubuntu",
+                              host=scheduler.instances[0]["ip"],
+                              jupyter_port=jupyter_port,
+                              dask_port=dask_port)
+        except ConnectionError as e:
+            print(e)
+            return None
+
+    pipeline = Pipeline("create_cluster")
+    pipeline.add("scheduler", lambda: create_fleet(scheduler_fleet_name(name), 1, project_tag,
+                                                   instance_types=instance_types, subnet_ids=subnet_ids,
+                                                   **scheduler_params))
+    pipeline.add("workers", lambda: create_fleet(worker_fleet_name(name), workers, project_tag,
+                                                 max_workers=max_workers,
+                                                 instance_types=() if worker_type else instance_types,
+                                                 subnet_ids=subnet_ids, **worker_params))
+    # the launch may have fallen back on another instance type
+    pipeline.add("resources", lambda workers: worker_resources(workers.instances[0]["instance_type"]),
+                 deps=("workers",))
+    pipeline.add("account", lambda: AwsService.from_service("ec2").get_account_id())
+    pipeline.add("ecr_credentials",
+                 lambda account: get_ecr_credentials(f"{account}.dkr.ecr.{region}.amazonaws.com"),
+                 deps=("account",))
+    pipeline.add("dask_scheduler", _dask_scheduler, deps=("scheduler", "account", "ecr_credentials"))
+    pipeline.add("dask_workers", _dask_workers, deps=("workers", "account", "dask_scheduler", "resources"))
+    pipeline.add("jupyter", _jupyter, deps=("scheduler", "account", "dask_scheduler"))
+    pipeline.add("tunnel", _tunnel, deps=("scheduler", "jupyter"))
+
+    try:
+        results = pipeline.run()
+    except (ClientError, Exception, KeyboardInterrupt) as e:
+        print("Error creating or provisioning the cluster. Here is why:")
+        print(e)
+        launched = [f for f in (pipeline.phases["scheduler"].result, pipeline.phases["workers"].result) if f]
+        if launched:
+            print(f"Terminating the instances of cluster {name}")
+            terminate_instances([i for fleet in launched for i in fleet.instance_ids])
+        raise
+    finally:
+        pipeline.report()
+
+    cluster = DaskCluster(name, results["scheduler"], results["workers"])
+    cluster.display()
+    if results["tunnel"] is not None:
+        print(f"To reconnect to jupyter server and the dask dashboard use the following command:\n")
+        print(f"\t\t {results['tunnel']}")
+    return cluster
+
+
+def delete_cluster(name: str, wait: bool = False) -> list:
+    """
+    Terminates every node of cluster `name` with one TerminateInstances
+    request, and removes their docker contexts and registrations.
+
+    Returns:
+        The ids of the terminated instances.
+    """
+    filters = [{"Name": "tag:cluster", "Values": [name]},
+               {"Name": "instance-state-name", "Values": ["pending", "running", "stopping", "stopped"]}]
+    instance_ids = [i["InstanceId"] for i in describe_cache.describe_instances(filters, fresh=True)]
+    if not instance_ids:
+        print(f"Cluster {name} not found")
+        return []
+    return terminate_instances(instance_ids, wait=wait, fresh=True)
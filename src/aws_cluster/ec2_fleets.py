@@ -1,21 +1,149 @@
-# import boto3
+from concurrent.futures import ThreadPoolExecutor
 
+import docker
+from botocore.exceptions import ClientError
 
-# class AwsResource:
-#     def __init__(self, resource) -> None:
+from eki_dev import describe_cache
+from eki_dev.aws_service import AwsService
+from eki_dev.launch_fallback import launch_with_fallback
+from eki_dev.docker_utils import (
+    create_docker_context,
+    list_docker_context,
+)
+from eki_dev.utils import (
+    register_instance,
+    add_instance_tags,
+    check_project_tag
+)
 
-#         self.client = resource
-        
 
-#     @classmethod
-#     def from_resource(cls, res: str='ec2'):
-#         aws_client = boto3.client(res)        
-#         return cls(aws_client)
+class Ec2Fleet:
+    """
+    A group of EC2 instances launched together with a single RunInstances call.
 
+    Instance `i` of a fleet named `name` gets the docker context `name-i`.
 
-# class ec2_fleet:
-#     def __init__(self, aws_res: AwsResource = AwsResource.from_resource('ec2')):
-#         self.aws_res = aws_res
+    Args:
+        name: fleet name, used as prefix of the docker contexts and as `fleet` tag.
+        instances: list of dicts with the keys `name`, `id`, `ip`, `private_ip` and `instance_type`.
+    """
 
-    
-        
\ No newline at end of file
+    def __init__(self, name: str, instances: list):
+        self.name = name
+        self.instances = instances
+
+    def __len__(self):
+        return len(self.instances)
+
+    @property
+    def instance_ids(self) -> list:
+        return [i["id"] for i in self.instances]
+
+    def display(self, indent=1):
+        ind = "\t" * indent
+        print(f"Fleet {self.name}: {len(self)} instances")
+        for i in self.instances:
+            print(f"{ind}{i['name']:<24}{i['id']:<22}{i['ip']}")
+
+
+def fleet_instance_names(name: str, count: int) -> list:
+    return [f"{name}-{i}" for i in range(count)]
+
+
+def _add_fleet_tag(name: str, **instance_params):
+    spec = instance_params['TagSpecifications'][0]
+    tags = [t for t in spec['Tags'] if t['Key'] != 'fleet'] + [{'Key': 'fleet', 'Value': name}]
+    specs = [dict(spec, Tags=tags)] + instance_params['TagSpecifications'][1:]
+    return dict(instance_params, TagSpecifications=specs)
+
+
+def _describe_ips(client, instance_ids: list) -> dict:
+    """returns {instance_id: (public ip, private ip)} with one paginated DescribeInstances"""
+    ips = {}
+    paginator = client.get_paginator("describe_instances")
+    for page in paginator.paginate(InstanceIds=instance_ids):
+        for reservation in page["Reservations"]:
+            for inst in reservation["Instances"]:
+                ips[inst["InstanceId"]] = (inst.get("PublicIpAddress"), inst.get("PrivateIpAddress"))
+    return ips
+
+
+def create_fleet(name: str,
+                 count: int,
+                 project_tag: str,
+                 max_workers: int = 16,
+                 instance_types: list = (),
+                 subnet_ids: list = (),
+                 **instance_params) -> Ec2Fleet:
+    """
+    Launches `count` identical instances in one RunInstances call, waits for all
+    of them at once and creates their docker contexts and registrations in bulk.
+
+    Args:
+        name: fleet name. Instances get the docker contexts `name-0` ... `name-{count-1}`.
+        count: number of instances.
+        project_tag: project identification tag.
+        max_workers: threads used to create the docker contexts.
+        instance_types: instance types acceptable if EC2 lacks capacity for `InstanceType`.
+        subnet_ids: subnets acceptable if EC2 lacks capacity in the requested one.
+        **instance_params: Parameters for creating the EC2 instances.
+
+    Returns:
+        The Ec2Fleet.
+
+    Raises:
+        ClientError: If instance creation fails. Any instance already launched is terminated.
+    """
+    check_project_tag(project_tag)
+    instance_params = add_instance_tags(project_tag, **instance_params)
+    instance_params = _add_fleet_tag(name, **instance_params)
+
+    names = fleet_instance_names(name, count)
+    existing = {ctx.Name for ctx in list_docker_context()}
+    clashes = [n for n in names if n in existing]
+    if clashes:
+        print(f"Contexts {clashes} already exist")
+        raise docker.errors.ContextAlreadyExists(clashes[0])
+
+    svc = AwsService.from_service("ec2")
+    instance_ids = []
+    try:
+        def launch(**params):
+            print(f"Attempting to create {count} {params['InstanceType']} instances "
+                  f"in region {svc.get_region()}")
+            return svc.resource.create_instances(**params, MinCount=count, MaxCount=count)
+
+        instances = launch_with_fallback(launch, svc.get_region(), instance_types, subnet_ids, **instance_params)
+        describe_cache.invalidate()
+        instance_ids = [i.id for i in instances]
+
+        # a single waiter polls every instance, so the wait is bounded by the slowest one
+        svc.client.get_waiter("instance_running").wait(InstanceIds=instance_ids)
+        ips = _describe_ips(svc.client, instance_ids)
+
+        members = [{"name": n, "id": i.id, "ip": ips[i.id][0], "private_ip": ips[i.id][1],
+                    "instance_type": i.instance_type} for n, i in zip(names, instances)]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            list(pool.map(lambda m: create_docker_context(m["name"], host=m["ip"]), members))
+
+    except (ClientError, Exception, KeyboardInterrupt) as e:
+        print("Error creating or provisioning the fleet request. Here is why:")
+        print(e)
+        if instance_ids:
+            print(f"Terminating instances {instance_ids}")
+            svc.client.terminate_instances(InstanceIds=instance_ids)
+            describe_cache.invalidate()
+            for n in names:
+                try:
+                    docker.ContextAPI.remove_context(n)
+                except docker.errors.ContextNotFound:
+                    pass
+        raise
+
+    for m in members:
+        register_instance(m["name"], m["ip"], instance_id=m["id"], project=project_tag)
+    describe_cache.invalidate()
+
+    fleet = Ec2Fleet(name, members)
+    fleet.display()
+    return fleet
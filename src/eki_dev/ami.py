@@ -0,0 +1,94 @@
+import time
+
+from eki_dev.aws_service import AwsService
+from eki_dev.docker_utils import login_into_ecr, ecr_auth_config
+from eki_dev.pull_progress import pull_image
+from eki_dev.readiness import wait_until_ready, default_probes
+from eki_dev.ssh_transport import get_docker_client, run_command
+
+
+def ami_name(name: str, version: str = None) -> str:
+    """returns the versioned AMI name `name-version`. The version defaults to a UTC timestamp"""
+    version = version or time.strftime("%Y%m%d%H%M%S", time.gmtime())
+    return f"{name}-{version}"
+
+
+def _pull_images(user: str, host: str, images: list):
+    svc = AwsService.from_service("ec2")
+    registry = f"{svc.get_account_id()}.dkr.ecr.{svc.get_region()}.amazonaws.com"
+    docker_client = login_into_ecr(registry, docker_client=get_docker_client(user, host))
+    for image in images:
+        c_name, _, c_tag = image.partition(':')
+        print(f"Pre-pulling {registry}/{c_name}:{c_tag or 'latest'}")
+        pull_image(docker_client, f"{registry}/{c_name}", c_tag or "latest",
+                   auth_config=ecr_auth_config(registry), mode="quiet")
+
+
+def bake_ami(name: str = "edamame",
+             images: list = (),
+             version: str = None,
+             user: str = "ubuntu",
+             readiness_deadline: float = 1800,
+             **instance_params) -> str:
+    """
+    Bakes a golden AMI: launches a builder from `instance_params` (ImageId and
+    the full bootstrap UserData), waits for the bootstrap, optionally pre-pulls
+    ECR `images`, and registers the AMI `name-version`. The builder is always
+    terminated.
+
+    Args:
+        name: AMI name prefix.
+        images: ECR images (`repo:tag`) to pre-pull into the AMI.
+        version: AMI version. Defaults to a UTC timestamp.
+        **instance_params: Parameters for creating the builder instance.
+
+    Returns:
+        The new AMI id.
+    """
+    svc = AwsService.from_service("ec2")
+    image_name = ami_name(name, version)
+    if images:
+        instance_params["IamInstanceProfile"] = {"Name": "AccessECR"}
+    instance_params["TagSpecifications"] = [{"ResourceType": "instance",
+                                             "Tags": [{"Key": "Name", "Value": f"{image_name}-builder"}]}]
+
+    print(f"Launching AMI builder from {instance_params['ImageId']}")
+    instance = svc.resource.create_instances(**instance_params, MinCount=1, MaxCount=1)[0]
+    try:
+        instance.wait_until_running()
+        instance.reload()
+        host = instance.public_ip_address
+        wait_until_ready(default_probes(user, host), deadline=readiness_deadline).display()
+
+        if images:
+            _pull_images(user, host, images)
+
+        # instances launched from the AMI run their own UserData with cloud-init
+        run_command(user, host, "sudo cloud-init clean --logs")
+
+        print(f"Creating AMI {image_name}")
+        image_id = svc.client.create_image(
+            InstanceId=instance.id,
+            Name=image_name,
+            Description=f"EDAMAME golden image from {instance_params['ImageId']}",
+            TagSpecifications=[{"ResourceType": "image",
+                                "Tags": [{"Key": "edamame:ami", "Value": name},
+                                         {"Key": "edamame:version", "Value": image_name[len(name) + 1:]},
+                                         {"Key": "edamame:source-ami", "Value": instance_params["ImageId"]},
+                                         {"Key": "edamame:images", "Value": ",".join(images)}]}],
+        )["ImageId"]
+        svc.client.get_waiter("image_available").wait(ImageIds=[image_id])
+    finally:
+        print(f"Terminating AMI builder {instance.id}")
+        instance.terminate()
+
+    print(f"AMI {image_name} ({image_id}) is available")
+    return image_id
+
+
+def list_amis(name: str = "edamame") -> list:
+    """returns the baked AMIs named `name`, newest first"""
+    svc = AwsService.from_service("ec2")
+    images = svc.client.describe_images(Owners=["self"],
+                                        Filters=[{"Name": "tag:edamame:ami", "Values": [name]}])["Images"]
+    return sorted(images, key=lambda i: i["CreationDate"], reverse=True)
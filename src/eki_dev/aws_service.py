@@ -1,27 +1,82 @@
+import os
+import threading
+
 import boto3
 from botocore.exceptions import ClientError
 from boto3.exceptions import ResourceNotExistsError
 
+from eki_dev.credential_cache import CredentialCache
+from eki_dev.tracing import instrument_session
 
-class AwsService:
+# folder, relative to home, where account ids are cached between runs
+CONFIG_DIR = '.dev_machine'
+
+
+# Process-wide pools. Sessions are keyed by (region, profile) and services by
+# (service, region, profile) so repeated calls to `AwsService.from_service`
+# reuse the same boto3 session, resource and client objects.
+_SESSIONS = {}
+_SERVICES = {}
+# account id and ECR authorization memoized per session key
+_IDENTITY = {}
+_POOL_LOCK = threading.RLock()
+
+
+def _pool_key(region: str = None, profile: str = None) -> tuple:
+    region = region or os.getenv("AWS_REGION") or os.getenv("AWS_DEFAULT_REGION")
+    profile = profile or os.getenv("AWS_PROFILE")
+    return region, profile
+
+
+def get_session(region: str = None, profile: str = None) -> boto3.session.Session:
     """
-    Initializes the AwsService object with the provided resource and client.
+    Returns the pooled boto3 session for `region` and `profile`, creating it on
+    first use.
+    """
+    key = _pool_key(region, profile)
+    with _POOL_LOCK:
+        session = _SESSIONS.get(key)
+        if session is None:
+            session = instrument_session(boto3.session.Session(region_name=key[0], profile_name=key[1]))
+            _SESSIONS[key] = session
+    return session
 
-    Args:
-        resource: The AWS resource to interact with.
-        client: The AWS client to perform operations with.
 
-    Returns:
-        None
+def credentials_fingerprint(session: boto3.session.Session) -> str:
+    """Non reversible key of the credentials of `session`, None without credentials"""
+    credentials = session.get_credentials()
+    if credentials is None or not credentials.access_key:
+        return None
+    return CredentialCache.fingerprint(credentials.access_key)
+
+
+def reset_pool() -> None:
+    """Drops every pooled session, service and memoized identity"""
+    with _POOL_LOCK:
+        _SESSIONS.clear()
+        _SERVICES.clear()
+        _IDENTITY.clear()
+
+
+class AwsService:
+    """
+    Wraps the boto3 resource and client for an AWS service.
+
+    Instances are pooled per (service, region, profile); use
+    `AwsService.from_service` rather than the constructor. The constructor makes
+    no network calls: the account id and the ECR authorization token are
+    fetched on first use and memoized for the whole process.
     """
 
-    def __init__(self, session=None, resource=None, client=None):
+    def __init__(self, session=None, resource=None, client=None, profile=None):
         """
     Initializes the AwsService object with the provided resource and client.
 
     Args:
+        session: The boto3 session the resource and client were created from.
         resource: The AWS resource to interact with.
         client: The AWS client to perform operations with.
+        profile: The AWS profile name of the session, if any.
 
     Returns:
         None
@@ -30,18 +85,18 @@ class AwsService:
         self.resource = resource
         self.client = client
         self.region = self.session.region_name
-        self.account_id = self.session.client('sts').get_caller_identity().get('Account')
-        ecr_auth = self.session.client('ecr').get_authorization_token()
-        self.ecr_pass = ecr_auth.get("authorizationData")[0].get('authorizationToken')
-
+        self.profile = profile
 
     @classmethod
-    def from_service(cls, service: str) -> "AwsService":
+    def from_service(cls, service: str, region: str = None, profile: str = None) -> "AwsService":
         """
-        Creates an AwsService object for the specified AWS service.
+        Creates an AwsService object for the specified AWS service, or returns the
+        pooled one if it was already created in this process.
 
         Args:
             service: The AWS service to interact with.
+            region: AWS region. Defaults to the environment/profile configuration.
+            profile: AWS profile name. Defaults to AWS_PROFILE.
 
         Returns:
             An instance of AwsService initialized with the AWS resource and client for the specified service.
@@ -49,30 +104,38 @@ class AwsService:
         Raises:
             ClientError: If there is an error creating the AWS resource or client for the service.
         """
-
-        session = boto3.session.Session()
-        region = session.region_name
-
-        # region = os.getenv("AWS_DEFAULT_REGION", "us-east-1")
-
-        try:
-            cls_res = boto3.resource(service, region_name=region)
-        except ResourceNotExistsError:
-            cls_res = None
-            # print("Resource interface not available for service '{}'.".format(service))
-            # print("Attempting Client interface...")
-        try:
-            cls_client = boto3.client(service, region_name=region)
-
-            return cls(session, cls_res, cls_client)
-
-        except ClientError as err:
-            print(
-                "Could not create the requested service: %s %s",
-                err.response["Error"]["Code"],
-                err.response["Error"]["Message"],
-            )
-            raise
+        region, profile = _pool_key(region, profile)
+        key = (service, region, profile)
+        with _POOL_LOCK:
+            svc = _SERVICES.get(key)
+            if svc is not None:
+                return svc
+
+            session = get_session(region, profile)
+            region = session.region_name
+
+            try:
+                cls_res = session.resource(service, region_name=region)
+            except ResourceNotExistsError:
+                cls_res = None
+                # print("Resource interface not available for service '{}'.".format(service))
+                # print("Attempting Client interface...")
+            try:
+                cls_client = session.client(service, region_name=region)
+            except ClientError as err:
+                print(
+                    "Could not create the requested service: %s %s",
+                    err.response["Error"]["Code"],
+                    err.response["Error"]["Message"],
+                )
+                raise
+
+            svc = cls(session, cls_res, cls_client, profile=profile)
+            _SERVICES[key] = svc
+            return svc
+
+    def _identity(self) -> dict:
+        return _IDENTITY.setdefault((self.region, self.profile), {})
 
     def get_region(self) -> str:
         """
@@ -82,10 +145,39 @@ class AwsService:
 
     def get_account_id(self) -> str:
         """
-        returns a string with aws account id
+        returns a string with aws account id. The account id is cached on disk per
+        set of credentials, so STS is only called the first time they are used.
         """
-        return self.account_id
+        identity = self._identity()
+        if "account_id" not in identity:
+            with _POOL_LOCK:
+                if "account_id" not in identity:
+                    cache = CredentialCache(CONFIG_DIR=CONFIG_DIR)
+                    fingerprint = credentials_fingerprint(self.session)
+                    account_id = cache.get_account_id(fingerprint) if fingerprint else None
+                    if account_id is None:
+                        sts = AwsService.from_service("sts", self.region, self.profile)
+                        account_id = sts.client.get_caller_identity().get("Account")
+                        if fingerprint:
+                            cache.put_account_id(fingerprint, account_id)
+                    identity["account_id"] = account_id
+        return identity["account_id"]
+
+    @property
+    def account_id(self) -> str:
+        return self.get_account_id()
 
     def get_ecr_authorization(self) -> str:
-        """returns an authorization token for ECR"""
-        return self.ecr_pass
+        """returns an authorization token for ECR. The ECR call is made once per process."""
+        identity = self._identity()
+        if "ecr_pass" not in identity:
+            with _POOL_LOCK:
+                if "ecr_pass" not in identity:
+                    ecr = AwsService.from_service("ecr", self.region, self.profile)
+                    ecr_auth = ecr.client.get_authorization_token()
+                    identity["ecr_pass"] = ecr_auth.get("authorizationData")[0].get("authorizationToken")
+        return identity["ecr_pass"]
+
+    @property
+    def ecr_pass(self) -> str:
+        return self.get_ecr_authorization()
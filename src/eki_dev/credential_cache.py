@@ -0,0 +1,79 @@
+import time
+import hashlib
+import contextlib
+
+from eki_dev.json_file import LockedJsonFile
+
+
+class CredentialCache:
+    """
+    Small on-disk cache for ECR authorization tokens and AWS account ids.
+
+    The cache lives in a single LockedJsonFile under `~/CONFIG_DIR`, so several
+    edamame processes can use it at the same time.
+
+    Args:
+        refresh_margin: seconds before `expiresAt` at which a token is considered stale.
+    """
+
+    FILE_NAME = "credentials_cache.json"
+
+    def __init__(self, CONFIG_DIR='.dev_machine', refresh_margin: float = 3600):
+        self.file = LockedJsonFile(self.FILE_NAME, CONFIG_DIR=CONFIG_DIR)
+        self.path = self.file.path
+        self.refresh_margin = refresh_margin
+
+    def lock(self, exclusive: bool = False):
+        """Holds an advisory lock on the cache for the duration of the block"""
+        return self.file.lock(exclusive)
+
+    def _update(self, section: str, key: str, value: dict):
+        # caller holds the exclusive lock
+        data = self.file.read()
+        data.setdefault(section, {})[key] = value
+        self.file.write(data)
+
+    @staticmethod
+    def ecr_key(account_id: str, region: str) -> str:
+        return f"{account_id}:{region}"
+
+    def get_ecr_token(self, account_id: str, region: str, locked: bool = False) -> dict:
+        """
+        Returns the cached token entry ({"token", "expires_at", "verified"}) for the
+        registry of `account_id` in `region`, or None if missing or due for refresh.
+        """
+        with contextlib.nullcontext() if locked else self.lock():
+            entry = self.file.read().get("ecr", {}).get(self.ecr_key(account_id, region))
+        if entry is None or entry["expires_at"] - self.refresh_margin <= time.time():
+            return None
+        return entry
+
+    def put_ecr_token(self, account_id: str, region: str, token: str, expires_at: float,
+                      verified: bool = False, locked: bool = False):
+        entry = {"token": token, "expires_at": expires_at, "verified": verified}
+        with contextlib.nullcontext() if locked else self.lock(exclusive=True):
+            self._update("ecr", self.ecr_key(account_id, region), entry)
+        return entry
+
+    def mark_ecr_token_verified(self, account_id: str, region: str, token: str):
+        """Records that a docker login with `token` succeeded"""
+        key = self.ecr_key(account_id, region)
+        with self.lock(exclusive=True):
+            entry = self.file.read().get("ecr", {}).get(key)
+            if entry is not None and entry["token"] == token:
+                entry["verified"] = True
+                self._update("ecr", key, entry)
+
+    @staticmethod
+    def fingerprint(access_key: str) -> str:
+        """Non reversible key for a set of credentials"""
+        return hashlib.sha256(access_key.encode("utf8")).hexdigest()[:16]
+
+    def get_account_id(self, fingerprint: str) -> str:
+        with self.lock():
+            entry = self.file.read().get("accounts", {}).get(fingerprint)
+        return None if entry is None else entry["account_id"]
+
+    def put_account_id(self, fingerprint: str, account_id: str):
+        with self.lock(exclusive=True):
+            self._update("accounts", fingerprint, {"account_id": account_id})
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import hashlib
+import datetime
+import threading
+
+from eki_dev.aws_service import AwsService, _pool_key, get_session, credentials_fingerprint
+from eki_dev.json_file import LockedJsonFile
+
+
+class DescribeCache:
+    """
+    Read-through cache of EC2 describe results, in memory and optionally on
+    disk in ~/CONFIG_DIR/describe_cache.json so consecutive edamame commands
+    share it.
+
+    A result younger than `ttl` is served as is. An older one, up to
+    `stale_ttl`, is served while a background thread fetches it again
+    (stale-while-revalidate). Past `stale_ttl` it is fetched synchronously.
+    Commands that change instances call `invalidate`.
+
+    Args:
+        ttl: seconds a result is fresh, per operation in `ttls`.
+        stale_ttl: seconds a result may be served while being refreshed.
+        persist: keep a copy on disk.
+    """
+
+    FILE_NAME = "describe_cache.json"
+
+    def __init__(self, CONFIG_DIR='.dev_machine', ttl: float = 15, stale_ttl: float = 300,
+                 persist: bool = True, ttls: dict = None):
+        self.file = LockedJsonFile(self.FILE_NAME, CONFIG_DIR=CONFIG_DIR, encode=_encode, decode=_decode)
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+        self.stale_ttl = stale_ttl
+        self.persist = persist
+        self._memory = {}
+        self._refreshing = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(operation: str, params: dict) -> str:
+        # the credentials fingerprint keeps the results of another account
+        # from being served after a credential change under the same profile
+        region, profile = _pool_key()
+        credentials = credentials_fingerprint(get_session(region, profile))
+        blob = json.dumps(params, sort_keys=True, default=str)
+        return f"{operation}:{region}:{profile}:{credentials}:{hashlib.sha256(blob.encode()).hexdigest()[:16]}"
+
+    def _entry(self, key: str) -> dict:
+        with self._lock:
+            entry = self._memory.get(key)
+        if entry is None and self.persist:
+            with self.file.lock():
+                entry = self.file.read().get(key)
+            if entry is not None:
+                with self._lock:
+                    self._memory[key] = entry
+        return entry
+
+    def store(self, key: str, value):
+        entry = {"stored_at": time.time(), "value": value}
+        with self._lock:
+            self._memory[key] = entry
+        if self.persist:
+            with self.file.lock(exclusive=True):
+                data = self.file.read()
+                now = time.time()
+                data = {k: e for k, e in data.items() if now - e["stored_at"] < self.stale_ttl}
+                data[key] = entry
+                self.file.write(data)
+
+    def lookup(self, key: str, refresh=None, allow_stale: bool = True):
+        """
+        returns the cached value of `key`, or None if it must be fetched. A
+        stale value is returned only with `allow_stale`, after starting
+        `refresh` (a callable returning the new value) in the background.
+        """
+        entry = self._entry(key)
+        if entry is None:
+            return None
+        age = time.time() - entry["stored_at"]
+        if age <= self.ttls.get(key.split(":")[0], self.ttl):
+            return entry["value"]
+        if not allow_stale or age > self.stale_ttl or refresh is None:
+            return None
+        self._revalidate(key, refresh)
+        return entry["value"]
+
+    def _revalidate(self, key: str, refresh):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            # not a daemon: a short lived command finishes the refresh before exiting
+            thread = threading.Thread(target=self._refresh, args=(key, refresh), name=f"revalidate-{key}")
+            self._refreshing[key] = thread
+        thread.start()
+
+    def _refresh(self, key: str, refresh):
+        try:
+            self.store(key, refresh())
+        except Exception:
+            pass
+        finally:
+            with self._lock:
+                self._refreshing.pop(key, None)
+
+    def wait(self):
+        """waits for the background refreshes in flight"""
+        with self._lock:
+            threads = list(self._refreshing.values())
+        for thread in threads:
+            thread.join()
+
+    def invalidate(self, operation: str = None):
+        """drops the results of `operation`, or every result"""
+        def keep(k):
+            return operation is not None and not k.startswith(f"{operation}:")
+        with self._lock:
+            self._memory = {k: e for k, e in self._memory.items() if keep(k)}
+        if self.persist and os.path.exists(self.file.path):
+            with self.file.lock(exclusive=True):
+                data = self.file.read()
+                self.file.write({k: e for k, e in data.items() if keep(k)})
+
+
+def _encode(obj):
+    if isinstance(obj, datetime.datetime):
+        return {"__datetime__": obj.isoformat()}
+    raise TypeError(f"{type(obj)} is not JSON serializable")
+
+
+def _decode(obj: dict):
+    if "__datetime__" in obj:
+        return datetime.datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_cache() -> DescribeCache:
+    """returns the process-wide DescribeCache"""
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = DescribeCache()
+        return _CACHE
+
+
+def configure(**kwargs) -> DescribeCache:
+    """replaces the process-wide cache by DescribeCache(**kwargs)"""
+    global _CACHE
+    with _CACHE_LOCK:
+        _CACHE = DescribeCache(**kwargs)
+        return _CACHE
+
+
+def invalidate(operation: str = "DescribeInstances"):
+    """drops the cached results of `operation` after instances were created, started or terminated"""
+    get_cache().invalidate(operation)
+
+
+def reset_cache():
+    """drops every cached result, in memory and on disk, and forgets the configuration"""
+    global _CACHE
+    cache = get_cache()
+    cache.wait()
+    cache.invalidate()
+    with _CACHE_LOCK:
+        _CACHE = None
+
+
+def _fetch_instances(filters: list, page_size: int = None):
+    paginator = AwsService.from_service("ec2").client.get_paginator("describe_instances")
+    pagination = {"PageSize": page_size} if page_size else {}
+    for page in paginator.paginate(Filters=filters, PaginationConfig=pagination):
+        for reservation in page["Reservations"]:
+            yield from reservation["Instances"]
+
+
+def describe_instances(filters: list, fresh: bool = False, allow_stale: bool = True, page_size: int = None):
+    """
+    Yields the DescribeInstances records matching `filters`, from the cache
+    when possible. On a miss the records are yielded as the pages arrive and
+    cached at the end. `fresh` bypasses the cache.
+    """
+    cache = get_cache()
+    key = cache.key("DescribeInstances", {"Filters": filters})
+    if not fresh:
+        cached = cache.lookup(key, refresh=lambda: list(_fetch_instances(filters, page_size)),
+                              allow_stale=allow_stale)
+        if cached is not None:
+            yield from cached
+            return
+
+    records = []
+    for inst in _fetch_instances(filters, page_size):
+        records.append(inst)
+        yield inst
+    cache.store(key, records)
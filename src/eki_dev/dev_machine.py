@@ -1,41 +1,180 @@
-import os
-import time
-import re
+import sys
+import csv
+import json
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 from botocore.exceptions import ClientError
 import docker
 
-from rich.progress import Progress
-
 from eki_dev.aws_service import AwsService
 
 from eki_dev.docker_utils import (
     create_docker_context,
     remove_docker_context,
-    _check_docker_installed,
-    find_context_name_from_instance_ip,
+    list_host_ip_for_all_contexts,
     check_docker_context_does_not_exist,
     login_into_ecr,
+    get_ecr_credentials,
+    ecr_auth_config,
     wait_for_token
 )
 
 from eki_dev.utils import (
-    show_progress,
     ssh_tunnel,
     register_instance,
     deregister_instance,
     add_instance_tags,
-    get_project_tags
+    get_iam_user,
+    check_project_tag
 )
+from eki_dev import tracing
+from eki_dev.pipeline import Pipeline
+from eki_dev.state import StateStore
+from eki_dev import describe_cache
+from eki_dev.pull_progress import pull_image
+from eki_dev.readiness import wait_until_ready, default_probes
+from eki_dev.ssh_transport import get_docker_client
+from eki_dev.warm_pool import claim_warm_instance, refill_in_background
+from eki_dev.launch_fallback import launch_with_fallback
+from eki_dev.storage import with_storage_profile, container_volumes, check_storage
+from eki_dev.image_cache import lookup_image_cache, with_image_cache, image_is_current, refresh_in_background
+
+
+def _launch_instance(project_tag: str,
+                     iam_user: dict,
+                     instance_types: list = (),
+                     subnet_ids: list = (),
+                     **instance_params):
+    """
+    Sends the RunInstances request. Returns the new, still pending, instance.
+    When EC2 lacks capacity, the next of `instance_types` and `subnet_ids` is tried.
+    """
+    instance_params = add_instance_tags(project_tag, iam_user=iam_user, **instance_params)
+    res = AwsService.from_service("ec2")
+
+    keyname = instance_params["KeyName"]
+    region = res.client.meta.region_name
+    print(f"Creating using {keyname} key")
+
+    def launch(**params):
+        print(f"Attempting to create {params['InstanceType']} instance in region {region}")
+        return res.resource.create_instances(**params, MinCount=1, MaxCount=1)[0]
+
+    instance = launch_with_fallback(launch, region, instance_types, subnet_ids, **instance_params)
+    describe_cache.invalidate()
+    return instance
+
+
+def _claim_or_launch_instance(project_tag: str,
+                              iam_user: dict,
+                              instance_types: list = (),
+                              subnet_ids: list = (),
+                              storage: str = None,
+                              **instance_params):
+    """
+    Hands out a warm pool instance of the requested type and `storage`
+    profile, or launches a new one if the pool has none
+    """
+    instance = claim_warm_instance(instance_params["InstanceType"], project_tag, iam_user=iam_user, storage=storage)
+    if instance is None:
+        print(f"No warm {instance_params['InstanceType']} instance available, launching a new one")
+        instance = _launch_instance(project_tag, iam_user, instance_types, subnet_ids, **instance_params)
+    return instance
+
+
+def _wait_for_instance(name: str, instance):
+    """Waits until `instance` is running, then creates its docker context and registers it"""
+    instance.wait_until_running()
+
+    instance.reload() # required to update public ip address
+
+    host_ip = instance.public_ip_address
+    print(f"public ip {host_ip} assigned. Creating Docker context now")
+    create_docker_context(name, host=host_ip)
+
+    _display(instance)
+    tags = {t["Key"]: t["Value"] for t in instance.tags or []}
+    register_instance(name, host_ip, instance_id=instance.id, project=tags.get("project"), image=instance.image_id)
+    # cached listings may hold the instance without its public ip
+    describe_cache.invalidate()
+    return instance
+
+
+def _add_instance_phases(pipeline: Pipeline,
+                         name: str,
+                         project_tag: str,
+                         warm_pool: bool = False,
+                         storage: str = None,
+                         image_cache: str = None,
+                         instance_types: list = (),
+                         subnet_ids: list = (),
+                         **instance_params) -> Pipeline:
+    """
+    Adds the phases that launch an instance to `pipeline`. The context check,
+    project tag validation and IAM user lookup run concurrently before the
+    launch; the `running` phase returns the running instance. With `warm_pool`
+    the launch first tries to claim a warm pool instance of the `storage`
+    profile. With `image_cache`, a container name, the `image_cache` phase
+    looks up its cache snapshot and the instance is launched with a volume
+    restored from it. `instance_types` and `subnet_ids` are the fallbacks when
+    EC2 lacks capacity.
+    """
+    launch = functools.partial(_claim_or_launch_instance, storage=storage) if warm_pool else _launch_instance
+    launch_deps = ("context_check", "project_tag", "iam_user")
+    pipeline.add("context_check", lambda: check_docker_context_does_not_exist(name))
+    pipeline.add("project_tag", lambda: check_project_tag(project_tag))
+    pipeline.add("iam_user", get_iam_user)
+    if image_cache is not None:
+        pipeline.add("image_cache", lambda: lookup_image_cache(image_cache))
+        launch_deps += ("image_cache",)
+    pipeline.add("launch",
+                 lambda iam_user, image_cache=None, **_: launch(project_tag, iam_user, instance_types, subnet_ids,
+                                                                **with_image_cache(image_cache, **instance_params)),
+                 deps=launch_deps)
+    pipeline.add("running", lambda launch: _wait_for_instance(name, launch), deps=("launch",))
+    return pipeline
+
+
+def _run_instance_pipeline(pipeline: Pipeline, name: str) -> dict:
+    """
+    Runs `pipeline`, terminating the instance if it was launched but the
+    `running` phase did not complete.
+    """
+    try:
+        return pipeline.run()
+    except docker.errors.ContextAlreadyExists as e:
+        print(f"Context {name} already exists")
+        raise
+    except (ClientError, Exception, KeyboardInterrupt) as e:
+        print("Error creating or provisioning the instance request. Here is why:")
+        print(e)
+        instance = pipeline.phases["launch"].result
+        if (instance is not None) and pipeline.phases["running"].status != "done":
+            print(f"instance {instance.id} was created and in state {instance.state}")
+            print("Terminating instance")
+            instance.terminate()
+            describe_cache.invalidate()
+            try:
+                remove_docker_context(name)
+            except Exception:
+                pass
+        raise
+    finally:
+        pipeline.report()
 
 
 def create_ec2_instance(name: str,
                         project_tag: str,
+                        instance_types: list = (),
+                        subnet_ids: list = (),
                         **instance_params):
     """
     Creates a new EC2 instance based on the provided instance parameters.
 
     Args:
+        instance_types: instance types acceptable if EC2 lacks capacity for `InstanceType`.
+        subnet_ids: subnets acceptable if EC2 lacks capacity in the requested one.
         **instance_params: Parameters for creating the EC2 instance.
 
     Returns:
@@ -45,54 +184,11 @@ def create_ec2_instance(name: str,
         ClientError: If instance creation fails.
     """
 
-    instance = None
-    lst_tags = get_project_tags()
-    if project_tag in lst_tags:
-        instance_params = add_instance_tags(project_tag, **instance_params)
-    else:
-        print(f"tag {project_tag} must be one of {lst_tags}")
-        raise Exception(f"tag {project_tag} must be one of {lst_tags}")
-
-    try:
-        check_docker_context_does_not_exist(name)
-    except docker.errors.ContextAlreadyExists as e:
-        print(f"Context {name} already exists")
-        raise
-
-    try:
-        res = AwsService.from_service("ec2")
-
-        instype = instance_params["InstanceType"]
-        keyname = instance_params["KeyName"]
-        region = res.client.meta.region_name
-        print(f"Attempting to create {instype} instance in region {region}")
-        print(f"Creating using {keyname} key")
-
-        instance = res.resource.create_instances(
-            **instance_params, MinCount=1, MaxCount=1
-        )[0]
-        instance.wait_until_running()
-
-        instance.reload() # required to update public ip address
-
-        host_ip = instance.public_ip_address
-        print(f"public ip {host_ip} assigned. Creating Docker context now")
-        docker_ctxt = create_docker_context(name,
-                                                host=host_ip)
-
-    except (ClientError, Exception, KeyboardInterrupt) as e:
-        print("Error creating or provisioning the instance request. Here is why:")
-        print(e)
-        if (instance is not None) & (instance.state not in ["shutting-down", "terminated"]):
-            print(f"instance {instance.id} was created and in state {instance.state}")
-            print("Terminating instance")
-            terminate_instance(instance.id)
-            raise
-
-    else:
-        _display(instance)
-        register_instance(name, host_ip)
-        return instance
+    pipeline = Pipeline("create_ec2_instance")
+    _add_instance_phases(pipeline, name, project_tag, instance_types=instance_types, subnet_ids=subnet_ids,
+                         **instance_params)
+    results = _run_instance_pipeline(pipeline, name)
+    return results["running"]
 
 
 def _run_jupyter_notebook(account_id: str,
@@ -101,39 +197,49 @@ def _run_jupyter_notebook(account_id: str,
                           jupyter_port: int,
                           dask_port: int,
                           user: str = "ubuntu",
-                          region: str = "us-west-1", ):
+                          region: str = "us-west-1",
+                          readiness_deadline: float = 900,
+                          image_digest: str = None,
+                          progress: str = "rich",
+                          environment: dict = None,
+                          volumes: list = None):
     REGION=region
     ACCOUNT=account_id
     registry = f"{ACCOUNT}.dkr.ecr.{REGION}.amazonaws.com"
     c_name, c_tag = container_name.split(':')
     container_full_name = f"{ACCOUNT}.dkr.ecr.{REGION}.amazonaws.com/{c_name}"
     host = host_ip
-    os.environ["DOCKER_HOST"] = f"ssh://{user}@{host}"
-
-    while not _check_docker_installed(user, host):
-        pass
 
-    docker_client = login_into_ecr(registry)
+    print(f"Waiting for {host} to finish bootstrapping...")
+    with tracing.span("readiness", host=host):
+        report = wait_until_ready(default_probes(user, host), deadline=readiness_deadline)
+    report.display()
 
-    tasks = {}
-    with Progress(refresh_per_second=500, transient=True) as progress:
+    docker_client = login_into_ecr(registry, docker_client=get_docker_client(user, host))
 
-        resp = docker_client.api.pull(repository=f"{container_full_name}", tag=c_tag, stream=True, decode=True)
-        for line in resp:
-            show_progress(line, progress, tasks)
+    if image_digest is not None and image_is_current(docker_client, container_full_name, c_tag, image_digest):
+        print(f"{container_name} is up to date ({image_digest}), skipping the pull")
+    else:
+        pull_image(docker_client, container_full_name, c_tag, auth_config=ecr_auth_config(registry), mode=progress)
 
     print("Running container with Jupyter notebook...")
     c_full_name = ":".join([container_full_name, c_tag])
-    c = docker_client.containers.run(image=f"{c_full_name}",
-                                 command=f"jupyter-lab --port {jupyter_port} --no-browser --ip=0.0.0.0 --allow-root",
-                                 user=0,
-                                 #auto_remove=True,
-                                 detach=True,
-                                 volumes=['/home/ubuntu/efs:/home/eki/efs'],
-                                 ports={jupyter_port: jupyter_port, dask_port: dask_port},
-                                 )
-
-    token = wait_for_token(c)
+    with tracing.span("docker run", image=c_full_name, host=host):
+        c = docker_client.containers.run(image=f"{c_full_name}",
+                                     command=f"jupyter-lab --port {jupyter_port} --no-browser --ip=0.0.0.0 --allow-root",
+                                     user=0,
+                                     #auto_remove=True,
+                                     detach=True,
+                                     volumes=volumes or container_volumes(),
+                                     # without dask_port, the dask dashboard port is used by a scheduler on the host
+                                     ports={jupyter_port: jupyter_port, **({dask_port: dask_port} if dask_port else {})},
+                                     environment=environment,
+                                     )
+
+    with tracing.span("jupyter token", host=host) as span:
+        token = wait_for_token(c)
+        if not token:
+            span.finish("timeout")
 
     if token:
         jupyter_url = f"http://localhost:{jupyter_port}"
@@ -151,115 +257,225 @@ def create_instance_pull_start_server(name: str,
                                       jupyter_port: int = 8888,
                                       dask_port: int = 8889,
                                       container: str = "data_explorer:prod",
+                                      warm_pool: bool = False,
+                                      warm_pool_size: int = 1,
+                                      image_cache: bool = False,
+                                      progress: str = "rich",
+                                      instance_types: list = (),
+                                      subnet_ids: list = (),
+                                      storage: str = None,
+                                      storage_check: bool = False,
+                                      profile: str = None,
                                       **instance_params):
+    """
+    Creates an EC2 instance and runs a Jupyter server from `container` on it.
 
-    try:
-        check_docker_context_does_not_exist(name)
-    except docker.errors.ContextAlreadyExists as e:
-        print(f"Context {name} already exists")
-        raise
+    The phases that do not depend on the instance (project tags, IAM user,
+    account id and ECR credentials) run while the instance boots. A timing
+    report of every phase is printed at the end.
 
-    instance_params["IamInstanceProfile"] = {"Name": "AccessECR"}
+    With `warm_pool` a stopped, pre-provisioned instance of the same type and
+    storage profile is used when available, and the pool is refilled to `warm_pool_size` in the
+    background.
 
+    With `image_cache` the instance starts with /var/lib/docker restored from
+    the EBS snapshot cache of `container`, so the pull only fetches what
+    changed. The snapshot is rebuilt in the background when the image digest
+    in ECR has moved.
 
-    try:
-        i = create_ec2_instance(name=name,
-                                project_tag=project_tag,
-                                **instance_params)
-    except Exception as e:
-        print(e)
-        raise
-
-    print("PROVISIONING INSTANCE WITH REQUIRED SERVICES...")
-    aws_account = AwsService.from_service('ec2').get_account_id()
-    aws_region = AwsService.from_service('ec2').get_region()
-    user = "ubuntu"
-    host = i.public_ip_address
-    _run_jupyter_notebook(aws_account,
-                          container_name=container,
-                          host_ip=host,
-                          jupyter_port=jupyter_port,
-                          dask_port=dask_port,
-                          region=aws_region)
+    When EC2 lacks capacity, the launch falls back on the other acceptable
+    `instance_types` and `subnet_ids`.
 
-    del os.environ["DOCKER_HOST"]
+    `storage` selects the storage profile (see eki_dev.storage) mounted on the
+    instance and in the container. With `storage_check` the bandwidth of its
+    mounts is measured with fio at the end.
 
-    try:
-        tunnel_cmd = ssh_tunnel(user=user,
-                   host=host,
-                   jupyter_port=jupyter_port,
-                   dask_port=dask_port)
-    except ConnectionError as e:
-        print(e)
-        pass
+    The background processes use the configuration `profile`.
+    """
 
-    print(f"To reconnect to jupyter server use the following command:\n")
-    print(f"\t\t {tunnel_cmd}")
-    return i
+    instance_params["IamInstanceProfile"] = {"Name": "AccessECR"}
+    instance_params = with_storage_profile(storage, **instance_params)
+    user = "ubuntu"
+    aws_region = AwsService.from_service('ec2').get_region()
 
+    def _jupyter(running, account, image_cache=None, **_):
+        print("PROVISIONING INSTANCE WITH REQUIRED SERVICES...")
+        _run_jupyter_notebook(account,
+                              container_name=container,
+                              host_ip=running.public_ip_address,
+                              jupyter_port=jupyter_port,
+                              dask_port=dask_port,
+                              region=aws_region,
+                              image_digest=image_cache["digest"] if image_cache else None,
+                              progress=progress,
+                              volumes=container_volumes(storage))
+
+    def _tunnel(running, **_):
+        try:
+            return ssh_tunnel(user=user,
+                              host=running.public_ip_address,
+                              jupyter_port=jupyter_port,
+                              dask_port=dask_port)
+        except ConnectionError as e:
+            print(e)
+            return None
+
+    pipeline = Pipeline("create_instance_pull_start_server")
+    _add_instance_phases(pipeline, name, project_tag, warm_pool=warm_pool, storage=storage,
+                         image_cache=container if image_cache else None,
+                         instance_types=instance_types, subnet_ids=subnet_ids, **instance_params)
+    pipeline.add("account", lambda: AwsService.from_service('ec2').get_account_id())
+    pipeline.add("ecr_credentials",
+                 lambda account: get_ecr_credentials(f"{account}.dkr.ecr.{aws_region}.amazonaws.com"),
+                 deps=("account",))
+    jupyter_deps = ("running", "account", "ecr_credentials") + (("image_cache",) if image_cache else ())
+    pipeline.add("jupyter", _jupyter, deps=jupyter_deps)
+    pipeline.add("tunnel", _tunnel, deps=("running", "jupyter"))
+
+    results = _run_instance_pipeline(pipeline, name)
+    if warm_pool:
+        refill_in_background(instance_params["InstanceType"], size=warm_pool_size, storage=storage,
+                             profile=profile)
+    if image_cache and not results["image_cache"]["current"]:
+        refresh_in_background(container, profile=profile)
+
+    if storage_check:
+        check_storage(user, results["running"].public_ip_address, storage)
+
+    tunnel_cmd = results["tunnel"]
+    if tunnel_cmd is not None:
+        print(f"To reconnect to jupyter server use the following command:\n")
+        print(f"\t\t {tunnel_cmd}")
+    return results["running"]
+
+
+def clean_dangling_contexts(CONFIG_DIR='.dev_machine', max_age: float = 300, force: bool = False,
+                            fresh: bool = False) -> []:
+    """
+    Removes the docker contexts and state entries of machines that no longer
+    exist. Only the entries not checked in the last `max_age` seconds (all of
+    them with `force`) are looked up, with one DescribeInstances filtered on
+    their IPs; nothing is called when every entry is fresh.
 
-def clean_dangling_contexts(CONFIG_DIR='.dev_machine') -> []:
+    Returns:
+        The names of the removed machines.
+    """
 
     print("CLEANING DANGLING CONTEXTS...")
-    lst_cleaned_contexts = []
-    lst_instances = _get_lst_instances()
-    lst_ips = []
-    for instance in lst_instances.iterator():
-        lst_ips.append(instance.public_ip_address)
-
-    HOME = os.path.expanduser("~")
-    for root, dirs, files in os.walk(os.path.join(HOME, CONFIG_DIR)):
-        for file in files:
-            try:
-                name, ip = file.split("@")
-            except ValueError:
+    store = StateStore(CONFIG_DIR)
+    try:
+        stale = store.all() if force else store.stale(max_age)
+        if not stale:
+            return []
+
+        ips = sorted({e["ip"] for e in stale if e["ip"]})
+        live_ips = set()
+        for i in range(0, len(ips), 200):
+            filters = [{"Name": "ip-address", "Values": ips[i:i + 200]},
+                       {"Name": "instance-state-name", "Values": ["pending", "running", "stopping", "stopped"]}]
+            live_ips.update(inst.get("PublicIpAddress")
+                            for inst in describe_cache.describe_instances(filters, fresh=fresh, allow_stale=False))
+
+        lst_cleaned_contexts = []
+        for entry in stale:
+            if entry["ip"] in live_ips:
                 continue
-            if ip not in lst_ips:
-                try:
-                    remove_docker_context(name)
-                except Exception as e:
-                    pass
-
-                try:
-                    os.remove(os.path.join(root, file))
-                except Exception as e:
-                    pass
-                lst_cleaned_contexts.append(name)
+            try:
+                remove_docker_context(entry["context"] or entry["name"])
+            except Exception as e:
+                pass
+            store.remove(entry["name"], entry["ip"])
+            lst_cleaned_contexts.append(entry["name"])
+        store.mark_checked([e["name"] for e in stale if e["name"] not in lst_cleaned_contexts])
+    finally:
+        store.close()
 
     return lst_cleaned_contexts
 
 
-def list_instances(indent=1):
-    """
-    Displays information about all running instances. Returns a list of instances
-
-    :param indent: The visual indent to apply to the output.
-    """
-
-    lst_instances = _get_lst_instances()
+LIST_COLUMNS = ("InstanceId", "InstanceType", "State", "PublicIpAddress", "user", "project", "LaunchTime", "ImageId")
 
-    if lst_instances is None:
-        print("No instance to display.")
-        return
 
-    lst_instances = [i for i in lst_instances.iterator()]
+def _instance_filters(user: str = None, project: str = None, states=None) -> list:
+    filters = []
+    if user is not None:
+        filters.append({"Name": "tag:user", "Values": [user]})
+    if project is not None:
+        filters.append({"Name": "tag:project", "Values": [project]})
+    if states:
+        filters.append({"Name": "instance-state-name", "Values": list(states)})
+    return filters
 
-    for i, instance in enumerate(lst_instances):
-        instance.load()
-        print(f"Instance number {i}:")
-        _display(instance, indent=indent)
 
-    return lst_instances
+def _instance_row(inst: dict) -> dict:
+    tags = {t["Key"]: t["Value"] for t in inst.get("Tags", [])}
+    return {"InstanceId": inst["InstanceId"],
+            "InstanceType": inst.get("InstanceType"),
+            "State": inst["State"]["Name"],
+            "PublicIpAddress": inst.get("PublicIpAddress"),
+            "user": tags.get("user"),
+            "project": tags.get("project"),
+            "LaunchTime": inst["LaunchTime"].isoformat() if inst.get("LaunchTime") else None,
+            "ImageId": inst.get("ImageId")}
 
 
-def _get_lst_instances():
+def iter_instances(user: str = None,
+                   project: str = None,
+                   states=("pending", "running", "stopping", "stopped"),
+                   page_size: int = None,
+                   fresh: bool = False,
+                   allow_stale: bool = True):
+    """
+    Yields the DescribeInstances records matching the `user` and `project` tags
+    and the instance `states`, page by page. Filtering is done by EC2, one call
+    per page. Results come from the describe cache unless `fresh`.
+    """
     try:
-        svc = AwsService.from_service("ec2")
-        lst_instances = svc.resource.instances
+        yield from describe_cache.describe_instances(_instance_filters(user, project, states),
+                                                     fresh=fresh, allow_stale=allow_stale, page_size=page_size)
     except ClientError as err:
         print(err.response["Error"]["Code"], err.response["Error"]["Message"])
         raise
-    return lst_instances
+
+
+def list_instances(indent=1,
+                   user: str = None,
+                   project: str = None,
+                   states=("pending", "running", "stopping", "stopped"),
+                   output: str = "text",
+                   fresh: bool = False):
+    """
+    Displays the instances matching the `user` and `project` tags and the
+    instance `states`. Rows are printed as the pages arrive. Returns the rows.
+
+    :param indent: The visual indent to apply to the text output.
+    :param output: `text`, `json` (one JSON object per line) or `csv`.
+    :param fresh: bypass the describe cache.
+    """
+    ind = "\t" * indent
+    writer = None
+    rows = []
+    for inst in iter_instances(user=user, project=project, states=states, fresh=fresh):
+        row = _instance_row(inst)
+        if output == "json":
+            print(json.dumps(row), flush=True)
+        elif output == "csv":
+            if writer is None:
+                writer = csv.DictWriter(sys.stdout, fieldnames=LIST_COLUMNS)
+                writer.writeheader()
+            writer.writerow(row)
+            sys.stdout.flush()
+        else:
+            if not rows:
+                print(f"{ind}{'ID':<21}{'Type':<13}{'State':<10}{'Public IP':<16}{'User':<16}{'Project':<16}Launched")
+            print(f"{ind}{row['InstanceId']:<21}{row['InstanceType'] or '-':<13}{row['State']:<10}"
+                  f"{row['PublicIpAddress'] or '-':<16}{row['user'] or '-':<16}{row['project'] or '-':<16}"
+                  f"{row['LaunchTime'] or '-'}", flush=True)
+        rows.append(row)
+
+    if not rows and output == "text":
+        print("No instance to display.")
+    return rows
 
 
 def _display(instance, indent=1):
@@ -288,55 +504,105 @@ def _display(instance, indent=1):
 
 def terminate_instance(instance_id: str = None) -> None:
     """
-    Terminates an instance and waits for it to be in a terminated state.
+    Terminates an instance and removes its docker context and registration.
     """
 
-    filters = [{"Name": "instance-state-name", "Values": ["running"]}]
-
     if instance_id is None:
         return
-    else:
+    terminate_instances([instance_id])
+
+
+def _cleanup_instance(instance_id: str, ip: str, contexts: dict, registered: dict, CONFIG_DIR='.dev_machine'):
+    # stopped instances have no public ip: their record gives the context
+    entry = registered.get(instance_id)
+    ctx_name = contexts.get(ip) if ip else None
+    if ctx_name is None and entry is not None:
+        ctx_name = entry["context"]
+    if ctx_name is not None:
+        print(f"Context associated with instance {instance_id} found. Removing context")
         try:
-            lst_instances = _get_lst_instances()
-            instances = lst_instances.filter(Filters=filters)
-            if instances is None:
-                print("No instance to terminate.")
-                return
-            for inst in instances:
-                if inst.id == instance_id:
-                    print(f"Found running instance {instance_id}")
-                    instance = inst
-                    instance_id = instance.id
-                    _remove_instance(instance_id, instance)
-                    return
-            print(f"Instance {instance_id} not found. Instance not terminated.")
-            return
+            remove_docker_context(ctx_name)
+        except Exception as e:
+            print(f"Could not remove context {ctx_name}: {e}")
+    if entry is not None:
+        deregister_instance(entry["name"], entry["ip"], CONFIG_DIR=CONFIG_DIR)
+    elif ctx_name is not None:
+        deregister_instance(ctx_name, ip, CONFIG_DIR=CONFIG_DIR)
+    print(f"Instance {instance_id} successfully terminated.")
+
+
+def terminate_instances(instance_ids: list = None,
+                        user: str = None,
+                        project: str = None,
+                        wait: bool = False,
+                        max_workers: int = 16,
+                        fresh: bool = False,
+                        CONFIG_DIR='.dev_machine') -> list:
+    """
+    Terminates the instances `instance_ids`, or the instances matching the
+    `user` and `project` tags, with one TerminateInstances request. Their
+    docker contexts and registrations are then removed concurrently. They are
+    found by public IP, or by instance id in the state store for stopped
+    instances.
+
+    Args:
+        instance_ids: ids of the instances to terminate.
+        user: with no `instance_ids`, terminate the instances of this user.
+        project: with no `instance_ids`, terminate the instances of this project.
+        wait: wait until every instance is terminated.
+        fresh: bypass the describe cache. Stale cached results are never used.
+
+    Returns:
+        The ids of the terminated instances.
+    """
+    states = ("pending", "running", "stopping", "stopped")
+    if instance_ids:
+        # filtering on instance-id does not fail on unknown or malformed ids
+        filters = [{"Name": "instance-id", "Values": list(instance_ids)},
+                   {"Name": "instance-state-name", "Values": list(states)}]
+        found = list(describe_cache.describe_instances(filters, fresh=fresh, allow_stale=False))
+    elif user is not None or project is not None:
+        found = list(iter_instances(user=user, project=project, states=states, fresh=fresh, allow_stale=False))
+    else:
+        return []
+
+    found_ids = [inst["InstanceId"] for inst in found]
+    if not found_ids and not instance_ids:
+        print("No instance to terminate.")
+        return []
 
+    svc = AwsService.from_service("ec2")
+    if found_ids:
+        print(f"Terminating instances {found_ids}...")
+        try:
+            for i in range(0, len(found_ids), 1000):
+                svc.client.terminate_instances(InstanceIds=found_ids[i:i + 1000])
+            describe_cache.invalidate()
         except ClientError as err:
             print(
-                "Couldn't load instance %s. Here's why: %s: %s",
-                instance_id,
+                "Couldn't terminate instances %s. Here's why: %s: %s" % (
+                found_ids,
                 err.response["Error"]["Code"],
-                err.response["Error"]["Message"],
+                err.response["Error"]["Message"]),
             )
-            return
-
-
-def _remove_instance(instance_id, instance):
-    try:
-        print(f"Terminating instance {instance_id}...")
-        ip = instance.public_ip_address
-        ctx_name = find_context_name_from_instance_ip(ip)
-        instance.terminate()
+            return []
 
-        print(f"Context associated with instance {instance_id} found. Removing context")
-        if ctx_name is not None:
-            remove_docker_context(ctx_name)
+        contexts = {ip: name for name, ip in list_host_ip_for_all_contexts()}
+        store = StateStore(CONFIG_DIR)
+        try:
+            registered = store.by_instance_ids(found_ids)
+        finally:
+            store.close()
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            list(pool.map(lambda inst: _cleanup_instance(inst["InstanceId"], inst.get("PublicIpAddress"), contexts,
+                                                         registered, CONFIG_DIR=CONFIG_DIR),
+                          found))
+
+    for instance_id in instance_ids or []:
+        if instance_id not in found_ids:
+            print(f"Instance {instance_id} not found. Instance not terminated.")
 
-        #instance.wait_until_terminated(instance_id)
-        instance = None
-        deregister_instance(ctx_name, ip)
-        print(f"Instance {instance_id} successfully terminated.")
-    except ClientError as err:
-        raise err
-    
\ No newline at end of file
+    if wait and found_ids:
+        print(f"Waiting for {len(found_ids)} instances to terminate...")
+        svc.client.get_waiter("instance_terminated").wait(InstanceIds=found_ids)
+    return found_ids
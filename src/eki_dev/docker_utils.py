@@ -1,73 +1,248 @@
 import base64
 
+from eki_dev import tracing
 from eki_dev.utils import ssh_splitter
 from eki_dev.aws_service import AwsService
+from eki_dev.credential_cache import CredentialCache
 
+import os
 import time
 import re
-import subprocess
+import queue
+import threading
+import contextlib
+from collections import namedtuple
+
 import docker
+from docker.context.config import get_meta_dir
 import logging
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.WARNING)
 
 
-def login_into_ecr(registry):
-    """returns an authenticated docker client for ECR"""
-    print("Retrieving ECR credentials")
-    token = AwsService.from_service('ecr').get_ecr_authorization()
+def _parse_ecr_registry(registry: str) -> tuple:
+    """returns (account_id, region) from an `ACCOUNT.dkr.ecr.REGION.amazonaws.com` registry"""
+    host = registry.replace("https://", "").split("/")[0]
+    parts = host.split(".")
+    return parts[0], parts[3]
+
+
+def get_ecr_credentials(registry: str, CONFIG_DIR='.dev_machine') -> dict:
+    """
+    Returns the cached ECR token entry ({"token", "expires_at", "verified"}) for
+    `registry`, fetching a new token from ECR when the cached one is missing or
+    close to expiry.
+    """
+    account_id, region = _parse_ecr_registry(registry)
+    cache = CredentialCache(CONFIG_DIR=CONFIG_DIR)
+    entry = cache.get_ecr_token(account_id, region)
+    if entry is not None:
+        return entry
+
+    with cache.lock(exclusive=True):
+        # another process may have refreshed the token while we waited for the lock
+        entry = cache.get_ecr_token(account_id, region, locked=True)
+        if entry is None:
+            print("Retrieving ECR credentials")
+            ecr = AwsService.from_service('ecr', region=region)
+            auth = ecr.client.get_authorization_token()["authorizationData"][0]
+            entry = cache.put_ecr_token(account_id, region,
+                                        token=auth["authorizationToken"],
+                                        expires_at=auth["expiresAt"].timestamp(),
+                                        locked=True)
+    return entry
+
+
+def ecr_auth_config(registry: str, CONFIG_DIR='.dev_machine') -> dict:
+    """returns the docker `auth_config` for `registry`"""
+    token = get_ecr_credentials(registry, CONFIG_DIR=CONFIG_DIR)["token"]
     username, password = base64.b64decode(token).decode('utf-8').split(':')
+    return {"username": username, "password": password}
 
-    docker_client = None
-    for i in range(500):
-        print("Creating docker client for ECR, attempt {}".format(i+1))
-        try:
-            docker_client = docker.from_env()
-            break
 
-        except docker.errors.DockerException as e:
-            time.sleep(2)
-            continue
-    if not docker_client:
-        raise Exception("Unable to create docker client for ECR")
+def login_into_ecr(registry, CONFIG_DIR='.dev_machine', docker_client=None):
+    """returns an authenticated docker client for ECR.
 
+    A cached token that already passed a `docker login` is reused without
+    logging in again; pass `ecr_auth_config(registry)` as `auth_config` to
+    pulls instead. Without `docker_client` a client is created from the
+    environment.
+    """
+    entry = get_ecr_credentials(registry, CONFIG_DIR=CONFIG_DIR)
+    username, password = base64.b64decode(entry["token"]).decode('utf-8').split(':')
+
+    if docker_client is None:
+        for i in range(500):
+            print("Creating docker client for ECR, attempt {}".format(i+1))
+            try:
+                docker_client = docker.from_env()
+                break
 
+            except docker.errors.DockerException as e:
+                time.sleep(2)
+                continue
+    if not docker_client:
+        raise Exception("Unable to create docker client for ECR")
 
-    print("Logging into {}".format(registry))
     registry = registry.replace("https://", "")
-    for i in range(3):
-        print("{} attempt to log into ECR".format(i+1))
-        try:
-            ret = docker_client.login(username='AWS', password=password, registry=registry, reauth=True)
-            if ret['Status'] == 'Login Succeeded':
-                logger.info("Login succeeded")
-                break
-            time.sleep(1)
-        except docker.errors.APIError as e:
-            continue
+    with tracing.span("docker login", registry=registry, cached=entry["verified"]) as span:
+        if entry["verified"]:
+            logger.info("Using cached ECR credentials for {}".format(registry))
+            return docker_client
+
+        print("Logging into {}".format(registry))
+        for i in range(3):
+            print("{} attempt to log into ECR".format(i+1))
+            span.attempts = i + 1
+            try:
+                ret = docker_client.login(username='AWS', password=password, registry=registry, reauth=True)
+                if ret['Status'] == 'Login Succeeded':
+                    logger.info("Login succeeded")
+                    account_id, region = _parse_ecr_registry(registry)
+                    CredentialCache(CONFIG_DIR=CONFIG_DIR).mark_ecr_token_verified(account_id, region, entry["token"])
+                    break
+                time.sleep(1)
+            except docker.errors.APIError as e:
+                continue
+        else:
+            span.finish("error", "login did not succeed")
 
 
     return docker_client
 
 
+class ContextInfo(namedtuple("ContextInfo", ["Name", "Host"])):
+    """Name and host of a docker context, as kept in the ContextIndex"""
+
+    @property
+    def ip(self) -> str:
+        _, host_ip, _ = ssh_splitter(self.Host or "")
+        return host_ip
+
+
+class ContextIndex:
+    """
+    In-process index of the docker contexts: name -> host and ip -> name.
+
+    The index is built from `docker.ContextAPI.contexts()` on first use and
+    kept up to date by `create_docker_context` and `remove_docker_context`.
+    It is rebuilt when the mtime of docker's contexts meta directory changes,
+    that is when another process adds or removes a context.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._contexts = {}
+        self._by_ip = {}
+        self._mtime = None
+        self._built = False
+
+    @staticmethod
+    def _meta_mtime():
+        try:
+            return os.stat(get_meta_dir()).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _rebuild(self):
+        self._contexts = {}
+        self._by_ip = {}
+        mtime = self._meta_mtime()
+        for ctx in list_docker_context():
+            self._add(ctx.Name, ctx.Host)
+        self._mtime = mtime
+        self._built = True
+
+    def _ensure_fresh(self):
+        if not self._built or self._meta_mtime() != self._mtime:
+            self._rebuild()
+
+    def _add(self, name: str, host: str):
+        info = ContextInfo(name, host)
+        self._contexts[name] = info
+        if info.ip:
+            self._by_ip.setdefault(info.ip, name)
+
+    def _remove(self, name: str):
+        info = self._contexts.pop(name, None)
+        if info is not None and self._by_ip.get(info.ip) == name:
+            del self._by_ip[info.ip]
+            # another context may point to the same ip
+            for other in self._contexts.values():
+                if other.ip == info.ip:
+                    self._by_ip[info.ip] = other.Name
+                    break
+
+    @contextlib.contextmanager
+    def updating(self):
+        """
+        Holds the index while the caller changes docker contexts and records
+        the changes with `add` and `remove`; the directory mtime is then
+        recorded so this process's own changes do not trigger a rebuild.
+        """
+        with self._lock:
+            self._ensure_fresh()
+            try:
+                yield self
+            finally:
+                self._mtime = self._meta_mtime()
+
+    def add(self, name: str, host: str):
+        with self._lock:
+            self._add(name, host)
+
+    def remove(self, name: str):
+        with self._lock:
+            self._remove(name)
+
+    def contexts(self) -> list:
+        with self._lock:
+            self._ensure_fresh()
+            return list(self._contexts.values())
+
+    def get(self, name: str) -> ContextInfo:
+        with self._lock:
+            self._ensure_fresh()
+            return self._contexts.get(name)
+
+    def name_for_ip(self, ip: str) -> str:
+        with self._lock:
+            self._ensure_fresh()
+            return self._by_ip.get(ip)
+
+    def invalidate(self):
+        with self._lock:
+            self._built = False
+
+
+_CONTEXT_INDEX = ContextIndex()
+
+
+def get_context_index() -> ContextIndex:
+    """returns the process-wide ContextIndex"""
+    return _CONTEXT_INDEX
+
+
 def create_docker_context(instance_name: str,
                           host: str,
                           port: int = 22,
                           user_name: str = 'ubuntu'):
     host = "ssh://" + user_name + "@" + host + f":{port}"
     print(f"Creating docker context for {host}")
-    try:
-        ret = docker.ContextAPI.create_context(name=instance_name,
-                                               orchestrator='docker',
-                                               host=host)
-    except docker.errors.ContextAlreadyExists as err:
-        print("Context name already exists")
-        print(err)
-        raise err
-    except docker.errors.ContextException as err:
-        print(err)
-        raise err
+    with _CONTEXT_INDEX.updating() as index:
+        try:
+            ret = docker.ContextAPI.create_context(name=instance_name,
+                                                   orchestrator='docker',
+                                                   host=host)
+        except docker.errors.ContextAlreadyExists as err:
+            print("Context name already exists")
+            print(err)
+            raise err
+        except docker.errors.ContextException as err:
+            print(err)
+            raise err
+        index.add(instance_name, host)
 
     return ret
 
@@ -90,92 +265,119 @@ def inspect_docker_context(name: str) -> dict:
         print(err)
 
 
-def remove_docker_context(name: str) -> docker.Context:
-    try:
-        docker.ContextAPI.remove_context(name)
-        print("Context with name {} removed".format(name))
+def remove_docker_context(name: str) -> list:
+    """Removes context `name`. Returns the remaining contexts as ContextInfo"""
+    with _CONTEXT_INDEX.updating() as index:
+        try:
+            docker.ContextAPI.remove_context(name)
+            print("Context with name {} removed".format(name))
 
-    except docker.errors.ContextNotFound as err:
-        print("Context with name {} does not exist".format(name))
-        print(err)
+        except docker.errors.ContextNotFound as err:
+            print("Context with name {} does not exist".format(name))
+            print(err)
+        index.remove(name)
 
-    return list_docker_context()
+    return _CONTEXT_INDEX.contexts()
 
 
 def find_context_name_from_instance_ip(ip: str) -> str:
 
-    for ctx in list_docker_context():
-
-        host = ctx.Host
-        _, host_ip, _ = ssh_splitter(host)
-        if host_ip == ip:
-            return ctx.Name
-
-    print("Could not find context name from ip")
-    return None
+    name = _CONTEXT_INDEX.name_for_ip(ip)
+    if name is None:
+        print("Could not find context name from ip")
+    return name
 
 
 def list_host_ip_for_all_contexts() -> list:
 
-    lst_ip = []
-    for ctx in list_docker_context():
-        host = ctx.Host
-        _, host_ip, _ = ssh_splitter(host)
-        lst_ip.append((ctx.Name,host_ip))
-    return lst_ip
+    return [(ctx.Name, ctx.ip) for ctx in _CONTEXT_INDEX.contexts()]
 
 
 def check_docker_context_does_not_exist(name: str) -> bool:
     """Returns True if context with `name` does not exist, otherwise raise
     docker.error.ContextAlreadyExists exception."""
 
-    for ctx in list_docker_context():
-        if ctx.name == name:
-            raise docker.errors.ContextAlreadyExists(name)
+    if _CONTEXT_INDEX.get(name) is not None:
+        raise docker.errors.ContextAlreadyExists(name)
 
     return True
 
 
-def _check_docker_installed(user: str, host: str):
+def _close_log_stream(stream):
     """
-    Returns True if docker is installed. The function ssh into the host machine,
-    calls docker --version, and parses stderr
-    Args:
-        user: Username to log into host
-        host: IP address of host
-
-    Returns: True if docker is installed in host machine, False otherwise.
-
+    Closes a log stream. docker-py cannot cancel streams over ssh
+    (`CancellableStream.close` raises), their reader stops at the next chunk
+    or when the container stops.
     """
-
-    ps = subprocess.Popen(f"ssh -o StrictHostKeyChecking=accept-new {user}@{host} docker --version",
-                                           shell=True,
-                                            stdout=subprocess.PIPE,
-                                            stderr=subprocess.PIPE)
-    ps.wait()
-    stdout, stderr = ps.communicate()
-    if ps.returncode == 0:
-        print(f"{str(stdout)} is running")
-        return True
-    else:
-        print("Waiting for docker...")
-        time.sleep(5)
-        return False
+    with contextlib.suppress(docker.errors.DockerException, OSError):
+        if hasattr(stream, "close"):
+            stream.close()
 
 
-def wait_for_token(container):
-    max_attempts = 10  # Maximum number of attempts to check logs
-    attempt = 0
+def wait_for_log_pattern(container, pattern: str, timeout: float = 60):
+    """
+    Follows the logs of `container` and returns as soon as a line matches
+    `pattern`.
 
-    while attempt < max_attempts:
-        logs = container.logs().decode('utf-8')
-        match = re.search(r'\?token=([a-f0-9]+)', logs)
+    The logs are streamed once and matched line by line as they arrive, so the
+    cost is linear in the log size and the match is seen when it is written.
+    The stream is read on its own thread: docker-py sends followed logs without
+    a socket timeout, so the deadline is enforced by the waiting side.
 
-        if match:
-            token = match.group(1)
-            return token
+    Args:
+        container: docker Container.
+        pattern: regular expression searched in each log line.
+        timeout: seconds to wait for the pattern.
 
-        attempt += 1
-        time.sleep(5)  # Wait for 1 second before checking logs again
+    Returns:
+        The re.Match, or None if the pattern did not appear before the timeout
+        or before the container stopped.
+    """
+    regex = re.compile(pattern)
+    stream = container.logs(stream=True, follow=True)
+    chunks = queue.Queue()
+    done = threading.Event()
 
+    def read():
+        try:
+            for chunk in stream:
+                if done.is_set():
+                    break
+                chunks.put(chunk)
+        except Exception as e:
+            chunks.put(e)
+        finally:
+            chunks.put(None)
+
+    threading.Thread(target=read, name="log-reader", daemon=True).start()
+    deadline = time.monotonic() + timeout
+    pending = ""
+    try:
+        while True:
+            try:
+                chunk = chunks.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                logger.debug(f"{pattern} not found in the logs after {timeout}s")
+                return None
+            if chunk is None:
+                return regex.search(pending)
+            if isinstance(chunk, Exception):
+                raise chunk
+            pending += chunk.decode('utf-8', errors='replace')
+            *lines, pending = pending.split("\n")
+            for line in lines:
+                match = regex.search(line)
+                if match:
+                    return match
+    finally:
+        # unblocks the reader thread, or makes it stop at the next chunk
+        done.set()
+        _close_log_stream(stream)
+
+
+def wait_for_token(container, timeout: float = 60):
+    """returns the Jupyter token printed by `container`, or None if it does not appear within `timeout` seconds"""
+    match = wait_for_log_pattern(container, r'\?token=([a-f0-9]+)', timeout=timeout)
+    if match:
+        return match.group(1)
     return None
@@ -0,0 +1,195 @@
+from eki_dev.aws_service import AwsService
+from eki_dev.docker_utils import login_into_ecr, ecr_auth_config
+from eki_dev.pull_progress import pull_image
+from eki_dev.readiness import wait_until_ready, default_probes
+from eki_dev.ssh_transport import get_docker_client, run_command
+from eki_dev.utils import run_edamame_in_background
+
+# Cache snapshots hold an ext4 file system labelled LABEL with the content of
+# /var/lib/docker after pulling an image. They are tagged with the image
+# (`repo:tag`) and the digest it had in ECR when the snapshot was taken.
+IMAGE_TAG = "edamame:image-cache"
+DIGEST_TAG = "edamame:image-digest"
+LABEL = "edamame-docker"
+DEVICE = "/dev/sdf"
+
+# Mounts the cache volume on /var/lib/docker. Docker is stopped around the
+# mount when it is already installed (baked AMI) and installs on top of the
+# mounted volume otherwise.
+MOUNT_SCRIPT = f"""if [ -e /dev/disk/by-label/{LABEL} ]; then
+  sudo systemctl stop docker.socket docker 2>/dev/null || true
+  sudo mkdir -p /var/lib/docker
+  echo 'LABEL={LABEL} /var/lib/docker ext4 defaults,nofail 0 2' | sudo tee -a /etc/fstab > /dev/null
+  sudo mount -a
+  sudo systemctl start docker 2>/dev/null || true
+fi
+"""
+
+
+def image_digest(container: str) -> str:
+    """returns the digest `container` (`repo:tag`) currently points to in ECR"""
+    repository, tag = container.split(':')
+    ecr = AwsService.from_service("ecr").client
+    resp = ecr.describe_images(repositoryName=repository, imageIds=[{"imageTag": tag}])
+    return resp["imageDetails"][0]["imageDigest"]
+
+
+def list_cache_snapshots(container: str) -> list:
+    """returns the completed cache snapshots of `container`, newest first"""
+    ec2 = AwsService.from_service("ec2").client
+    paginator = ec2.get_paginator("describe_snapshots")
+    snapshots = [snap
+                 for page in paginator.paginate(OwnerIds=["self"],
+                                                Filters=[{"Name": f"tag:{IMAGE_TAG}", "Values": [container]},
+                                                         {"Name": "status", "Values": ["completed"]}])
+                 for snap in page["Snapshots"]]
+    return sorted(snapshots, key=lambda s: s["StartTime"], reverse=True)
+
+
+def _snapshot_digest(snapshot: dict) -> str:
+    return next((t["Value"] for t in snapshot.get("Tags", []) if t["Key"] == DIGEST_TAG), None)
+
+
+def lookup_image_cache(container: str) -> dict:
+    """
+    Finds the cache snapshot to launch `container` instances with.
+
+    Returns:
+        {"container", "digest": current ECR digest, "snapshot_id": newest
+        snapshot or None, "current": whether that snapshot holds the current
+        digest}. A stale snapshot is still used, most layers are usually
+        unchanged and only the new ones are pulled.
+    """
+    digest = image_digest(container)
+    snapshots = list_cache_snapshots(container)
+    snapshot = snapshots[0] if snapshots else None
+    return {"container": container,
+            "digest": digest,
+            "snapshot_id": snapshot["SnapshotId"] if snapshot else None,
+            "current": snapshot is not None and _snapshot_digest(snapshot) == digest}
+
+
+def with_image_cache(cache: dict, volume_type: str = "gp3", **instance_params) -> dict:
+    """
+    returns `instance_params` with a volume restored from the cache snapshot
+    and the UserData mounting it on /var/lib/docker. Unchanged if there is no
+    snapshot.
+    """
+    if cache is None or cache["snapshot_id"] is None:
+        return instance_params
+
+    instance_params = dict(instance_params)
+    instance_params["BlockDeviceMappings"] = list(instance_params.get("BlockDeviceMappings", [])) + [
+        {"DeviceName": DEVICE,
+         "Ebs": {"SnapshotId": cache["snapshot_id"], "VolumeType": volume_type, "DeleteOnTermination": True}}]
+    shebang, _, script = (instance_params.get("UserData") or "#!/bin/sh\n").partition("\n")
+    instance_params["UserData"] = f"{shebang}\n{MOUNT_SCRIPT}{script}"
+    return instance_params
+
+
+def image_is_current(docker_client, repository: str, tag: str, digest: str) -> bool:
+    """True if the daemon already has `repository:tag` at `digest`, so the pull can be skipped"""
+    try:
+        image = docker_client.images.get(f"{repository}:{tag}")
+    except Exception:
+        return False
+    return f"{repository}@{digest}" in image.attrs.get("RepoDigests", [])
+
+
+def _format_script(volume_id: str) -> str:
+    # nitro instances expose EBS volumes as nvme devices named after the volume id
+    nvme = f"/dev/disk/by-id/nvme-Amazon_Elastic_Block_Store_{volume_id.replace('-', '')}"
+    return (f"DEV={nvme}; [ -e $DEV ] || DEV=/dev/xvd{DEVICE[-1]}\n"
+            f"sudo mkfs.ext4 -q -L {LABEL} $(readlink -f $DEV)\n"
+            f"sudo udevadm settle\n" + MOUNT_SCRIPT)
+
+
+def build_cache_snapshot(container: str,
+                         volume_size: int = 30,
+                         volume_type: str = "gp3",
+                         fast_restore_zones: list = (),
+                         keep: int = 2,
+                         user: str = "ubuntu",
+                         readiness_deadline: float = 1800,
+                         **instance_params) -> str:
+    """
+    Takes a new cache snapshot of `container`: launches a builder with a blank
+    volume mounted on /var/lib/docker, pulls the image into it and snapshots
+    the volume. Fast snapshot restore is enabled in `fast_restore_zones` and
+    only the `keep` newest snapshots of the image are kept. The builder is
+    always terminated.
+
+    Returns:
+        The new snapshot id.
+    """
+    svc = AwsService.from_service("ec2")
+    digest = image_digest(container)
+    registry = f"{svc.get_account_id()}.dkr.ecr.{svc.get_region()}.amazonaws.com"
+    c_name, c_tag = container.split(':')
+
+    instance_params = dict(instance_params)
+    instance_params["IamInstanceProfile"] = {"Name": "AccessECR"}
+    instance_params["BlockDeviceMappings"] = list(instance_params.get("BlockDeviceMappings", [])) + [
+        {"DeviceName": DEVICE,
+         "Ebs": {"VolumeSize": volume_size, "VolumeType": volume_type, "DeleteOnTermination": True}}]
+    instance_params["TagSpecifications"] = [{"ResourceType": "instance",
+                                             "Tags": [{"Key": "Name", "Value": f"{container}-cache-builder"}]}]
+
+    print(f"Launching image cache builder for {container} ({digest})")
+    instance = svc.resource.create_instances(**instance_params, MinCount=1, MaxCount=1)[0]
+    try:
+        instance.wait_until_running()
+        instance.reload()
+        host = instance.public_ip_address
+        volume_id = next(m["Ebs"]["VolumeId"] for m in instance.block_device_mappings if m["DeviceName"] == DEVICE)
+        wait_until_ready(default_probes(user, host), deadline=readiness_deadline).display()
+        run_command(user, host, _format_script(volume_id), timeout=300)
+
+        docker_client = login_into_ecr(registry, docker_client=get_docker_client(user, host))
+        print(f"Pulling {registry}/{container} into the cache volume")
+        pull_image(docker_client, f"{registry}/{c_name}", c_tag, auth_config=ecr_auth_config(registry), mode="quiet")
+        run_command(user, host, "sudo systemctl stop docker.socket docker && sync && sudo umount /var/lib/docker",
+                    timeout=300)
+
+        snapshot_id = svc.client.create_snapshot(
+            VolumeId=volume_id,
+            Description=f"EDAMAME image cache {container} {digest}",
+            TagSpecifications=[{"ResourceType": "snapshot",
+                                "Tags": [{"Key": IMAGE_TAG, "Value": container},
+                                         {"Key": DIGEST_TAG, "Value": digest}]}],
+        )["SnapshotId"]
+        svc.client.get_waiter("snapshot_completed").wait(SnapshotIds=[snapshot_id])
+    finally:
+        print(f"Terminating image cache builder {instance.id}")
+        instance.terminate()
+
+    if fast_restore_zones:
+        svc.client.enable_fast_snapshot_restores(AvailabilityZones=list(fast_restore_zones),
+                                                 SourceSnapshotIds=[snapshot_id])
+    older = [s for s in list_cache_snapshots(container) if s["SnapshotId"] != snapshot_id]
+    for old in older[max(keep - 1, 0):]:
+        print(f"Deleting cache snapshot {old['SnapshotId']}")
+        svc.client.delete_snapshot(SnapshotId=old["SnapshotId"])
+
+    print(f"Cache snapshot {snapshot_id} of {container} is available")
+    return snapshot_id
+
+
+def refresh_cache_snapshot(container: str, force: bool = False, **kwargs) -> str:
+    """Builds a new cache snapshot if the newest one does not hold the current digest. Returns its id"""
+    cache = lookup_image_cache(container)
+    if cache["current"] and not force:
+        print(f"Cache snapshot {cache['snapshot_id']} of {container} is up to date")
+        return cache["snapshot_id"]
+    return build_cache_snapshot(container, **kwargs)
+
+
+def refresh_in_background(container: str, profile: str = None, CONFIG_DIR='.dev_machine'):
+    """
+    Starts `edamame image-cache refresh` as a detached process with the
+    configuration `profile`. Output goes to ~/CONFIG_DIR/image_cache.log
+    """
+    proc = run_edamame_in_background(["image-cache", "refresh", "--container", container],
+                                     "image_cache.log", profile=profile, CONFIG_DIR=CONFIG_DIR)
+    print(f"Refreshing the {container} image cache in the background (pid {proc.pid})")
+    return proc
@@ -0,0 +1,66 @@
+import os
+import json
+import fcntl
+import tempfile
+import contextlib
+from pathlib import Path
+
+
+class LockedJsonFile:
+    """
+    JSON document in ~/CONFIG_DIR, readable only by the owner, that several
+    edamame processes can use at the same time: reads take a shared lock and
+    updates an exclusive lock on a sibling lock file, and the document is
+    replaced atomically.
+
+    Args:
+        file_name: name of the JSON file.
+        CONFIG_DIR: configuration folder, relative to the home directory.
+        encode: `default` of json.dump, for the values JSON cannot represent.
+        decode: `object_hook` of json.load, the reverse of `encode`.
+    """
+
+    def __init__(self, file_name: str, CONFIG_DIR='.dev_machine', encode=None, decode=None):
+        self.dir = os.path.join(os.path.expanduser("~"), CONFIG_DIR)
+        self.path = os.path.join(self.dir, file_name)
+        self.encode = encode
+        self.decode = decode
+
+    @contextlib.contextmanager
+    def lock(self, exclusive: bool = False):
+        """Holds an advisory lock on the file for the duration of the block"""
+        Path(self.dir).mkdir(parents=False, exist_ok=True, mode=0o700)
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def read(self) -> dict:
+        """returns the document, empty if missing or corrupt. The caller holds the lock"""
+        try:
+            with open(self.path, "r", encoding='utf8') as f:
+                return json.load(f, object_hook=self.decode)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def write(self, data: dict):
+        """replaces the document by `data`. The caller holds the exclusive lock"""
+        name = os.path.splitext(os.path.basename(self.path))[0]
+        fd, tmp = tempfile.mkstemp(dir=self.dir, prefix=f".{name}.")
+        try:
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, "w", encoding='utf8') as f:
+                json.dump(data, f, default=self.encode)
+            os.replace(tmp, self.path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp)
+            raise
+
+    def remove(self):
+        with self.lock(exclusive=True):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
@@ -0,0 +1,126 @@
+import time
+
+from botocore.exceptions import ClientError
+
+from eki_dev.json_file import LockedJsonFile
+
+# errors after which another instance type or availability zone may succeed
+CAPACITY_ERRORS = ("InsufficientInstanceCapacity", "Unsupported")
+
+
+def subnet_of(instance_params: dict) -> str:
+    """returns the subnet id of the RunInstances parameters, from the first network interface if any"""
+    interfaces = instance_params.get("NetworkInterfaces")
+    if interfaces:
+        return interfaces[0].get("SubnetId")
+    return instance_params.get("SubnetId")
+
+
+def with_candidate(instance_type: str, subnet_id: str, **instance_params) -> dict:
+    """returns a copy of the RunInstances parameters launching `instance_type` in `subnet_id`"""
+    params = dict(instance_params, InstanceType=instance_type)
+    if subnet_id is None:
+        return params
+    if params.get("NetworkInterfaces"):
+        interfaces = [dict(i) for i in params["NetworkInterfaces"]]
+        interfaces[0]["SubnetId"] = subnet_id
+        params["NetworkInterfaces"] = interfaces
+    else:
+        params["SubnetId"] = subnet_id
+    return params
+
+
+class LaunchHistory:
+    """
+    Combination of instance type and subnet that last launched successfully,
+    per region and list of acceptable instance types, kept in
+    ~/CONFIG_DIR/launch_fallback.json so later launches try it first.
+    """
+
+    FILE_NAME = "launch_fallback.json"
+
+    def __init__(self, CONFIG_DIR='.dev_machine'):
+        self.file = LockedJsonFile(self.FILE_NAME, CONFIG_DIR=CONFIG_DIR)
+
+    @staticmethod
+    def key(region: str, instance_types: list) -> str:
+        return f"{region}:{','.join(instance_types)}"
+
+    def last_success(self, region: str, instance_types: list) -> tuple:
+        """returns the (instance type, subnet id) that last launched, or None"""
+        with self.file.lock():
+            entry = self.file.read().get(self.key(region, instance_types))
+        return None if entry is None else (entry["InstanceType"], entry["SubnetId"])
+
+    def record_success(self, region: str, instance_types: list, instance_type: str, subnet_id: str):
+        with self.file.lock(exclusive=True):
+            data = self.file.read()
+            data[self.key(region, instance_types)] = {"InstanceType": instance_type, "SubnetId": subnet_id,
+                                                      "launched_at": time.time()}
+            self.file.write(data)
+
+
+def _unique(items) -> list:
+    return list(dict.fromkeys(i for i in items if i))
+
+
+def launch_candidates(instance_types: list, subnet_ids: list, preferred: tuple = None) -> list:
+    """
+    returns the (instance type, subnet id) combinations to try, in order: the
+    `preferred` one first, then every subnet of the first instance type, then
+    every subnet of the second, ... A capacity shortage is usually limited to
+    one availability zone, so another subnet is tried before another type.
+    """
+    candidates = [(t, s) for t in instance_types for s in (subnet_ids or [None])]
+    if preferred in candidates:
+        candidates.remove(preferred)
+        candidates.insert(0, preferred)
+    return candidates
+
+
+def launch_with_fallback(launch,
+                         region: str,
+                         instance_types: list = (),
+                         subnet_ids: list = (),
+                         CONFIG_DIR='.dev_machine',
+                         **instance_params):
+    """
+    Calls `launch(**params)` for each acceptable combination of instance type
+    and subnet until one is not refused for lack of capacity, and records it.
+
+    The requested `InstanceType` and subnet are acceptable first, followed by
+    `instance_types` and `subnet_ids`. A combination that succeeded before is
+    tried first.
+
+    Args:
+        launch: callable sending the RunInstances request with the given parameters.
+        region: region of the launch, part of the history key.
+        instance_types: other acceptable instance types, in order of preference.
+        subnet_ids: other acceptable subnets, e.g. in other availability zones.
+        CONFIG_DIR: where the LaunchHistory is kept.
+        **instance_params: Parameters for creating the EC2 instances.
+
+    Returns:
+        The result of `launch`.
+
+    Raises:
+        ClientError: the error of the last combination if none has capacity, or
+            any error that is not a capacity shortage.
+    """
+    instance_types = _unique([instance_params["InstanceType"], *instance_types])
+    subnet_ids = _unique([subnet_of(instance_params), *subnet_ids])
+    history = LaunchHistory(CONFIG_DIR=CONFIG_DIR)
+    candidates = launch_candidates(instance_types, subnet_ids, history.last_success(region, instance_types))
+
+    for n, (instance_type, subnet_id) in enumerate(candidates):
+        try:
+            result = launch(**with_candidate(instance_type, subnet_id, **instance_params))
+        except ClientError as err:
+            code = err.response["Error"]["Code"]
+            if code not in CAPACITY_ERRORS or n == len(candidates) - 1:
+                raise
+            print(f"{code} for {instance_type} in {subnet_id}, trying {' in '.join(filter(None, candidates[n + 1]))}")
+            continue
+        if len(candidates) > 1:
+            history.record_success(region, instance_types, instance_type, subnet_id)
+        return result
@@ -0,0 +1,166 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from eki_dev import tracing
+
+
+class Phase:
+    """
+    A named step of a Pipeline.
+
+    Args:
+        name: phase name. Dependent phases receive this phase's result as a
+            keyword argument with this name.
+        func: callable run with the results of `deps` as keyword arguments.
+        deps: names of the phases that must complete before this one starts.
+    """
+
+    def __init__(self, name: str, func, deps=()):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.result = None
+        self.error = None
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self) -> float:
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+    @property
+    def status(self) -> str:
+        if self.error is not None:
+            return "failed"
+        if self.end is not None:
+            return "done"
+        if self.start is not None:
+            return "running"
+        return "skipped"
+
+    def __call__(self, **kwargs):
+        self.start = time.perf_counter()
+        try:
+            with tracing.span(f"phase {self.name}", deps=list(self.deps)):
+                self.result = self.func(**kwargs)
+        except BaseException as e:
+            self.error = e
+            raise
+        finally:
+            self.end = time.perf_counter()
+        return self.result
+
+
+class Pipeline:
+    """
+    Runs a dependency graph of phases, starting every phase as soon as the
+    phases it depends on are done, so independent phases run concurrently.
+
+    Phases must be added after their dependencies, which keeps the graph
+    acyclic. When a phase fails no new phase is started, the running ones are
+    waited for and the first exception is re-raised. On an interrupt the
+    running phases are waited for at most `interrupt_timeout` seconds, so that
+    what they create (e.g. an instance) is in their result for the cleanup.
+
+    Args:
+        name: pipeline name, used in the timing report.
+        max_workers: maximum number of phases running at the same time.
+        interrupt_timeout: seconds to wait for the running phases on an interrupt.
+    """
+
+    def __init__(self, name: str = "pipeline", max_workers: int = 8, interrupt_timeout: float = 30):
+        self.name = name
+        self.max_workers = max_workers
+        self.interrupt_timeout = interrupt_timeout
+        self.phases = {}
+        self.start = None
+        self.end = None
+
+    def add(self, name: str, func, deps=()) -> "Pipeline":
+        if name in self.phases:
+            raise ValueError(f"Phase {name} already exists")
+        missing = [d for d in deps if d not in self.phases]
+        if missing:
+            raise ValueError(f"Phase {name} depends on unknown phases {missing}")
+        self.phases[name] = Phase(name, func, deps)
+        return self
+
+    def results(self) -> dict:
+        return {name: phase.result for name, phase in self.phases.items()}
+
+    def run(self) -> dict:
+        """Runs every phase and returns {phase name: result}"""
+        with tracing.span(f"pipeline {self.name}"):
+            return self._run_phases()
+
+    def _run_phases(self) -> dict:
+        pending = dict(self.phases)
+        running = {}
+        done = set()
+        error = None
+        self.start = time.perf_counter()
+
+        pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+        try:
+            while pending or running:
+                if error is None:
+                    ready = [p for p in pending.values() if all(d in done for d in p.deps)]
+                    for phase in ready:
+                        kwargs = {d: self.phases[d].result for d in phase.deps}
+                        # the phase spans are children of the pipeline span
+                        running[pool.submit(tracing.run_in_context(phase), **kwargs)] = phase
+                        del pending[phase.name]
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    phase = running.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                    else:
+                        done.add(phase.name)
+        finally:
+            # every submitted phase has finished unless we are unwinding from
+            # an interrupt, in which case wait a bounded time for them
+            pool.shutdown(wait=False, cancel_futures=True)
+            if running:
+                names = ", ".join(p.name for p in running.values())
+                print(f"Interrupted, waiting up to {self.interrupt_timeout}s for the running phases: {names}")
+                wait(running, timeout=self.interrupt_timeout)
+            self.end = time.perf_counter()
+
+        if error is not None:
+            raise error
+        return self.results()
+
+    @property
+    def duration(self) -> float:
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+    def critical_path(self) -> list:
+        """returns the chain of phases that determined the pipeline end time"""
+        finished = [p for p in self.phases.values() if p.end is not None]
+        if not finished:
+            return []
+        path = [max(finished, key=lambda p: p.end)]
+        while path[-1].deps:
+            path.append(max((self.phases[d] for d in path[-1].deps), key=lambda p: p.end or 0))
+        return [p.name for p in reversed(path)]
+
+    def report(self, indent=1):
+        """prints the start offset and duration of each phase"""
+        ind = "\t" * indent
+        critical = set(self.critical_path())
+        print(f"{self.name} timing report ({self.duration or 0:.2f}s):")
+        print(f"{ind}{'phase':<24}{'start':>9}{'duration':>10}  status")
+        for phase in sorted(self.phases.values(), key=lambda p: (p.start is None, p.start or 0)):
+            start = "-" if phase.start is None else f"{phase.start - self.start:.2f}s"
+            duration = "-" if phase.duration is None else f"{phase.duration:.2f}s"
+            mark = " *" if phase.name in critical else ""
+            print(f"{ind}{phase.name:<24}{start:>9}{duration:>10}  {phase.status}{mark}")
+        print(f"{ind}* critical path")
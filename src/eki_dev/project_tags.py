@@ -0,0 +1,128 @@
+import time
+import threading
+
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError, BotoCoreError
+
+from eki_dev.aws_service import get_session, _pool_key
+from eki_dev.json_file import LockedJsonFile
+
+BUCKET = 'eki-dev-machine-config'
+KEY = 'project_tags.txt'
+
+
+class ProjectTagCache:
+    """
+    Local copy of the project tag list of S3 object `KEY`, with the object's ETag.
+
+    An entry younger than `max_age` is used without contacting S3. An older one
+    is revalidated with a conditional GET (`IfNoneMatch`): S3 answers 304 Not
+    Modified without a body when the list is unchanged. If S3 cannot be reached
+    within `timeout` seconds, the cached list is used whatever its age.
+
+    The cache is a LockedJsonFile in ~/CONFIG_DIR, shared by concurrent commands.
+
+    Args:
+        max_age: seconds between two revalidations.
+        timeout: connect and read timeout of the S3 requests, in seconds.
+    """
+
+    FILE_NAME = "project_tags.json"
+
+    def __init__(self, CONFIG_DIR='.dev_machine', max_age: float = 3600, timeout: float = 2):
+        self.file = LockedJsonFile(self.FILE_NAME, CONFIG_DIR=CONFIG_DIR)
+        self.max_age = max_age
+        self.timeout = timeout
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, bucket: str) -> dict:
+        """returns the cached entry ({"tags", "etag", "checked_at"}) of `bucket`, or None"""
+        with self.file.lock():
+            return self.file.read().get(bucket)
+
+    def put(self, bucket: str, tags: list, etag: str) -> dict:
+        entry = {"tags": tags, "etag": etag, "checked_at": time.time()}
+        with self.file.lock(exclusive=True):
+            data = self.file.read()
+            data[bucket] = entry
+            self.file.write(data)
+        return entry
+
+    def clear(self):
+        self.file.remove()
+
+    def _client(self):
+        # a dedicated client: the pooled one retries for a minute when S3 is unreachable
+        key = _pool_key()
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = get_session(*key).client(
+                    "s3", config=BotoConfig(connect_timeout=self.timeout, read_timeout=self.timeout,
+                                            retries={"max_attempts": 1}))
+            return self._clients[key]
+
+    def fetch(self, bucket: str, etag: str = None):
+        """
+        GETs the tag list, conditionally on `etag` if given. Returns (tags, etag),
+        or None if the object still has `etag`.
+        """
+        params = {"IfNoneMatch": etag} if etag else {}
+        try:
+            response = self._client().get_object(Bucket=bucket, Key=KEY, **params)
+        except ClientError as err:
+            if err.response["ResponseMetadata"].get("HTTPStatusCode") == 304:
+                return None
+            raise
+        tags = response['Body'].read().decode('utf8').strip().split(',')
+        return tags, response['ETag']
+
+    def tags(self, bucket: str = BUCKET, refresh: bool = False) -> tuple:
+        """
+        returns (tags, revalidated): the project tags of `bucket`, and whether S3
+        confirmed them during this call. `refresh` revalidates whatever the age.
+        """
+        entry = self.get(bucket)
+        if entry is not None and not refresh and time.time() - entry["checked_at"] < self.max_age:
+            return entry["tags"], False
+        try:
+            fetched = self.fetch(bucket, entry["etag"] if entry else None)
+        except (ClientError, BotoCoreError) as err:
+            if entry is None:
+                raise
+            print(f"Could not revalidate the project tags ({err}). Using the cached list")
+            return entry["tags"], False
+        if fetched is None:
+            entry = self.put(bucket, entry["tags"], entry["etag"])
+        else:
+            entry = self.put(bucket, *fetched)
+        return entry["tags"], True
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_cache() -> ProjectTagCache:
+    """returns the process-wide ProjectTagCache"""
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = ProjectTagCache()
+        return _CACHE
+
+
+def configure(**kwargs) -> ProjectTagCache:
+    """replaces the process-wide cache by ProjectTagCache(**kwargs)"""
+    global _CACHE
+    with _CACHE_LOCK:
+        _CACHE = ProjectTagCache(**kwargs)
+        return _CACHE
+
+
+def reset_cache():
+    """drops the cached tag lists and forgets the configuration"""
+    global _CACHE
+    get_cache().clear()
+    with _CACHE_LOCK:
+        _CACHE = None
@@ -0,0 +1,203 @@
+import json
+import time
+import threading
+
+from rich.progress import Progress, BarColumn, DownloadColumn, TextColumn, TransferSpeedColumn
+
+from eki_dev import tracing
+
+MODES = ("rich", "quiet", "json")
+
+
+class LayerProgress:
+    """Byte counts and timings of one image layer"""
+
+    def __init__(self, layer_id: str, now: float):
+        self.id = layer_id
+        self.status = "waiting"
+        self.download_total = 0
+        self.downloaded = 0
+        self.extract_total = 0
+        self.extracted = 0
+        self.start = now
+        self.download_start = None
+        self.download_end = None
+        self.extract_start = None
+        self.end = None
+
+    def as_dict(self, origin: float) -> dict:
+        def _span(start, end):
+            return None if start is None or end is None else round(end - start, 3)
+        return {"id": self.id,
+                "status": self.status,
+                "bytes": self.download_total or self.downloaded,
+                "download_s": _span(self.download_start, self.download_end),
+                "extract_s": _span(self.extract_start, self.end),
+                "done_at_s": _span(origin, self.end)}
+
+
+class PullProgress:
+    """
+    Aggregates the events of a `docker pull` stream into per-layer byte counts
+    and timings. `update` is called by the thread consuming the stream and
+    `layers` by the renderer, so both go through a lock.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.layers = {}
+        self.error = None
+        self.start = clock()
+        self.end = None
+        self._lock = threading.Lock()
+
+    def update(self, event: dict):
+        now = self.clock()
+        if "error" in event:
+            self.error = event["error"]
+            return
+        layer_id = event.get("id")
+        status = event.get("status", "")
+        detail = event.get("progressDetail") or {}
+        if layer_id is None or status.startswith(("Pulling from", "Digest", "Status")):
+            return
+
+        with self._lock:
+            layer = self.layers.get(layer_id)
+            if layer is None:
+                layer = self.layers[layer_id] = LayerProgress(layer_id, now)
+            if status == "Downloading":
+                layer.download_start = layer.download_start or now
+                layer.downloaded = detail.get("current", layer.downloaded)
+                layer.download_total = detail.get("total", layer.download_total)
+                layer.status = "downloading"
+            elif status == "Download complete":
+                layer.download_end = now
+                layer.downloaded = layer.download_total or layer.downloaded
+                layer.status = "downloaded"
+            elif status == "Extracting":
+                layer.extract_start = layer.extract_start or now
+                layer.extracted = detail.get("current", layer.extracted)
+                layer.extract_total = detail.get("total", layer.extract_total)
+                layer.status = "extracting"
+            elif status == "Pull complete":
+                layer.end = now
+                layer.extracted = layer.extract_total
+                layer.status = "complete"
+            elif status == "Already exists":
+                layer.end = now
+                layer.status = "cached"
+
+    def snapshot(self) -> list:
+        """returns (id, status, downloaded, download total, extracted, extract total) for every layer"""
+        with self._lock:
+            return [(l.id, l.status, l.downloaded, l.download_total, l.extracted, l.extract_total)
+                    for l in self.layers.values()]
+
+    def finish(self):
+        self.end = self.clock()
+
+    def summary(self) -> dict:
+        """total bytes downloaded, duration, throughput and per-layer timings"""
+        duration = (self.end or self.clock()) - self.start
+        with self._lock:
+            layers = [l.as_dict(self.start) for l in self.layers.values()]
+        total = sum(l["bytes"] for l in layers if l["status"] != "cached")
+        return {"bytes": total,
+                "duration_s": round(duration, 3),
+                "mb_per_s": round(total / 1e6 / duration, 2) if duration > 0 else 0.0,
+                "layers": layers,
+                "cached_layers": sum(1 for l in layers if l["status"] == "cached"),
+                "error": self.error}
+
+    def display_summary(self, indent=1):
+        ind = "\t" * indent
+        s = self.summary()
+        print(f"Pulled {s['bytes'] / 1e6:.1f} MB in {s['duration_s']:.2f}s ({s['mb_per_s']:.1f} MB/s), "
+              f"{len(s['layers'])} layers, {s['cached_layers']} already present")
+        for l in sorted(s["layers"], key=lambda l: l["bytes"], reverse=True):
+            download = "-" if l["download_s"] is None else f"{l['download_s']:.2f}s"
+            extract = "-" if l["extract_s"] is None else f"{l['extract_s']:.2f}s"
+            print(f"{ind}{l['id']:<14}{l['bytes'] / 1e6:>9.1f} MB{download:>10}{extract:>10}  {l['status']}")
+
+
+def _consume(stream, progress: PullProgress):
+    try:
+        for event in stream:
+            progress.update(event)
+    except Exception as e:
+        progress.error = progress.error or str(e)
+    finally:
+        progress.finish()
+
+
+def _render(progress: PullProgress, consumer: threading.Thread, refresh_per_second: float):
+    tasks = {}
+    columns = (TextColumn("{task.description}"), BarColumn(), DownloadColumn(), TransferSpeedColumn())
+    with Progress(*columns, auto_refresh=False, transient=True) as bar:
+        while consumer.is_alive():
+            consumer.join(1 / refresh_per_second)
+            for layer_id, status, downloaded, download_total, extracted, extract_total in progress.snapshot():
+                if layer_id not in tasks:
+                    tasks[layer_id] = bar.add_task(layer_id, total=None)
+                if status == "extracting":
+                    bar.update(tasks[layer_id], description=f"[green]Extract  {layer_id}",
+                               completed=extracted, total=extract_total or None)
+                elif status in ("complete", "cached"):
+                    bar.update(tasks[layer_id], description=f"[blue]Done     {layer_id}",
+                               completed=download_total or 1, total=download_total or 1)
+                else:
+                    bar.update(tasks[layer_id], description=f"[red]Download {layer_id}",
+                               completed=downloaded, total=download_total or None)
+            bar.refresh()
+
+
+def pull_image(docker_client,
+               repository: str,
+               tag: str,
+               auth_config: dict = None,
+               mode: str = "rich",
+               refresh_per_second: float = 4) -> dict:
+    """
+    Pulls `repository:tag` and reports its progress.
+
+    The pull stream is consumed and aggregated on its own thread, so rendering
+    never holds back the download.
+
+    Args:
+        mode: `rich` renders per-layer progress bars at `refresh_per_second`
+            and prints a summary, `quiet` only prints the summary line and
+            `json` prints the summary as one JSON document.
+
+    Returns:
+        The summary: bytes, duration, MB/s and per-layer timings.
+
+    Raises:
+        Exception: if the daemon reports an error during the pull.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown progress mode {mode}, expected one of {MODES}")
+
+    with tracing.span("docker pull", repository=repository, tag=tag) as span:
+        progress = PullProgress()
+        stream = docker_client.api.pull(repository=repository, tag=tag, stream=True, decode=True,
+                                        auth_config=auth_config)
+        consumer = threading.Thread(target=_consume, args=(stream, progress), name="pull-consumer", daemon=True)
+        consumer.start()
+        if mode == "rich":
+            _render(progress, consumer, refresh_per_second)
+        consumer.join()
+
+        summary = progress.summary()
+        span.set(bytes=summary["bytes"], layers=len(summary["layers"]), cached_layers=summary["cached_layers"],
+                 mb_per_s=summary["mb_per_s"])
+        if summary["error"] is not None:
+            raise Exception(f"Pulling {repository}:{tag} failed: {summary['error']}")
+    if mode == "json":
+        print(json.dumps(summary))
+    elif mode == "rich":
+        progress.display_summary()
+    else:
+        print(f"Pulled {repository}:{tag}: {summary['bytes'] / 1e6:.1f} MB in {summary['duration_s']:.2f}s "
+              f"({summary['mb_per_s']:.1f} MB/s)")
+    return summary
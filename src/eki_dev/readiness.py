@@ -0,0 +1,202 @@
+import time
+import random
+import socket
+
+import paramiko
+
+from eki_dev import tracing
+from eki_dev.ssh_transport import run_command
+
+
+class Probe:
+    """
+    A readiness check. `check` returns True once the stage is ready and False
+    (or raises OSError) while it is not. A single check does not last longer
+    than `timeout` seconds, if set.
+
+    Args:
+        name: stage name shown in the readiness report.
+        max_delay: upper bound, in seconds, of the backoff between attempts.
+    """
+
+    def __init__(self, name: str, max_delay: float = 1.0):
+        self.name = name
+        self.max_delay = max_delay
+        self.timeout = None
+
+    def check(self) -> bool:
+        raise NotImplementedError
+
+    def check_within(self, budget: float) -> bool:
+        """runs `check` with its timeout cut down to the `budget` seconds left"""
+        timeout = self.timeout
+        if timeout is not None:
+            self.timeout = min(timeout, budget)
+        try:
+            return self.check()
+        finally:
+            self.timeout = timeout
+
+
+class TcpPortProbe(Probe):
+    """Ready when `host` accepts TCP connections on `port`"""
+
+    def __init__(self, host: str, port: int = 22, timeout: float = 2.0, name: str = None, **kwargs):
+        super().__init__(name or f"tcp:{port}", **kwargs)
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def check(self) -> bool:
+        with socket.create_connection((self.host, self.port), timeout=self.timeout):
+            return True
+
+
+class SshBannerProbe(TcpPortProbe):
+    """Ready when the ssh server on `host` sends its protocol banner"""
+
+    def __init__(self, host: str, port: int = 22, timeout: float = 5.0, **kwargs):
+        super().__init__(host, port, timeout=timeout, name="ssh-banner", **kwargs)
+
+    def check(self) -> bool:
+        with socket.create_connection((self.host, self.port), timeout=self.timeout) as sock:
+            return sock.recv(256).startswith(b"SSH-")
+
+
+class SshCommandProbe(Probe):
+    """Ready when `command` run over ssh on `host` succeeds"""
+
+    def __init__(self, user: str, host: str, command: str, name: str = None, timeout: float = 30, **kwargs):
+        super().__init__(name or command, **kwargs)
+        self.user = user
+        self.host = host
+        self.command = command
+        self.timeout = timeout
+
+    def run(self) -> tuple:
+        """
+        returns (returncode, stdout, stderr) of the remote command. The command
+        runs on the host's shared ssh transport; ssh level failures are reported
+        with returncode 255, like the ssh client does.
+        """
+        try:
+            return run_command(self.user, self.host, self.command, timeout=self.timeout)
+        except (paramiko.SSHException, EOFError) as e:
+            return 255, b"", str(e).encode()
+
+    def check(self) -> bool:
+        returncode, _, _ = self.run()
+        return returncode == 0
+
+
+class CloudInitProbe(SshCommandProbe):
+    """
+    Ready when cloud-init has finished running the UserData bootstrap.
+
+    `cloud-init status --wait` blocks on the instance until cloud-init is done,
+    so completion is seen as soon as it happens rather than at the next poll.
+    The bootstrap counts as finished even if it reported errors; later probes
+    decide whether the instance is usable.
+    """
+
+    def __init__(self, user: str, host: str, timeout: float = 1800, **kwargs):
+        super().__init__(user, host, "cloud-init status --wait", name="cloud-init", timeout=timeout, **kwargs)
+
+    def check(self) -> bool:
+        returncode, stdout, _ = self.run()
+        # 255 is ssh's own error code, any other code comes from cloud-init
+        return returncode != 255 and b"status:" in (stdout or b"")
+
+
+class DockerProbe(SshCommandProbe):
+    """Ready when the docker daemon socket answers for `user`"""
+
+    def __init__(self, user: str, host: str, **kwargs):
+        super().__init__(user, host, "docker info --format '{{.ServerVersion}}'", name="docker", **kwargs)
+
+
+def default_probes(user: str, host: str, port: int = 22) -> list:
+    """TCP port, ssh banner, cloud-init completion and docker socket, in this order"""
+    return [TcpPortProbe(host, port),
+            SshBannerProbe(host, port),
+            CloudInitProbe(user, host),
+            DockerProbe(user, host)]
+
+
+class ReadinessReport:
+    """Attempts and time spent waiting for each stage"""
+
+    def __init__(self):
+        self.stages = []
+
+    def add(self, name: str, attempts: int, duration: float, ready: bool):
+        self.stages.append({"name": name, "attempts": attempts, "duration": duration, "ready": ready})
+
+    @property
+    def ready(self) -> bool:
+        return bool(self.stages) and all(s["ready"] for s in self.stages)
+
+    @property
+    def duration(self) -> float:
+        return sum(s["duration"] for s in self.stages)
+
+    def display(self, indent=1):
+        ind = "\t" * indent
+        print(f"Readiness report ({self.duration:.2f}s):")
+        for s in self.stages:
+            status = "ready" if s["ready"] else "not ready"
+            print(f"{ind}{s['name']:<16}{s['duration']:>8.2f}s{s['attempts']:>5} attempts  {status}")
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """Exponential backoff with equal jitter: a delay in [d/2, d], d = min(max, base * 2**attempt)"""
+    delay = min(max_delay, base_delay * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def wait_until_ready(probes: list,
+                     deadline: float = 900,
+                     base_delay: float = 0.1,
+                     sleep=time.sleep) -> ReadinessReport:
+    """
+    Runs `probes` one after the other, retrying each with exponential backoff
+    and jitter until it passes. Each attempt gets at most the time left before
+    the deadline.
+
+    Args:
+        probes: list of Probe, each gating the next.
+        deadline: seconds allowed for all the probes together.
+        base_delay: delay before the second attempt of a probe.
+
+    Returns:
+        The ReadinessReport.
+
+    Raises:
+        TimeoutError: if the probes do not pass before the deadline. The
+            exception carries the partial report as `report`.
+    """
+    report = ReadinessReport()
+    end = time.monotonic() + deadline
+    for probe in probes:
+        with tracing.span(f"probe {probe.name}") as span:
+            start = time.monotonic()
+            attempt = 0
+            while True:
+                attempt += 1
+                span.attempts = attempt
+                try:
+                    ready = probe.check_within(max(0.0, end - time.monotonic()))
+                except OSError:
+                    ready = False
+                if ready:
+                    report.add(probe.name, attempt, time.monotonic() - start, True)
+                    break
+
+                now = time.monotonic()
+                if now >= end:
+                    report.add(probe.name, attempt, now - start, False)
+                    err = TimeoutError(f"{probe.name} not ready after {deadline}s")
+                    err.report = report
+                    raise err
+                sleep(min(backoff_delay(attempt - 1, base_delay, probe.max_delay), end - now))
+    return report
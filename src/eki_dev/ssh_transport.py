@@ -0,0 +1,231 @@
+import os
+import socket
+import threading
+
+import paramiko
+import docker
+from docker.constants import DEFAULT_DOCKER_API_VERSION, MINIMUM_DOCKER_API_VERSION
+from docker.transport import SSHHTTPAdapter
+from docker.utils import version_lt
+
+from eki_dev import tracing
+
+_CONNECTIONS = {}
+_DOCKER_CLIENTS = {}
+_LOCK = threading.Lock()
+
+
+class AcceptNewPolicy(paramiko.MissingHostKeyPolicy):
+    """
+    Same as ssh's `StrictHostKeyChecking=accept-new`: unknown host keys are
+    accepted and appended to `known_hosts`; changed keys are still rejected by
+    paramiko because they are found in the loaded host keys.
+    """
+
+    def __init__(self, known_hosts: str):
+        self.known_hosts = known_hosts
+
+    def missing_host_key(self, client, hostname, key):
+        client.get_host_keys().add(hostname, key.get_name(), key)
+        os.makedirs(os.path.dirname(self.known_hosts), mode=0o700, exist_ok=True)
+        with open(self.known_hosts, "a", encoding='utf8') as f:
+            f.write(f"{hostname} {key.get_name()} {key.get_base64()}\n")
+
+
+class SshConnection:
+    """
+    One authenticated SSH transport to `user@host:port`, shared by every remote
+    command, readiness probe and docker API call for that host. Each use opens a
+    new channel on the transport instead of paying a new handshake. The
+    transport is re-established if it drops.
+
+    Args:
+        user: login user.
+        host: host name or IP address.
+        port: ssh port.
+        timeout: TCP connect, banner and authentication timeout in seconds.
+        keepalive: seconds between transport keepalive packets.
+    """
+
+    def __init__(self, user: str, host: str, port: int = 22, timeout: float = 10, keepalive: int = 30):
+        self.user = user
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.client = paramiko.SSHClient()
+        self.docker_api_version = None
+        self._lock = threading.Lock()
+
+    def _connect_params(self) -> dict:
+        params = {"hostname": self.host, "port": self.port, "username": self.user,
+                  "timeout": self.timeout, "banner_timeout": self.timeout, "auth_timeout": self.timeout}
+        ssh_config_file = os.path.expanduser("~/.ssh/config")
+        if os.path.exists(ssh_config_file):
+            conf = paramiko.SSHConfig.from_path(ssh_config_file)
+            host_config = conf.lookup(self.host)
+            if 'proxycommand' in host_config:
+                params["sock"] = paramiko.ProxyCommand(host_config['proxycommand'])
+            if 'identityfile' in host_config:
+                params["key_filename"] = host_config['identityfile']
+        return params
+
+    def ensure_connected(self) -> paramiko.Transport:
+        """returns the active transport, connecting first if needed"""
+        with self._lock:
+            transport = self.client.get_transport()
+            if transport is None or not transport.is_active():
+                with tracing.span("ssh connect", host=self.host, user=self.user):
+                    known_hosts = os.path.expanduser("~/.ssh/known_hosts")
+                    if os.path.exists(known_hosts):
+                        self.client.load_host_keys(known_hosts)
+                    self.client.set_missing_host_key_policy(AcceptNewPolicy(known_hosts))
+                    self.client.connect(**self._connect_params())
+                    transport = self.client.get_transport()
+                    transport.set_keepalive(self.keepalive)
+            return transport
+
+    def run(self, command: str, timeout: float = 30) -> tuple:
+        """
+        Runs `command` on a new channel. Returns (returncode, stdout, stderr).
+        The channel is closed after `timeout` seconds even if the command keeps
+        writing, and socket.timeout is raised.
+        """
+        self.ensure_connected()
+        _, stdout, stderr = self.client.exec_command(command, timeout=timeout)
+        expired = threading.Event()
+
+        def expire():
+            expired.set()
+            stdout.channel.close()
+
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+        try:
+            out = stdout.read()
+            err = stderr.read()
+            returncode = stdout.channel.recv_exit_status()
+        finally:
+            timer.cancel()
+        if expired.is_set():
+            raise socket.timeout(f"{command} did not finish within {timeout}s")
+        return returncode, out, err
+
+    def negotiate_docker_api_version(self, api: docker.APIClient) -> str:
+        """
+        returns the docker API version to use with the daemon: the highest one
+        both docker-py and the daemon support. Daemons drop old versions (docker
+        29 needs 1.44 or later), so it is asked once per connection, then cached.
+        """
+        if self.docker_api_version is None:
+            server = api.version(api_version=False)["ApiVersion"]
+            self.docker_api_version = (server if version_lt(server, DEFAULT_DOCKER_API_VERSION)
+                                       else DEFAULT_DOCKER_API_VERSION)
+        return self.docker_api_version
+
+    def close(self):
+        with self._lock:
+            self.client.close()
+
+
+class PooledSSHHTTPAdapter(SSHHTTPAdapter):
+    """docker-py ssh adapter that sends every API call over an SshConnection"""
+
+    def __init__(self, base_url: str, connection: SshConnection, **kwargs):
+        self.connection = connection
+        super().__init__(base_url, **kwargs)
+
+    def _create_paramiko_client(self, base_url):
+        self.ssh_client = self.connection.client
+        self.ssh_params = {}
+
+    def _connect(self):
+        self.connection.ensure_connected()
+
+    def get_connection(self, url, proxies=None):
+        transport = self.connection.ensure_connected()
+        with self.pools.lock:
+            pool = self.pools.get(url)
+            if pool is not None and pool.ssh_transport is not transport:
+                # the transport was re-established, drop channels of the old one
+                self.pools.clear()
+        return super().get_connection(url, proxies)
+
+    def close(self):
+        # the SshConnection outlives the adapter
+        self.pools.clear()
+
+
+class PooledAPIClient(docker.APIClient):
+    """
+    docker-py low-level client whose API calls go through a PooledSSHHTTPAdapter.
+    `use_ssh_client` defers any connection of the adapter docker-py creates,
+    the pooled one is then mounted over it.
+    """
+
+    def __init__(self, base_url: str, adapter: PooledSSHHTTPAdapter, version: str, timeout: int = 60):
+        super().__init__(base_url=base_url, version=version, timeout=timeout, use_ssh_client=True)
+        self.mount("http+docker://ssh", adapter)
+
+
+class PooledDockerClient(docker.DockerClient):
+    """
+    docker-py client for the daemon at `base_url` over `connection`, using the
+    API version negotiated once per connection.
+    """
+
+    def __init__(self, base_url: str, connection: SshConnection, timeout: int = 60):
+        adapter = PooledSSHHTTPAdapter(base_url, connection, timeout=timeout)
+        # the version request works with any supported version
+        probe = PooledAPIClient(base_url, adapter, version=MINIMUM_DOCKER_API_VERSION, timeout=timeout)
+        version = connection.negotiate_docker_api_version(probe)
+        # all DockerClient.__init__ does is to build its APIClient
+        self.api = PooledAPIClient(base_url, adapter, version=version, timeout=timeout)
+
+
+def get_connection(user: str, host: str, port: int = 22) -> SshConnection:
+    """returns the process-wide SshConnection for `user@host:port`"""
+    key = (user, host, port)
+    with _LOCK:
+        conn = _CONNECTIONS.get(key)
+        if conn is None:
+            conn = SshConnection(user, host, port)
+            _CONNECTIONS[key] = conn
+    return conn
+
+
+def run_command(user: str, host: str, command: str, timeout: float = 30, port: int = 22) -> tuple:
+    """Runs `command` on `host` over the shared transport. Returns (returncode, stdout, stderr)"""
+    return get_connection(user, host, port).run(command, timeout=timeout)
+
+
+def get_docker_client(user: str, host: str, port: int = 22, timeout: int = 60) -> docker.DockerClient:
+    """
+    returns the process-wide docker client for the daemon on `host`. Its API
+    calls are channels of the shared SshConnection.
+    """
+    key = (user, host, port)
+    with _LOCK:
+        client = _DOCKER_CLIENTS.get(key)
+        if client is not None:
+            return client
+
+    client = PooledDockerClient(f"ssh://{user}@{host}:{port}", get_connection(user, host, port), timeout=timeout)
+
+    with _LOCK:
+        client = _DOCKER_CLIENTS.setdefault(key, client)
+    return client
+
+
+def close_all():
+    """Closes every pooled docker client and ssh transport"""
+    with _LOCK:
+        clients = list(_DOCKER_CLIENTS.values())
+        connections = list(_CONNECTIONS.values())
+        _DOCKER_CLIENTS.clear()
+        _CONNECTIONS.clear()
+    for client in clients:
+        client.close()
+    for conn in connections:
+        conn.close()
@@ -0,0 +1,146 @@
+import os
+import time
+import sqlite3
+from pathlib import Path
+from contextlib import contextmanager
+
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    name TEXT PRIMARY KEY,
+    instance_id TEXT,
+    ip TEXT,
+    context TEXT,
+    project TEXT,
+    image TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    checked_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS instances_ip ON instances (ip);
+CREATE INDEX IF NOT EXISTS instances_instance_id ON instances (instance_id);
+CREATE INDEX IF NOT EXISTS instances_checked_at ON instances (checked_at);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class StateStore:
+    """
+    Local record of the machines created from this computer, kept in
+    ~/CONFIG_DIR/state.db.
+
+    The database is SQLite in WAL mode: readers never block, and writers from
+    concurrent edamame processes are serialized by `BEGIN IMMEDIATE`
+    transactions. The legacy empty `name@ip` files of ~/CONFIG_DIR are imported
+    and removed the first time the store is opened.
+
+    Args:
+        CONFIG_DIR: configuration directory, relative to the home directory.
+        timeout: seconds to wait for another process's write transaction.
+    """
+
+    def __init__(self, CONFIG_DIR='.dev_machine', timeout: float = 30):
+        self.config_dir = os.path.join(os.path.expanduser("~"), CONFIG_DIR)
+        Path(self.config_dir).mkdir(parents=False, exist_ok=True)
+        self.path = os.path.join(self.config_dir, "state.db")
+        self.conn = sqlite3.connect(self.path, timeout=timeout, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+        self._migrate_legacy_files()
+
+    def _create_schema(self):
+        with self.transaction() as conn:
+            for statement in filter(str.strip, _SCHEMA.split(";")):
+                conn.execute(statement)
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('schema_version', ?)", (str(SCHEMA_VERSION),))
+
+    @contextmanager
+    def transaction(self):
+        """write transaction, holding the database write lock until it ends"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def _migrate_legacy_files(self):
+        legacy = []
+        with self.transaction() as conn:
+            if conn.execute("SELECT value FROM meta WHERE key = 'legacy_migrated'").fetchone():
+                return
+            for file in os.listdir(self.config_dir):
+                try:
+                    name, ip = file.split("@")
+                except ValueError:
+                    continue
+                now = os.path.getmtime(os.path.join(self.config_dir, file))
+                conn.execute("INSERT OR IGNORE INTO instances (name, ip, context, created_at, updated_at, checked_at) "
+                             "VALUES (?, ?, ?, ?, ?, 0)", (name, ip, name, now, now))
+                legacy.append(file)
+            conn.execute("INSERT INTO meta VALUES ('legacy_migrated', ?)", (str(time.time()),))
+        for file in legacy:
+            try:
+                os.remove(os.path.join(self.config_dir, file))
+            except FileNotFoundError:
+                pass
+
+    def upsert(self, name: str, ip: str, instance_id: str = None, context: str = None,
+               project: str = None, image: str = None):
+        """records machine `name`. A machine just created counts as checked"""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO instances (name, instance_id, ip, context, project, image, "
+                "created_at, updated_at, checked_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET instance_id = excluded.instance_id, ip = excluded.ip, "
+                "context = excluded.context, project = excluded.project, image = excluded.image, "
+                "updated_at = excluded.updated_at, checked_at = excluded.checked_at",
+                (name, instance_id, ip, context or name, project, image, now, now, now))
+
+    def remove(self, name: str, ip: str = None) -> int:
+        """removes machine `name`, only if it has `ip` when given. Returns the number of entries removed"""
+        with self.transaction() as conn:
+            if ip is None:
+                cur = conn.execute("DELETE FROM instances WHERE name = ?", (name,))
+            else:
+                cur = conn.execute("DELETE FROM instances WHERE name = ? AND ip = ?", (name, ip))
+            return cur.rowcount
+
+    def get(self, name: str) -> dict:
+        row = self.conn.execute("SELECT * FROM instances WHERE name = ?", (name,)).fetchone()
+        return dict(row) if row else None
+
+    def by_instance_ids(self, instance_ids: list) -> dict:
+        """returns {instance id: entry} of the machines recorded with one of `instance_ids`"""
+        entries = {}
+        ids = list(instance_ids)
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows = self.conn.execute(
+                f"SELECT * FROM instances WHERE instance_id IN ({','.join('?' * len(chunk))})", chunk)
+            entries.update((r["instance_id"], dict(r)) for r in rows)
+        return entries
+
+    def all(self) -> list:
+        return [dict(r) for r in self.conn.execute("SELECT * FROM instances ORDER BY created_at")]
+
+    def stale(self, max_age: float) -> list:
+        """returns the entries not checked against EC2 in the last `max_age` seconds"""
+        rows = self.conn.execute("SELECT * FROM instances WHERE checked_at < ?", (time.time() - max_age,))
+        return [dict(r) for r in rows]
+
+    def mark_checked(self, names: list):
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany("UPDATE instances SET checked_at = ? WHERE name = ?", [(now, n) for n in names])
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,192 @@
+import re
+import json
+
+from eki_dev.aws_service import AwsService
+from eki_dev.ssh_transport import run_command
+
+# Storage profiles of the explorer machines:
+#   efs           EFS on /home/ubuntu/efs, one NFS connection, no cache (the original setup)
+#   efs-cached    EFS through FS-Cache (cachefilesd) on the root volume, with 8 NFS connections
+#   nvme-scratch  instance store NVMe, striped if several, as scratch on /home/ubuntu/scratch,
+#                 and EFS through FS-Cache on that scratch
+PROFILES = ("efs", "efs-cached", "nvme-scratch")
+
+EFS_MOUNT = "/home/ubuntu/efs"
+SCRATCH_MOUNT = "/home/ubuntu/scratch"
+EFS_OPTIONS = "nfsvers=4.1,rsize=1048576,wsize=1048576,hard,timeo=600,retrans=2,noresvport"
+NCONNECT = 8
+
+# The mounts are redone at every boot: instance store is blank after a stop,
+# and the UserData only runs on the first boot.
+PER_BOOT_SCRIPT = "/var/lib/cloud/scripts/per-boot/edamame-storage.sh"
+
+_INSTALL = "sudo apt-get -y install nfs-common fio{packages}\n"
+
+# After a reboot the instance store keeps its data and the array is assembled
+# again by the kernel, as /dev/md127: it is stopped and created again on the
+# same devices, which keeps its file system. After a stop and start the
+# devices are blank and get a new one.
+_SCRATCH = f"""DEVICES=$(lsblk -dpno NAME,MODEL | awk '/Instance Storage/ {{print $1}}')
+COUNT=$(echo "$DEVICES" | grep -c /dev/)
+if [ "$COUNT" -gt 1 ]; then
+  for ARRAY in $(lsblk -lpno NAME,TYPE $DEVICES | awk '$2 ~ /^raid/ {{print $1}}' | sort -u); do
+    mdadm --stop $ARRAY
+  done
+  mdadm --create /dev/md0 --run --level=0 --raid-devices=$COUNT $DEVICES
+  DEVICES=/dev/md0
+fi
+if [ "$COUNT" -gt 0 ]; then
+  blkid $DEVICES > /dev/null || mkfs.ext4 -q -F $DEVICES
+  mkdir -p {SCRATCH_MOUNT}
+  mount -o noatime $DEVICES {SCRATCH_MOUNT}
+  chown ubuntu:ubuntu {SCRATCH_MOUNT}
+fi
+"""
+
+_FSCACHE = """mkdir -p {cache_dir}
+sed -i 's|^dir .*|dir {cache_dir}|' /etc/cachefilesd.conf
+sed -i 's|^#*RUN=.*|RUN=yes|' /etc/default/cachefilesd
+systemctl restart cachefilesd
+"""
+
+_EFS = f"""mkdir -p {EFS_MOUNT}
+mount -t nfs4 -o {{options}} {{efs}}:/ {EFS_MOUNT}
+"""
+
+_EFS_LINE = re.compile(rf"(\S+):/\s+{re.escape(EFS_MOUNT)}")
+
+
+def _check_profile(profile: str):
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown storage profile {profile}. Use one of {PROFILES}")
+
+
+def instance_store_support(instance_types: list) -> dict:
+    """returns {instance type: whether it has instance store volumes}"""
+    ec2 = AwsService.from_service("ec2")
+    info = ec2.client.describe_instance_types(InstanceTypes=list(instance_types))["InstanceTypes"]
+    return {i["InstanceType"]: i.get("InstanceStorageSupported", False) for i in info}
+
+
+def check_instance_store(profile: str, instance_types: list) -> list:
+    """
+    returns the `instance_types` that can run the storage of `profile`:
+    nvme-scratch needs instance store volumes, without them the scratch would
+    silently land on the root EBS volume.
+    """
+    if profile != "nvme-scratch" or not instance_types:
+        return list(instance_types)
+    support = instance_store_support(instance_types)
+    return [t for t in instance_types if support.get(t)]
+
+
+def efs_from_user_data(user_data: str) -> str:
+    """returns the EFS file system name mounted on /home/ubuntu/efs by `user_data`, or None"""
+    match = _EFS_LINE.search(user_data or "")
+    return match.group(1) if match else None
+
+
+def mount_script(profile: str, efs: str) -> str:
+    """returns the script, run as root at every boot, mounting the storage of `profile`"""
+    _check_profile(profile)
+    script = "#!/bin/sh\n"
+    if profile == "nvme-scratch":
+        script += _SCRATCH
+    if profile in ("efs-cached", "nvme-scratch"):
+        cache_dir = f"{SCRATCH_MOUNT}/fscache" if profile == "nvme-scratch" else "/var/cache/fscache"
+        script += _FSCACHE.format(cache_dir=cache_dir)
+        options = f"{EFS_OPTIONS},nconnect={NCONNECT},fsc"
+    else:
+        options = EFS_OPTIONS
+    return script + _EFS.format(options=options, efs=efs)
+
+
+def with_storage_profile(profile: str, efs: str = None, **instance_params) -> dict:
+    """
+    returns `instance_params` with the UserData mounting the storage of
+    `profile`, instead of its own EFS mount commands. `efs` defaults to the
+    file system mounted by the UserData. Unchanged without a profile.
+
+    Raises:
+        ValueError: if the InstanceType has no instance store for nvme-scratch.
+    """
+    if profile is None:
+        return instance_params
+    _check_profile(profile)
+    instance_type = instance_params.get("InstanceType")
+    if instance_type is not None and not check_instance_store(profile, [instance_type]):
+        raise ValueError(f"{instance_type} has no instance store volumes for the {profile} profile, "
+                         f"use an instance type with local NVMe such as m5d, c6id or i4i")
+    user_data = instance_params.get("UserData") or "#!/bin/sh\n"
+    efs = efs or efs_from_user_data(user_data)
+    if efs is None:
+        raise ValueError(f"No EFS file system given or mounted on {EFS_MOUNT} by the UserData")
+
+    lines = [line for line in user_data.splitlines() if EFS_MOUNT not in line]
+    packages = {"efs": "", "efs-cached": " cachefilesd", "nvme-scratch": " cachefilesd mdadm"}[profile]
+    script = (_INSTALL.format(packages=packages)
+              + f"sudo mkdir -p $(dirname {PER_BOOT_SCRIPT})\n"
+              + f"sudo tee {PER_BOOT_SCRIPT} > /dev/null << 'EOF'\n{mount_script(profile, efs)}EOF\n"
+              + f"sudo chmod 755 {PER_BOOT_SCRIPT}\n"
+              + f"sudo {PER_BOOT_SCRIPT}\n")
+    return dict(instance_params, UserData="\n".join(lines) + "\n" + script)
+
+
+def container_volumes(profile: str = None) -> list:
+    """returns the volumes of the explorer container for the storage of `profile`"""
+    volumes = [f"{EFS_MOUNT}:/home/eki/efs"]
+    if profile == "nvme-scratch":
+        volumes.append(f"{SCRATCH_MOUNT}:/home/eki/scratch")
+    return volumes
+
+
+def mount_points(profile: str = None) -> list:
+    """returns the host directories of the container volumes of `profile`"""
+    return [volume.split(":")[0] for volume in container_volumes(profile)]
+
+
+def fio_command(directory: str, size: str = "1G", runtime: int = 20, numjobs: int = 4) -> str:
+    """
+    returns the command laying out the fio files in `directory`, dropping the
+    page cache, then reading them sequentially. The reads are buffered, so
+    they go through FS-Cache when the profile has it.
+    """
+    fio = (f"sudo fio --name=edamame-read --directory={directory} --rw=read --bs=1M --size={size} "
+           f"--numjobs={numjobs} --ioengine=psync --group_reporting")
+    return (f"{fio} --create_only=1 > /dev/null && "
+            f"sudo sh -c 'sync; echo 3 > /proc/sys/vm/drop_caches' && "
+            f"{fio} --runtime={runtime} --time_based --output-format=json")
+
+
+def parse_fio(output: str) -> dict:
+    """returns the read bandwidth (MB/s) and IOPS of the fio JSON report"""
+    job = json.loads(output)["jobs"][0]["read"]
+    return {"mb_per_s": round(job["bw_bytes"] / 1e6, 1), "iops": round(job["iops"])}
+
+
+def check_storage(user: str, host: str, profile: str = None, size: str = "1G", runtime: int = 20) -> dict:
+    """
+    Measures the sequential read bandwidth of every mount of `profile` on
+    `host` with fio, and prints it.
+
+    Returns:
+        {mount point: {"mb_per_s", "iops"}}, or {"error"} for a failed mount point.
+    """
+    results = {}
+    for directory in mount_points(profile):
+        code, out, err = run_command(user, host, fio_command(directory, size=size, runtime=runtime),
+                                     timeout=runtime + 300)
+        if code != 0:
+            results[directory] = {"error": (err or out).decode(errors="replace").strip()}
+        else:
+            results[directory] = parse_fio(out)
+        # fio leaves its files behind
+        run_command(user, host, f"sudo rm -f {directory}/edamame-read.*")
+
+    print(f"Storage check of {host} ({profile or 'efs'})")
+    for directory, r in results.items():
+        if "error" in r:
+            print(f"\t{directory:<24}failed: {r['error']}")
+        else:
+            print(f"\t{directory:<24}{r['mb_per_s']:>10.1f} MB/s{r['iops']:>10} IOPS")
+    return results
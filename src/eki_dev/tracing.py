@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import random
+import threading
+import contextlib
+import contextvars
+
+FORMATS = ("jsonl", "otlp")
+
+_CURRENT = contextvars.ContextVar("edamame_span", default=None)
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+class Span:
+    """
+    A timed operation of a trace: an AWS call, an ssh probe, a docker login,
+    a pull, a pipeline phase...
+
+    Args:
+        name: operation name.
+        parent: enclosing span, or None to start a new trace.
+        **attributes: attributes recorded with the span.
+    """
+
+    def __init__(self, name: str, parent: "Span" = None, **attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else _new_id(128)
+        self.span_id = _new_id(64)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+        self.attempts = 1
+        self.outcome = None
+        self.error = None
+        self.start = time.time()
+        self.end = None
+        self._start = time.perf_counter()
+        self._duration = None
+
+    @property
+    def duration(self) -> float:
+        return self._duration
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self, outcome: str = "ok", error: str = None):
+        if self.end is not None:
+            return
+        self._duration = time.perf_counter() - self._start
+        self.end = self.start + self._duration
+        self.outcome = outcome
+        self.error = error
+        get_tracer().record(self)
+
+    def as_dict(self) -> dict:
+        return {"trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+                "name": self.name, "start": self.start, "end": self.end,
+                "duration_s": None if self._duration is None else round(self._duration, 6),
+                "attempts": self.attempts, "outcome": self.outcome, "error": self.error,
+                "attributes": self.attributes}
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_otlp_value(v) for v in value]}}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(span: Span) -> dict:
+    attributes = dict(span.attributes, attempts=span.attempts)
+    otlp = {"traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(int(span.start * 1e9)),
+            "endTimeUnixNano": str(int(span.end * 1e9)),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items() if v is not None],
+            "status": {"code": 1} if span.outcome == "ok" else {"code": 2, "message": span.error or span.outcome}}
+    if span.parent_id is not None:
+        otlp["parentSpanId"] = span.parent_id
+    return otlp
+
+
+class Tracer:
+    """
+    Collects the finished spans and appends them to `path` when their trace
+    ends, as one JSON object per span (`jsonl`) or as one OTLP/JSON
+    ExportTraceServiceRequest per trace (`otlp`, the format of the
+    OpenTelemetry collector file exporter). Without `path` nothing is kept.
+
+    Args:
+        path: file the traces are appended to.
+        format: `jsonl` or `otlp`.
+        service: service.name resource attribute of the OTLP export.
+    """
+
+    def __init__(self, path: str = None, format: str = "jsonl", service: str = "edamame"):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown trace format {format}, expected one of {FORMATS}")
+        self.path = os.path.expanduser(path) if path else None
+        self.format = format
+        self.service = service
+        self._spans = {}
+        self._closed = set()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def record(self, span: Span):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._spans.setdefault(span.trace_id, []).append(span)
+            if span.parent_id is None:
+                self._closed.add(span.trace_id)
+            # spans of background threads may finish after their root
+            done = span.trace_id in self._closed
+        if done:
+            self.flush(span.trace_id)
+
+    def flush(self, trace_id: str = None):
+        """appends the recorded spans of `trace_id`, or of every trace, to the file"""
+        with self._lock:
+            if trace_id is None:
+                spans = [s for trace in self._spans.values() for s in trace]
+                self._spans.clear()
+            else:
+                spans = self._spans.pop(trace_id, [])
+            if not spans:
+                return
+            if self.format == "otlp":
+                lines = [json.dumps({"resourceSpans": [{
+                    "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service}}]},
+                    "scopeSpans": [{"scope": {"name": "eki_dev.tracing"},
+                                    "spans": [_otlp_span(s) for s in spans]}]}]})]
+            else:
+                lines = [json.dumps(s.as_dict(), default=str) for s in spans]
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a", encoding='utf8') as f:
+                f.write("\n".join(lines) + "\n")
+
+
+_TRACER = Tracer()
+_TRACER_LOCK = threading.Lock()
+
+
+def get_tracer() -> Tracer:
+    """returns the process-wide Tracer"""
+    return _TRACER
+
+
+def configure(**kwargs) -> Tracer:
+    """replaces the process-wide tracer by Tracer(**kwargs)"""
+    global _TRACER
+    with _TRACER_LOCK:
+        _TRACER = Tracer(**kwargs)
+        return _TRACER
+
+
+def reset():
+    """disables tracing and drops the recorded spans"""
+    configure()
+
+
+def current_span() -> Span:
+    """returns the innermost open span of the calling context, or None"""
+    return _CURRENT.get()
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """
+    Runs the block in a new span, child of the current one. The outcome is
+    `ok`, or `error` with the exception if the block raises; the block may
+    set its own outcome with `finish`.
+    """
+    s = Span(name, _CURRENT.get(), **attributes)
+    token = _CURRENT.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.finish("error", f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        _CURRENT.reset(token)
+        s.finish()
+
+
+def run_in_context(func):
+    """
+    returns `func` bound to the calling context, to run it on other threads
+    under the current span. Each call runs in its own copy of the context, so
+    the result can be mapped over a thread pool.
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+
+def _before_call(model, context, **_):
+    context["edamame_span"] = Span(f"aws {model.service_model.service_name}.{model.name}", _CURRENT.get(),
+                                   service=model.service_model.service_name, operation=model.name)
+
+
+def _after_call(http_response, parsed, context, **_):
+    s = context.pop("edamame_span", None)
+    if s is None:
+        return
+    metadata = parsed.get("ResponseMetadata", {})
+    s.attempts = metadata.get("RetryAttempts", 0) + 1
+    s.set(http_status=http_response.status_code, request_id=metadata.get("RequestId"))
+    if http_response.status_code >= 300:
+        s.finish("error", parsed.get("Error", {}).get("Code"))
+    else:
+        s.finish()
+
+
+def _after_call_error(exception, context, **_):
+    s = context.pop("edamame_span", None)
+    if s is not None:
+        s.finish("error", f"{type(exception).__name__}: {exception}")
+
+
+def instrument_session(session):
+    """records a span for every API call of the clients created from the boto3 `session`, retries included"""
+    session.events.register("before-call", _before_call, unique_id="edamame-tracing-before")
+    session.events.register("after-call", _after_call, unique_id="edamame-tracing-after")
+    session.events.register("after-call-error", _after_call_error, unique_id="edamame-tracing-error")
+    return session
@@ -1,12 +1,16 @@
 import os
+import sys
 import copy
+import json
+import shutil
+import tempfile
+import contextlib
 import subprocess
-from rich.pretty import pprint
 from pathlib import Path
 import yaml
 import importlib_resources
 
-from eki_dev.aws_service import AwsService
+from eki_dev.state import StateStore
 
 
 def generate_makefile(image_name : str,
@@ -28,18 +32,69 @@ def update_dict(dct, dct_w_updates):
             dct[k] = v
 
 
+def merge_config(dct, dct_w_updates) -> dict:
+    """
+    returns `dct` updated with `dct_w_updates` without modifying either. The
+    result shares no object with them: callers edit the launch parameters of
+    the configuration they retrieved, e.g. its tag list.
+    """
+    merged = {k: copy.deepcopy(v) for k, v in dct.items()}
+    for k, v in dct_w_updates.items():
+        if isinstance(dct.get(k), dict) and isinstance(v, dict):
+            merged[k] = merge_config(dct[k], v)
+        else:
+            merged[k] = copy.deepcopy(v)
+    return merged
+
+
+# libyaml's loader when PyYAML was built with it, several times faster
+YAML_LOADER = getattr(yaml, "CFullLoader", yaml.FullLoader)
+
+
 class Config:
+    """
+    Application configuration (default_conf.yaml, shipped with the package)
+    and user configuration (`path_config_dir`/config).
+
+    Parsing the YAML files is the slowest part of a CLI start, so both files,
+    their merge and the merged profiles are kept as JSON in `path_config_dir`/config.cache,
+    reused as long as the files and the package version are unchanged.
+
+    A profile is a named set of overrides in the `Profiles` section, e.g. an
+    instance preset:
+
+        Profiles:
+          gpu:
+            Ec2Instance:
+              Properties:
+                InstanceType: g4dn.xlarge
+    """
+
+    CACHE_NAME = "config.cache"
+
     def __init__(self, path_config_dir='~/.dev_machine'):
-        self.conf = self.retrieve_application_configuration()
-        self.user_conf = self.retrieve_user_configuration(path_config_dir=path_config_dir)
         self.path_config_dir = path_config_dir
+        self._merged = {}
+        cached = self._load_cache()
+        if cached is None:
+            self.conf = self.retrieve_application_configuration()
+            self.user_conf = self.retrieve_user_configuration(path_config_dir=path_config_dir)
+            self._write_cache()
+        else:
+            self.conf, self.user_conf, self._merged = cached
+
+    @staticmethod
+    def _application_configuration_path():
+        ref = importlib_resources.files('eki_dev') / 'default_conf.yaml'
+        with importlib_resources.as_file(ref) as data_path:
+            return os.path.abspath(data_path)
 
     @staticmethod
     def retrieve_application_configuration():
         ref = importlib_resources.files('eki_dev') / 'default_conf.yaml'
         with importlib_resources.as_file(ref) as data_path:
             with open(data_path, "r", encoding='utf8') as f:
-                conf = yaml.load(f, Loader=yaml.FullLoader)
+                conf = yaml.load(f, Loader=YAML_LOADER)
         return conf
 
     @staticmethod
@@ -48,31 +103,104 @@ class Config:
         fn_config = os.path.join(path_user_config, "config")
         try:
             with open(fn_config, "r", encoding='utf8') as f:
-                conf = yaml.load(f, Loader=yaml.FullLoader)
+                conf = yaml.load(f, Loader=YAML_LOADER)
         except FileNotFoundError:
             conf = {"Ec2Instance": {"Properties": {"KeyName": "id_rsa"}}}
 
         return conf
 
-    def retrieve_configuration(self):
-        conf = copy.deepcopy(self.conf)
-        update_dict(conf, self.user_conf)
-        return conf
+    def _cache_key(self) -> list:
+        from eki_dev import __version__
+
+        def stamp(path):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                return [path, None, None]
+            return [path, st.st_mtime_ns, st.st_size]
+
+        fn_user_config = os.path.abspath(os.path.join(os.path.expanduser(self.path_config_dir), "config"))
+        return [__version__, stamp(self._application_configuration_path()), stamp(fn_user_config)]
+
+    def _cache_path(self) -> str:
+        return os.path.join(os.path.expanduser(self.path_config_dir), self.CACHE_NAME)
 
+    def _load_cache(self):
+        try:
+            with open(self._cache_path(), "r", encoding='utf8') as f:
+                cached = json.load(f)
+            if cached["key"] != self._cache_key():
+                return None
+            # each tree is its own part of the parsed document, nothing is shared
+            return cached["conf"], cached["user_conf"], {None: cached["merged"], **cached["profiles"]}
+        except (OSError, KeyError, TypeError, ValueError):
+            return None
+
+    def _write_cache(self):
+        merged = {None: merge_config(self.conf, self.user_conf)}
+        for name, overrides in (merged[None].get("Profiles") or {}).items():
+            merged[name] = merge_config(merged[None], overrides)
+        cached = {"key": self._cache_key(), "conf": self.conf, "user_conf": self.user_conf,
+                  "merged": merged.pop(None), "profiles": merged}
+        try:
+            text = json.dumps(cached)
+        except (TypeError, ValueError):
+            return
+        if json.loads(text) != cached:
+            # e.g. dates or non-string keys in the YAML files, JSON would not give them back as they are
+            return
+        path_config_dir = os.path.expanduser(self.path_config_dir)
+        try:
+            fd, tmp = tempfile.mkstemp(dir=path_config_dir, prefix=".config.cache.")
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "w", encoding='utf8') as f:
+                f.write(text)
+            os.replace(tmp, self._cache_path())
+        except OSError:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp)
+
+    def retrieve_configuration(self, profile: str = None):
+        """
+        returns the application configuration updated with the user
+        configuration and, if given, with the overrides of `profile`. The
+        result is independent of `conf` and `user_conf`.
+        """
+        if profile in self._merged:
+            return self._merged.pop(profile)
+        conf = merge_config(self.conf, self.user_conf)
+        if profile is not None:
+            profiles = conf.get("Profiles") or {}
+            if profile not in profiles:
+                raise ValueError(f"Profile {profile} not found. Available profiles: {sorted(profiles)}")
+            conf = merge_config(conf, profiles[profile])
+        return conf
 
     def update_ssh_key_name(self, key_name: str):
         print(f"Updating ssh key name to {key_name}")
+        self._merged.clear()
         d = {"KeyName": key_name}
         self.user_conf["Ec2Instance"]["Properties"].update(d)
         return self
 
+    def update_image(self, image_id: str, user_data: str):
+        print(f"Updating image id to {image_id}")
+        self._merged.clear()
+        d = {"ImageId": image_id, "UserData": user_data}
+        self.user_conf.setdefault("Ec2Instance", {}).setdefault("Properties", {}).update(d)
+        return self
+
     def write_configuration(self):
+        self._merged.clear()
         ref = importlib_resources.files('eki_dev') / 'default_conf.yaml'
         with importlib_resources.as_file(ref) as data_path:
             with open(data_path, "w", encoding='utf8') as f:
                 yaml.dump(self.conf, f)
 
     def write_user_configuration(self):
+        self._merged.clear()
         path_config_dir = os.path.expanduser(self.path_config_dir)
         fn_config = os.path.join(path_config_dir, "config")
         with open(fn_config, "w", encoding='utf8') as f:
@@ -85,6 +213,7 @@ class Config:
                         DryRun: bool = False,
                         KeyFormat: str = 'pem'):
         path_ssh_config = os.path.expanduser(path_ssh_config)
+        from eki_dev.aws_service import AwsService
         client = AwsService.from_service('ec2')
         resp = client.client.create_key_pair(KeyName=name,
                                       DryRun=DryRun,
@@ -128,89 +257,99 @@ class Config:
             print("Please enter either 'y' or 'n'")
 
 
+def get_project_tags(bucket='eki-dev-machine-config', refresh: bool = False):
+    """
+    returns the list of project tags, from the local cache when it was
+    revalidated recently. `refresh` asks S3 whether the list changed.
+    """
+    from eki_dev import project_tags
+    tags, _ = project_tags.get_cache().tags(bucket, refresh=refresh)
+    return tags
 
 
+def check_project_tag(project_tag, bucket='eki-dev-machine-config'):
+    """Raises an exception if `project_tag` is not one of the configured project tags"""
+    from eki_dev import project_tags
+    cache = project_tags.get_cache()
+    lst_tags, revalidated = cache.tags(bucket)
+    if project_tag not in lst_tags and not revalidated:
+        # the tag may have been added since the list was cached
+        lst_tags, _ = cache.tags(bucket, refresh=True)
+    if project_tag not in lst_tags:
+        print(f"tag {project_tag} must be one of {lst_tags}")
+        raise Exception(f"tag {project_tag} must be one of {lst_tags}")
+    return project_tag
 
 
-# Show task progress (red for download, green for extract)
-def show_progress(line, progress, tasks):
-
-    if line['status'] == 'Downloading':
-        #id_ = f'[red][Download {line["id"]}]'
-        pprint(f'Downloading: {line["id"]}')
-        return
-    elif line['status'] == 'Extracting':
-        id_ = f'[green][Extract  {line["id"]}]'
-    else:
-        # skip other statuses
-        return
-
-    if id_ not in tasks.keys():
-        tasks[id_] = progress.add_task(f"{id_}", total=line['progressDetail']['total'])
-    #else:
-    progress.update(tasks[id_], completed=line['progressDetail']['current'])
-
-
-def get_project_tags(bucket='eki-dev-machine-config'):
-    s3 = AwsService.from_service('s3')
-    response = s3.client.get_object(Bucket=bucket, Key='project_tags.txt')
-    data = response['Body'].read()
-    tags = data.decode('utf8').strip().split(',')
-    return tags
+def get_iam_user() -> dict:
+    """returns the IAM user ({'UserName', 'UserId', ...}) of the current credentials"""
+    from eki_dev.aws_service import AwsService
+    iam_service = AwsService.from_service('iam')
+    return iam_service.client.get_user()['User']
 
 
 def add_instance_tags(project_tag,
+                      iam_user=None,
                       **instance_params):
     # add user user id, and project tags
-    # retrieve user name
-    iam_service = AwsService.from_service('iam')
-    user_name = iam_service.client.get_user()['User']['UserName']
-    tag = {
-        'Key': 'user',
-        'Value': user_name
-    }
-    # remove pre-existing user tag and append new tag
-    [instance_params['TagSpecifications'][0]['Tags'].remove(t) for t in instance_params['TagSpecifications'][0]['Tags'] if t['Key']=='user']
-    instance_params['TagSpecifications'][0]['Tags'].append(tag)
-
-    user_id = iam_service.client.get_user()['User']['UserId']
-    tag = {
-        'Key': 'user_id',
-        'Value': user_id
-    }
-    instance_params['TagSpecifications'][0]['Tags'].append(tag)
-
-    tag = {
-                    'Key': 'project',
-                    'Value': project_tag
-                }
-    instance_params['TagSpecifications'][0]['Tags'].append(tag)
-    return instance_params
+    # retrieve user name unless the caller already did
+    if iam_user is None:
+        iam_user = get_iam_user()
+    # a new tag list replacing any pre-existing user, user id and project tags,
+    # the caller's parameters are left untouched
+    spec = instance_params['TagSpecifications'][0]
+    tags = [t for t in spec['Tags'] if t['Key'] not in ('user', 'user_id', 'project')]
+    tags += [{'Key': 'user', 'Value': iam_user['UserName']},
+             {'Key': 'user_id', 'Value': iam_user['UserId']},
+             {'Key': 'project', 'Value': project_tag}]
+    specs = [dict(spec, Tags=tags)] + instance_params['TagSpecifications'][1:]
+    return dict(instance_params, TagSpecifications=specs)
 
 
 def register_instance(
         name : str,
         host_ip : str,
         CONFIG_DIR='.dev_machine',
+        instance_id: str = None,
+        project: str = None,
+        image: str = None,
               ) -> str:
-    HOME = os.path.expanduser("~")
-    dev_machine_dir = os.path.join(HOME, CONFIG_DIR)
-    Path(dev_machine_dir).mkdir(parents=False, exist_ok=True)
-    p = os.path.join(dev_machine_dir, name + "@" + host_ip)
-    Path(p).touch()
-    return p
+    """Records machine `name` in the local state store. Returns the store path"""
+    store = StateStore(CONFIG_DIR)
+    try:
+        store.upsert(name, host_ip, instance_id=instance_id, project=project, image=image)
+    finally:
+        store.close()
+    return store.path
 
 
 def deregister_instance(name : str,
                         host_ip : str,
                         CONFIG_DIR='.dev_machine')->str:
-    HOME = os.path.expanduser("~")
-    p = os.path.join(HOME, CONFIG_DIR, name + "@" + host_ip)
+    """Removes machine `name` at `host_ip` from the local state store. Returns the store path"""
+    store = StateStore(CONFIG_DIR)
     try:
-        os.remove(p)
-    except FileNotFoundError:
-        pass
-    return p
+        store.remove(name, host_ip)
+    finally:
+        store.close()
+    return store.path
+
+
+def run_edamame_in_background(args: list, log_name: str, profile: str = None,
+                              CONFIG_DIR='.dev_machine') -> subprocess.Popen:
+    """
+    Starts `edamame *args` as a detached process, with the configuration
+    `profile` of the caller if given. Output goes to ~/CONFIG_DIR/log_name
+    """
+    edamame = shutil.which("edamame") or os.path.abspath(sys.argv[0])
+    # --profile is an option of edamame itself, it goes before the command
+    args = (["--profile", profile] if profile else []) + list(args)
+    HOME = os.path.expanduser("~")
+    Path(os.path.join(HOME, CONFIG_DIR)).mkdir(parents=False, exist_ok=True)
+    with open(os.path.join(HOME, CONFIG_DIR, log_name), "a") as log:
+        return subprocess.Popen([sys.executable, edamame] + args,
+                                stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                                start_new_session=True)
 
 
 def ssh_splitter(ssh_connect_string):
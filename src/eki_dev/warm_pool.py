@@ -0,0 +1,237 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from eki_dev import describe_cache, tracing
+from eki_dev.aws_service import AwsService
+from eki_dev.docker_utils import login_into_ecr, ecr_auth_config
+from eki_dev.pull_progress import pull_image
+from eki_dev.readiness import wait_until_ready, default_probes
+from eki_dev.storage import with_storage_profile, PER_BOOT_SCRIPT as STORAGE_SCRIPT
+from eki_dev.ssh_transport import get_docker_client, run_command
+from eki_dev.utils import get_iam_user, run_edamame_in_background
+
+# Warm pool instances are tagged `warm_pool=<instance type>` and carry their
+# pool state in `warm_pool_state`: `provisioning` while being bootstrapped and
+# `ready` once stopped with the explorer image pulled. `warm_pool_storage` is
+# the storage profile mounted at their boot.
+POOL_TAG = "warm_pool"
+STATE_TAG = "warm_pool_state"
+STORAGE_TAG = "warm_pool_storage"
+
+PER_BOOT_SCRIPT = "/var/lib/cloud/scripts/per-boot/edamame-mounts.sh"
+
+# seconds a claim may take between StartInstances and the retagging
+CLAIM_GRACE = 300
+
+
+def _storage_tag(profile: str = None) -> str:
+    # without a profile the UserData mounts EFS only, like the `efs` profile
+    return profile or "efs"
+
+
+def _pool_filters(instance_type: str = None, pool_states=None, instance_states=None, storage: str = None) -> list:
+    filters = [{"Name": "tag-key", "Values": [POOL_TAG]}]
+    if instance_type is not None:
+        filters.append({"Name": f"tag:{POOL_TAG}", "Values": [instance_type]})
+    if storage is not None:
+        filters.append({"Name": f"tag:{STORAGE_TAG}", "Values": [storage]})
+    if pool_states is not None:
+        filters.append({"Name": f"tag:{STATE_TAG}", "Values": list(pool_states)})
+    if instance_states is not None:
+        filters.append({"Name": "instance-state-name", "Values": list(instance_states)})
+    return filters
+
+
+def list_warm_instances(instance_type: str = None,
+                        pool_states=("provisioning", "ready"),
+                        instance_states=("pending", "running", "stopping", "stopped"),
+                        storage: str = None) -> list:
+    """returns the DescribeInstances records of the pool instances, of the `storage` tag if given"""
+    svc = AwsService.from_service("ec2")
+    paginator = svc.client.get_paginator("describe_instances")
+    filters = _pool_filters(instance_type, pool_states, instance_states, storage)
+    return [inst
+            for page in paginator.paginate(Filters=filters)
+            for reservation in page["Reservations"]
+            for inst in reservation["Instances"]]
+
+
+def _tag_value(inst: dict, key: str) -> str:
+    return next((t["Value"] for t in inst.get("Tags", []) if t["Key"] == key), None)
+
+
+def display_warm_pool(indent=1):
+    ind = "\t" * indent
+    instances = list_warm_instances()
+    print(f"Warm pool: {len(instances)} instances")
+    for inst in instances:
+        print(f"{ind}{inst['InstanceId']:<22}{_tag_value(inst, POOL_TAG):<14}"
+              f"{_tag_value(inst, STORAGE_TAG) or '-':<14}{_tag_value(inst, STATE_TAG):<14}{inst['State']['Name']}")
+
+
+def claim_warm_instance(instance_type: str, project_tag: str, iam_user: dict = None, storage: str = None):
+    """
+    Claims a stopped, ready instance of `instance_type` from the pool, starts it
+    and retags it for the current user and `project_tag`. Only instances
+    provisioned with the `storage` profile are claimed: the container volumes
+    expect its mounts.
+
+    The claim is the StartInstances call itself: only the caller that sees the
+    instance go from `stopped` to `pending` owns it, so concurrent claims never
+    hand out the same instance.
+
+    Returns:
+        The ec2.Instance, still pending, or None if the pool is empty.
+    """
+    svc = AwsService.from_service("ec2")
+    for inst in list_warm_instances(instance_type, pool_states=("ready",), instance_states=("stopped",),
+                                    storage=_storage_tag(storage)):
+        instance_id = inst["InstanceId"]
+        resp = svc.client.start_instances(InstanceIds=[instance_id])
+        if resp["StartingInstances"][0]["PreviousState"]["Name"] != "stopped":
+            continue
+
+        describe_cache.invalidate()
+        print(f"Claimed warm instance {instance_id}")
+        iam_user = iam_user or get_iam_user()
+        svc.client.create_tags(Resources=[instance_id],
+                               Tags=[{"Key": "user", "Value": iam_user["UserName"]},
+                                     {"Key": "user_id", "Value": iam_user["UserId"]},
+                                     {"Key": "project", "Value": project_tag}])
+        svc.client.delete_tags(Resources=[instance_id],
+                               Tags=[{"Key": POOL_TAG}, {"Key": STATE_TAG}, {"Key": STORAGE_TAG}])
+        return svc.resource.Instance(instance_id)
+    return None
+
+
+def sweep_abandoned_claims(instance_type: str = None, grace: float = CLAIM_GRACE) -> list:
+    """
+    Stops the pool instances still tagged `ready` but started more than `grace`
+    seconds ago: their claim died between StartInstances and the retagging, and
+    nobody owns them. Stopped, they are back in the pool.
+
+    Returns:
+        The ids of the stopped instances.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    instance_ids = [inst["InstanceId"]
+                    for inst in list_warm_instances(instance_type, pool_states=("ready",),
+                                                    instance_states=("pending", "running"))
+                    if (now - inst["LaunchTime"]).total_seconds() > grace]
+    if instance_ids:
+        AwsService.from_service("ec2").client.stop_instances(InstanceIds=instance_ids)
+        describe_cache.invalidate()
+        print(f"Returned abandoned warm instances {instance_ids} to the pool")
+    return instance_ids
+
+
+def _per_boot_mounts(user_data: str) -> str:
+    """
+    returns a script with the mount commands of `user_data`. UserData only runs
+    on the first boot, so pool instances rerun their mounts on every start.
+    None if `user_data` installs the per-boot script of a storage profile.
+    """
+    if STORAGE_SCRIPT in (user_data or ""):
+        return None
+    lines = [line for line in (user_data or "").splitlines()
+             if line.strip().startswith(("sudo mount", "mount "))]
+    return "\n".join(["#!/bin/sh"] + lines) + "\n"
+
+
+def _prepare_instance(instance_id: str, host: str, registry: str, container: str, user_data: str,
+                      user: str = "ubuntu", readiness_deadline: float = 900):
+    """Waits for the bootstrap, pulls `container` and installs the per-boot mount script"""
+    wait_until_ready(default_probes(user, host), deadline=readiness_deadline).display()
+
+    script = _per_boot_mounts(user_data)
+    if script is not None:
+        run_command(user, host, f"sudo tee {PER_BOOT_SCRIPT} > /dev/null << 'EOF'\n{script}EOF\n"
+                                f"sudo chmod 755 {PER_BOOT_SCRIPT}")
+
+    c_name, c_tag = container.split(':')
+    docker_client = login_into_ecr(registry, docker_client=get_docker_client(user, host))
+    print(f"Pulling {registry}/{container} into warm instance {instance_id}")
+    pull_image(docker_client, f"{registry}/{c_name}", c_tag, auth_config=ecr_auth_config(registry), mode="quiet")
+
+
+def refill_pool(instance_type: str,
+                size: int = 1,
+                container: str = "data_explorer:prod",
+                max_workers: int = 8,
+                storage: str = None,
+                **instance_params) -> list:
+    """
+    Tops the pool of `instance_type` and `storage` profile up to `size`
+    instances: launches the missing ones in one request, bootstraps them with
+    the storage profile, pulls `container` and stops them. Abandoned claims
+    are swept back into the pool first.
+
+    Returns:
+        The ids of the instances added to the pool.
+    """
+    sweep_abandoned_claims(instance_type)
+    missing = size - len(list_warm_instances(instance_type, storage=_storage_tag(storage)))
+    if missing <= 0:
+        print(f"Warm pool for {instance_type} ({_storage_tag(storage)}) is full")
+        return []
+
+    svc = AwsService.from_service("ec2")
+    registry = f"{svc.get_account_id()}.dkr.ecr.{svc.get_region()}.amazonaws.com"
+    instance_params["InstanceType"] = instance_type
+    instance_params["IamInstanceProfile"] = {"Name": "AccessECR"}
+    instance_params = with_storage_profile(storage, **instance_params)
+    # no user tags until claimed: the instances of a user are selected by them,
+    # e.g. by `edamame list` and `edamame remove --all`
+    spec = instance_params["TagSpecifications"][0]
+    tags = [t for t in spec["Tags"] if t["Key"] not in ("user", "user_id", "project")]
+    tags += [{"Key": "project", "Value": "warm_pool"},
+             {"Key": POOL_TAG, "Value": instance_type},
+             {"Key": STATE_TAG, "Value": "provisioning"},
+             {"Key": STORAGE_TAG, "Value": _storage_tag(storage)}]
+    instance_params["TagSpecifications"] = [dict(spec, Tags=tags)] + instance_params["TagSpecifications"][1:]
+
+    print(f"Adding {missing} {instance_type} instances to the warm pool")
+    instances = svc.resource.create_instances(**instance_params, MinCount=missing, MaxCount=missing)
+    describe_cache.invalidate()
+    instance_ids = [i.id for i in instances]
+    try:
+        svc.client.get_waiter("instance_running").wait(InstanceIds=instance_ids)
+        for i in instances:
+            i.reload()
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            list(pool.map(tracing.run_in_context(
+                lambda i: _prepare_instance(i.id, i.public_ip_address, registry, container,
+                                            instance_params.get("UserData"))),
+                instances))
+        svc.client.stop_instances(InstanceIds=instance_ids)
+        svc.client.get_waiter("instance_stopped").wait(InstanceIds=instance_ids)
+        svc.client.create_tags(Resources=instance_ids, Tags=[{"Key": STATE_TAG, "Value": "ready"}])
+    except Exception as e:
+        print(f"Could not prepare warm instances {instance_ids}. Here is why:")
+        print(e)
+        svc.client.terminate_instances(InstanceIds=instance_ids)
+        raise
+    return instance_ids
+
+
+def refill_in_background(instance_type: str, size: int = 1, storage: str = None, profile: str = None,
+                         CONFIG_DIR='.dev_machine'):
+    """
+    Starts `edamame warm-pool refill` as a detached process with the
+    configuration `profile`. Output goes to ~/CONFIG_DIR/warm_pool.log
+    """
+    args = ["warm-pool", "refill", "--instance_type", instance_type, "--size", str(size),
+            "--storage", _storage_tag(storage)]
+    proc = run_edamame_in_background(args, "warm_pool.log", profile=profile, CONFIG_DIR=CONFIG_DIR)
+    print(f"Refilling the {instance_type} warm pool in the background (pid {proc.pid})")
+    return proc
+
+
+def drain_pool(instance_type: str = None) -> list:
+    """Terminates the pool instances of `instance_type`, or of every type"""
+    instance_ids = [i["InstanceId"] for i in list_warm_instances(instance_type)]
+    if instance_ids:
+        AwsService.from_service("ec2").client.terminate_instances(InstanceIds=instance_ids)
+        describe_cache.invalidate()
+        print(f"Terminated warm instances {instance_ids}")
+    return instance_ids
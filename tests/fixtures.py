@@ -6,26 +6,41 @@ import yaml
 
 from moto import mock_aws
 
-from eki_dev.aws_service import AwsService
+from eki_dev.aws_service import AwsService, reset_pool
+from eki_dev import describe_cache
+from eki_dev import project_tags
 
 
 @pytest.fixture(scope="function")
-def aws_credentials():
+def aws_credentials(monkeypatch, tmp_path):
     """
-    Fixture to set AWS credentials for testing purposes.
+    Fixture to set AWS credentials for testing purposes. The home directory is
+    moved to `tmp_path` first, so the caches, state and locks written under
+    `~/.dev_machine` never touch the real one.
 
     Args:
-        None
+        monkeypatch: pytest monkeypatch fixture.
+        tmp_path: pytest tmp_path fixture.
 
     Returns:
         None
     """
 
+    home = tmp_path / "home"
+    home.mkdir()
+    monkeypatch.setenv("HOME", str(home))
     os.environ["AWS_ACCESS_KEY_ID"] = "testing"
     os.environ["AWS_SECRET_ACCESS_ID"] = "testing"
     os.environ["AWS_SECURITY_TOKEN"] = "testing"
     os.environ["AWS_SESSION_TOKEN"] = "testing"
     os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    reset_pool()
+    # drop the process-wide caches without clearing them: one built under the
+    # real home would delete the files of the real ~/.dev_machine
+    describe_cache.configure()
+    project_tags.configure()
+    describe_cache.reset_cache()
+    project_tags.reset_cache()
 
 
 @pytest.fixture(scope="function")
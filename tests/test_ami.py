@@ -0,0 +1,63 @@
+import boto3
+from moto import mock_aws
+
+from eki_dev.ami import ami_name, bake_ami, list_amis
+from eki_dev.utils import Config
+
+from fixtures import aws_credentials
+
+
+def test_ami_name():
+    assert ami_name("edamame", "v2") == "edamame-v2"
+    assert ami_name("edamame").startswith("edamame-20")
+
+
+@mock_aws
+def test_bake_ami(aws_credentials, mocker):
+    ready = mocker.patch("eki_dev.ami.wait_until_ready")
+    run_command = mocker.patch("eki_dev.ami.run_command", return_value=(0, b"", b""))
+    pull = mocker.patch("eki_dev.ami._pull_images")
+    boto3.client("iam").create_instance_profile(InstanceProfileName="AccessECR")
+
+    image_id = bake_ami(name="edamame", version="v1", images=["data_explorer:prod"],
+                        ImageId="ami-12345678", InstanceType="t2.micro", UserData="#!/bin/sh\n")
+
+    ready.assert_called_once()
+    pull.assert_called_once()
+    assert pull.call_args.args[2] == ["data_explorer:prod"]
+    run_command.assert_called_once()
+
+    images = list_amis("edamame")
+    assert [i["ImageId"] for i in images] == [image_id]
+    assert images[0]["Name"] == "edamame-v1"
+    tags = {t["Key"]: t["Value"] for t in images[0]["Tags"]}
+    assert tags["edamame:version"] == "v1"
+    assert tags["edamame:source-ami"] == "ami-12345678"
+
+    reservations = boto3.client("ec2").describe_instances()["Reservations"]
+    assert [i["State"]["Name"] for r in reservations for i in r["Instances"]] in (["shutting-down"], ["terminated"])
+
+
+@mock_aws
+def test_bake_ami_terminates_builder_on_failure(aws_credentials, mocker):
+    mocker.patch("eki_dev.ami.wait_until_ready", side_effect=TimeoutError("cloud-init not ready"))
+
+    try:
+        bake_ami(name="edamame", ImageId="ami-12345678", InstanceType="t2.micro")
+        assert False, "bake_ami should have failed"
+    except TimeoutError:
+        pass
+
+    reservations = boto3.client("ec2").describe_instances()["Reservations"]
+    assert [i["State"]["Name"] for r in reservations for i in r["Instances"]] in (["shutting-down"], ["terminated"])
+    assert list_amis("edamame") == []
+
+
+def test_update_image(tmp_path):
+    config = Config(path_config_dir=str(tmp_path))
+    config.update_image("ami-0abc", "#!/bin/sh\nsudo mount /efs").write_user_configuration()
+
+    conf = Config(path_config_dir=str(tmp_path)).retrieve_configuration()
+    assert conf["Ec2Instance"]["Properties"]["ImageId"] == "ami-0abc"
+    assert conf["Ec2Instance"]["Properties"]["UserData"] == "#!/bin/sh\nsudo mount /efs"
+    assert conf["Ec2Instance"]["Properties"]["KeyName"] == "id_rsa"
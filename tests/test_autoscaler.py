@@ -0,0 +1,154 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from aws_cluster.autoscaler import Autoscaler, ScalingPolicy, SchedulerAPI
+from eki_dev.state import StateStore
+
+
+class FakeScheduler(BaseHTTPRequestHandler):
+    """serves the dask scheduler API routes used by the autoscaler"""
+    target = 0
+    workers = []
+    retired = []
+
+    def _reply(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/api/v1/adaptive_target":
+            self._reply({"workers": self.target})
+        elif self.path == "/api/v1/get_workers":
+            self._reply({"num_workers": len(self.workers), "workers": self.workers})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        retired = FakeScheduler.workers[:body["n"]]
+        FakeScheduler.workers = FakeScheduler.workers[body["n"]:]
+        FakeScheduler.retired.append(body)
+        self._reply({w["address"]: {"name": w["name"]} for w in retired})
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def scheduler():
+    FakeScheduler.target = 0
+    FakeScheduler.workers = [{"name": f"c-worker-{i}", "address": f"tcp://10.0.0.{i}:4000"} for i in range(3)]
+    FakeScheduler.retired = []
+    server = HTTPServer(("127.0.0.1", 0), FakeScheduler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield SchedulerAPI(f"http://127.0.0.1:{server.server_port}")
+    server.shutdown()
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_policy_bounds_and_cooldowns():
+    policy = ScalingPolicy(min_workers=1, max_workers=5, scale_up_cooldown=60, scale_down_cooldown=300)
+
+    assert policy.decide(target=0, current=0, now=0) == (1, "target 0")
+    assert policy.decide(target=20, current=2, now=0) == (3, "target 20")
+    assert policy.decide(target=3, current=3, now=0) == (0, "at target")
+
+    policy.record(3, now=0)
+    assert policy.decide(target=20, current=3, now=30) == (0, "scale up cooldown")
+    assert policy.decide(target=20, current=3, now=60)[0] == 2
+    # no scale down right after a burst
+    assert policy.decide(target=0, current=5, now=200) == (0, "scale down cooldown")
+    assert policy.decide(target=0, current=5, now=300) == (-4, "target 0")
+
+
+def test_policy_max_scale_up():
+    policy = ScalingPolicy(max_workers=100, max_scale_up=10)
+    assert policy.decide(target=50, current=0, now=0)[0] == 10
+
+
+def test_policy_invalid_bounds():
+    with pytest.raises(ValueError):
+        ScalingPolicy(min_workers=3, max_workers=2)
+
+
+def test_scheduler_api(scheduler):
+    FakeScheduler.target = 7
+    assert scheduler.adaptive_target() == 7
+    assert [w["name"] for w in scheduler.workers()] == ["c-worker-0", "c-worker-1", "c-worker-2"]
+    assert scheduler.retire_workers(1) == {"tcp://10.0.0.0:4000": {"name": "c-worker-0"}}
+
+
+def _read_log(autoscaler):
+    with open(autoscaler.log_path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_step_scale_up(scheduler, tmp_path, mocker):
+    add_workers = mocker.patch("aws_cluster.autoscaler.add_workers")
+    mocker.patch("aws_cluster.autoscaler.find_scheduler_address", return_value="tcp://10.0.0.100:8786")
+    FakeScheduler.target = 5
+    autoscaler = Autoscaler("c", "dev", scheduler, ScalingPolicy(max_workers=4), CONFIG_DIR=str(tmp_path),
+                            clock=Clock(), InstanceType="t3.large")
+
+    record = autoscaler.step()
+
+    assert record["action"] == "up"
+    assert record["change"] == 1
+    add_workers.assert_called_once_with("c", 1, "dev", container="data_explorer:prod",
+                                        scheduler_address="tcp://10.0.0.100:8786", InstanceType="t3.large")
+    assert _read_log(autoscaler)[0]["workers"] == 3
+
+    assert autoscaler.step()["reason"] == "scale up cooldown"
+
+
+def test_step_scale_down(scheduler, tmp_path, mocker):
+    terminate = mocker.patch("aws_cluster.autoscaler.terminate_instances", side_effect=lambda ids: ids)
+    store = StateStore(CONFIG_DIR=str(tmp_path))
+    for i in range(3):
+        store.upsert(f"c-worker-{i}", f"1.2.3.{i}", instance_id=f"i-{i}")
+    store.close()
+    autoscaler = Autoscaler("c", "dev", scheduler, ScalingPolicy(min_workers=1), CONFIG_DIR=str(tmp_path),
+                            clock=Clock())
+
+    record = autoscaler.step()
+
+    assert record["action"] == "down"
+    assert FakeScheduler.retired == [{"n": 2}]
+    terminate.assert_called_once_with(["i-0", "i-1"])
+    assert record["terminated"] == ["i-0", "i-1"]
+
+
+def test_step_error_is_logged(tmp_path):
+    autoscaler = Autoscaler("c", "dev", SchedulerAPI("http://127.0.0.1:9", timeout=1), ScalingPolicy(),
+                            CONFIG_DIR=str(tmp_path), clock=Clock())
+
+    record = autoscaler.step()
+
+    assert record["action"] == "error"
+    assert _read_log(autoscaler)[0]["action"] == "error"
+
+
+def test_run_sleeps_between_steps(scheduler, tmp_path, mocker):
+    sleep = mocker.Mock()
+    FakeScheduler.target = 3
+    autoscaler = Autoscaler("c", "dev", scheduler, ScalingPolicy(), CONFIG_DIR=str(tmp_path), clock=Clock())
+
+    autoscaler.run(interval=15, steps=3, sleep=sleep)
+
+    assert [c.args[0] for c in sleep.call_args_list] == [15, 15]
+    assert len(_read_log(autoscaler)) == 3
@@ -0,0 +1,49 @@
+from moto import mock_aws
+
+from eki_dev.aws_service import AwsService, reset_pool
+
+from fixtures import aws_credentials
+
+
+@mock_aws
+def test_aws_service_is_pooled(aws_credentials):
+    service = AwsService.from_service("ec2")
+    assert AwsService.from_service("ec2") is service
+    assert AwsService.from_service("s3") is not service
+    assert AwsService.from_service("ec2", region="eu-west-1") is not service
+
+
+@mock_aws
+def test_aws_service_lazy_identity(aws_credentials, mocker, tmp_path):
+    mocker.patch("eki_dev.aws_service.CONFIG_DIR", str(tmp_path))
+    service = AwsService.from_service("s3")
+    sts = AwsService.from_service("sts")
+    spy = mocker.spy(sts.client, "get_caller_identity")
+    assert spy.call_count == 0
+
+    account_id = service.get_account_id()
+    assert AwsService.from_service("ec2").get_account_id() == account_id
+    assert spy.call_count == 1
+
+
+@mock_aws
+def test_aws_service_lazy_ecr_authorization(aws_credentials, mocker):
+    ecr = AwsService.from_service("ecr")
+    spy = mocker.spy(ecr.client, "get_authorization_token")
+    service = AwsService.from_service("ec2")
+    assert spy.call_count == 0
+
+    token = service.get_ecr_authorization()
+    assert token == AwsService.from_service("s3").get_ecr_authorization()
+    assert spy.call_count == 1
+
+
+@mock_aws
+def test_aws_service_account_id_cached_on_disk(aws_credentials, mocker, tmp_path):
+    mocker.patch("eki_dev.aws_service.CONFIG_DIR", str(tmp_path))
+    account_id = AwsService.from_service("ec2").get_account_id()
+
+    reset_pool()
+    spy = mocker.spy(AwsService.from_service("sts").client, "get_caller_identity")
+    assert AwsService.from_service("ec2").get_account_id() == account_id
+    assert spy.call_count == 0
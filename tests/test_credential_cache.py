@@ -0,0 +1,53 @@
+import os
+import stat
+import time
+import multiprocessing
+
+from eki_dev.credential_cache import CredentialCache
+
+
+def _put_tokens(config_dir, n):
+    cache = CredentialCache(CONFIG_DIR=config_dir)
+    for i in range(n):
+        cache.put_ecr_token(str(os.getpid()), f"region-{i}", "token", time.time() + 43200)
+
+
+def test_ecr_token_roundtrip(tmp_path):
+    cache = CredentialCache(CONFIG_DIR=str(tmp_path / "cfg"))
+    assert cache.get_ecr_token("123456", "us-west-1") is None
+
+    cache.put_ecr_token("123456", "us-west-1", "abc", time.time() + 43200)
+    entry = cache.get_ecr_token("123456", "us-west-1")
+    assert entry["token"] == "abc"
+    assert entry["verified"] is False
+    assert cache.get_ecr_token("123456", "us-east-1") is None
+
+    cache.mark_ecr_token_verified("123456", "us-west-1", "abc")
+    assert cache.get_ecr_token("123456", "us-west-1")["verified"] is True
+
+
+def test_ecr_token_refreshed_ahead_of_expiry(tmp_path):
+    cache = CredentialCache(CONFIG_DIR=str(tmp_path), refresh_margin=600)
+    cache.put_ecr_token("123456", "us-west-1", "abc", time.time() + 300)
+    assert cache.get_ecr_token("123456", "us-west-1") is None
+
+
+def test_cache_permissions(tmp_path):
+    config_dir = tmp_path / "cfg"
+    cache = CredentialCache(CONFIG_DIR=str(config_dir))
+    cache.put_account_id(cache.fingerprint("AKIA"), "123456")
+
+    assert cache.get_account_id(cache.fingerprint("AKIA")) == "123456"
+    assert stat.S_IMODE(os.stat(cache.path).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(config_dir).st_mode) == 0o700
+
+
+def test_concurrent_writers(tmp_path):
+    procs = [multiprocessing.Process(target=_put_tokens, args=(str(tmp_path), 10)) for _ in range(4)]
+    [p.start() for p in procs]
+    [p.join() for p in procs]
+
+    cache = CredentialCache(CONFIG_DIR=str(tmp_path))
+    for p in procs:
+        for i in range(10):
+            assert cache.get_ecr_token(str(p.pid), f"region-{i}") is not None
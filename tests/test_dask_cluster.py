@@ -0,0 +1,110 @@
+import json
+
+import boto3
+import docker
+import pytest
+from moto import mock_aws
+
+from aws_cluster.dask_cluster import add_workers, create_cluster, delete_cluster, worker_resources
+
+from fixtures import (
+    aws_credentials,
+    ec2_config,
+    aws_s3,
+    create_test_bucket,
+    bucket_with_project_tags
+)
+
+
+def _states():
+    return sorted(i["State"]["Name"]
+                  for r in boto3.client("ec2").describe_instances()["Reservations"] for i in r["Instances"])
+
+
+def _contexts():
+    return {ctx.Name for ctx in docker.ContextAPI.contexts()}
+
+
+@mock_aws
+def test_worker_resources(aws_credentials):
+    resources = worker_resources("t3.large")
+    assert resources["nthreads"] == 2
+    assert resources["memory_limit"] == int(8192 * 2 ** 20 * 0.9)
+
+
+@mock_aws
+def test_create_and_delete_cluster(aws_credentials, ec2_config, bucket_with_project_tags, mocker):
+    boto3.client("iam").create_instance_profile(InstanceProfileName="AccessECR")
+    start = mocker.patch("aws_cluster.dask_cluster._start_dask_container")
+    jupyter = mocker.patch("aws_cluster.dask_cluster._run_jupyter_notebook")
+    mocker.patch("aws_cluster.dask_cluster.ssh_tunnel", return_value="ssh -f -N ...")
+
+    cluster = create_cluster(name="test_cluster",
+                             workers=2,
+                             project_tag="dev",
+                             worker_type="t3.large",
+                             **json.loads(ec2_config)["Ec2Instance"]["Properties"])
+    try:
+        assert len(cluster.instance_ids) == 3
+        assert {"test_cluster-scheduler-0", "test_cluster-worker-0", "test_cluster-worker-1"} <= _contexts()
+
+        commands = sorted(c.args[3] for c in start.call_args_list)
+        assert commands[0].startswith("dask scheduler --port 8786")
+        for command in commands[1:]:
+            assert command.startswith(f"dask worker {cluster.scheduler_address}")
+            assert "--nthreads 2" in command
+        assert jupyter.call_args.kwargs["environment"] == {"DASK_SCHEDULER_ADDRESS": cluster.scheduler_address}
+        assert jupyter.call_args.kwargs["dask_port"] is None
+
+        workers = boto3.client("ec2").describe_instances(InstanceIds=cluster.workers.instance_ids)
+        for inst in workers["Reservations"][0]["Instances"]:
+            assert inst["InstanceType"] == "t3.large"
+            assert {"Key": "cluster", "Value": "test_cluster"} in inst["Tags"]
+            assert {"Key": "fleet", "Value": "test_cluster-worker"} in inst["Tags"]
+    finally:
+        terminated = delete_cluster("test_cluster")
+
+    assert sorted(terminated) == sorted(cluster.instance_ids)
+    assert _states() == ["terminated"] * 3
+    assert not {"test_cluster-scheduler-0", "test_cluster-worker-0", "test_cluster-worker-1"} & _contexts()
+
+
+@mock_aws
+def test_create_cluster_terminates_on_failure(aws_credentials, ec2_config, bucket_with_project_tags, mocker):
+    boto3.client("iam").create_instance_profile(InstanceProfileName="AccessECR")
+    mocker.patch("aws_cluster.dask_cluster._start_dask_container", side_effect=RuntimeError("no docker"))
+    mocker.patch("aws_cluster.dask_cluster._run_jupyter_notebook")
+
+    with pytest.raises(RuntimeError):
+        create_cluster(name="test_cluster",
+                       workers=2,
+                       project_tag="dev",
+                       worker_type="t3.large",
+                       **json.loads(ec2_config)["Ec2Instance"]["Properties"])
+
+    assert _states() == ["terminated"] * 3
+    assert not {"test_cluster-scheduler-0", "test_cluster-worker-0", "test_cluster-worker-1"} & _contexts()
+
+
+@mock_aws
+def test_add_workers(aws_credentials, ec2_config, bucket_with_project_tags, mocker):
+    boto3.client("iam").create_instance_profile(InstanceProfileName="AccessECR")
+    start = mocker.patch("aws_cluster.dask_cluster._start_dask_container")
+    mocker.patch("aws_cluster.dask_cluster.get_ecr_credentials")
+    conf = json.loads(ec2_config)["Ec2Instance"]["Properties"]
+    conf["InstanceType"] = "t3.large"
+
+    fleet = add_workers("test_cluster", 2, "dev", scheduler_address="tcp://10.0.0.1:8786", **conf)
+    try:
+        assert len(fleet) == 2
+        assert fleet.name.startswith("test_cluster-worker-")
+        assert all(c.args[3].startswith("dask worker tcp://10.0.0.1:8786") for c in start.call_args_list)
+        assert start.call_count == 2
+    finally:
+        delete_cluster("test_cluster")
+    assert _states() == ["terminated"] * 2
+
+
+def test_delete_unknown_cluster(aws_credentials):
+    with mock_aws():
+        assert delete_cluster("nothing") == []
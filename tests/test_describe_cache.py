@@ -0,0 +1,92 @@
+import os
+import datetime
+
+import boto3
+from moto import mock_aws
+
+from eki_dev import describe_cache
+from eki_dev.aws_service import AwsService, reset_pool
+from eki_dev.describe_cache import DescribeCache
+from eki_dev.dev_machine import list_instances, terminate_instances
+
+from fixtures import aws_credentials
+
+
+def _config_dir(tmp_path):
+    return os.path.relpath(tmp_path, os.path.expanduser("~"))
+
+
+def _age(cache, key, seconds):
+    cache._memory[key]["stored_at"] -= seconds
+
+
+def _count_describe_instances() -> list:
+    calls = []
+    AwsService.from_service("ec2").client.meta.events.register(
+        "before-call.ec2.DescribeInstances", lambda **kwargs: calls.append(kwargs["params"]))
+    return calls
+
+
+@mock_aws
+def test_lookup_fresh_stale_and_expired(aws_credentials, tmp_path):
+    cache = DescribeCache(_config_dir(tmp_path), ttl=10, stale_ttl=100, persist=False)
+    key = cache.key("DescribeInstances", {"Filters": []})
+    assert cache.lookup(key) is None
+
+    cache.store(key, ["old"])
+    assert cache.lookup(key, refresh=lambda: ["new"]) == ["old"]
+
+    # stale: served while refreshed in the background
+    _age(cache, key, 50)
+    assert cache.lookup(key, refresh=lambda: ["new"]) == ["old"]
+    cache.wait()
+    assert cache.lookup(key) == ["new"]
+
+    _age(cache, key, 50)
+    assert cache.lookup(key, refresh=lambda: ["newer"], allow_stale=False) is None
+
+    _age(cache, key, 500)
+    assert cache.lookup(key, refresh=lambda: ["newer"]) is None
+
+
+@mock_aws
+def test_disk_copy_is_shared(aws_credentials, tmp_path):
+    launched = datetime.datetime(2024, 5, 1, 12, tzinfo=datetime.timezone.utc)
+    cache = DescribeCache(_config_dir(tmp_path))
+    key = cache.key("DescribeInstances", {"Filters": [{"Name": "tag:user", "Values": ["alice"]}]})
+    cache.store(key, [{"InstanceId": "i-1", "LaunchTime": launched}])
+
+    other = DescribeCache(_config_dir(tmp_path))
+    assert other.lookup(key) == [{"InstanceId": "i-1", "LaunchTime": launched}]
+
+    other.invalidate("DescribeInstances")
+    assert DescribeCache(_config_dir(tmp_path)).lookup(key) is None
+
+
+@mock_aws
+def test_key_depends_on_credentials(aws_credentials, monkeypatch):
+    params = {"Filters": []}
+    key = DescribeCache.key("DescribeInstances", params)
+    assert DescribeCache.key("DescribeInstances", params) == key
+
+    # same region and profile, credentials of another account
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "other")
+    reset_pool()
+    assert DescribeCache.key("DescribeInstances", params) != key
+
+
+@mock_aws
+def test_listing_is_cached_and_invalidated(aws_credentials, tmp_path):
+    describe_cache.configure(CONFIG_DIR=_config_dir(tmp_path))
+    ec2 = boto3.client("ec2")
+    instance_id = ec2.run_instances(ImageId="ami-12345678", MinCount=1, MaxCount=1)["Instances"][0]["InstanceId"]
+    calls = _count_describe_instances()
+
+    assert len(list_instances(output="json")) == 1
+    assert len(list_instances(output="json")) == 1
+    assert len(calls) == 1
+    assert len(list_instances(output="json", fresh=True)) == 1
+    assert len(calls) == 2
+
+    terminate_instances([instance_id])
+    assert list_instances(output="json") == []
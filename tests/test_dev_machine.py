@@ -1,4 +1,7 @@
 import os.path
+import shutil
+
+import pytest
 
 import boto3
 import json
@@ -11,8 +14,9 @@ from eki_dev.aws_service import AwsService
 from eki_dev.dev_machine import (
     create_ec2_instance,
     list_instances,
-    _get_lst_instances,
+    iter_instances,
     terminate_instance,
+    terminate_instances,
     create_instance_pull_start_server,
     _run_jupyter_notebook,
     clean_dangling_contexts
@@ -27,6 +31,7 @@ bucket_with_project_tags
 )
 
 from eki_dev.utils import register_instance, deregister_instance
+from eki_dev.state import StateStore
 
 # @pytest.mark.parametrize("clean_docker_context", "test_instance")
 @mock_aws
@@ -67,6 +72,8 @@ def test__run_jupyter_notebook(aws_credentials, ec2_config,bucket_with_project_t
     m = mocker.patch('subprocess.Popen')
     m.return_value.returncode = 0
     m.return_value.communicate.side_effect = [(" ", "command not found"), ("docker v23.test", "127")]
+    mocker.patch('eki_dev.dev_machine.wait_until_ready')
+    mocker.patch('eki_dev.dev_machine.get_docker_client')
 
     instance = create_ec2_instance(name='test_instance',
                                    project_tag='dev',
@@ -98,6 +105,9 @@ def test_create_instance_pull_start_server(aws_credentials, ec2_config,bucket_wi
 
     mrun = mocker.patch('subprocess.run')
     mrun.return_value.returncode = 0
+    mocker.patch('eki_dev.dev_machine.wait_until_ready')
+    mdocker = mocker.patch('eki_dev.dev_machine.get_docker_client')
+    mdocker.return_value.containers.run.return_value.logs.return_value = iter([b"http://127.0.0.1:8888/lab?token=abc123\n"])
 
     iam = boto3.client("iam")
     conf = json.loads(ec2_config)["Ec2Instance"]["Properties"]
@@ -127,7 +137,7 @@ def test_list_instances(aws_credentials, ec2_config,bucket_with_project_tags):
         project_tag='test_project',
         **json.loads(ec2_config)["Ec2Instance"]["Properties"]
     )
-    lst_inst = _get_lst_instances()
+    lst_inst = boto3.resource("ec2").instances
     list_instances()
     assert len(list(lst_inst.all())) == 3
 
@@ -135,56 +145,91 @@ def test_list_instances(aws_credentials, ec2_config,bucket_with_project_tags):
         terminate_instance(instance.id)
 
 
-@mock_aws
-def test_clean_dangling_contexts_no_instances_running(aws_credentials, ec2_config):
-    name = "test_instance"
-    host_ip = "10.10.10.10"
-
-    register_instance(name, host_ip)
+def _count_describe_instances() -> list:
+    calls = []
+    AwsService.from_service("ec2").client.meta.events.register(
+        "before-call.ec2.DescribeInstances", lambda **kwargs: calls.append(kwargs["params"]))
+    return calls
 
-    clean_context = clean_dangling_contexts()
-    assert clean_context[0] == name
 
-    deregister_instance(name, host_ip)
+@mock_aws
+def test_list_instances_filters_and_formats(aws_credentials, capsys, mocker):
+    ec2 = boto3.client("ec2")
+    for user, project in [("alice", "p1"), ("alice", "p2"), ("bob", "p1")]:
+        ec2.run_instances(ImageId="ami-12345678", MinCount=1, MaxCount=1, InstanceType="t2.micro",
+                          TagSpecifications=[{"ResourceType": "instance",
+                                              "Tags": [{"Key": "user", "Value": user},
+                                                       {"Key": "project", "Value": project}]}])
+    calls = _count_describe_instances()
+
+    rows = list_instances(user="alice")
+    assert sorted(r["project"] for r in rows) == ["p1", "p2"]
+    assert len(calls) == 1
+    assert [r["user"] for r in list_instances(project="p1", user="bob")] == ["bob"]
+    assert list_instances(states=["stopped"]) == []
+    capsys.readouterr()
+
+    list_instances(user="alice", output="json")
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line)["user"] for line in lines] == ["alice", "alice"]
+
+    list_instances(project="p1", output="csv")
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith("InstanceId,InstanceType,State")
+    assert len(lines) == 3
 
 
 @mock_aws
-def test_clean_dangling_contexts_instance_running(aws_credentials, ec2_config, mocker):
+def test_list_instances_paginates(aws_credentials, mocker):
+    for _ in range(7):
+        boto3.client("ec2").run_instances(ImageId="ami-12345678", MinCount=1, MaxCount=1, InstanceType="t2.micro")
+    calls = _count_describe_instances()
 
-    class minst:
-        public_ip_address = "10.10.10.11"
+    assert len(list(iter_instances(page_size=5))) == 7
+    assert len(calls) == 2
 
-    m = mocker.patch("eki_dev.dev_machine._get_lst_instances")
-    m.return_value.iterator.return_value = [minst]
 
-    name = "test"
-    host_ip = "10.10.10.10"
+@pytest.fixture
+def state_dir():
+    config_dir = ".test_dev_machine_state"
+    yield config_dir
+    shutil.rmtree(os.path.join(os.path.expanduser("~"), config_dir), ignore_errors=True)
 
-    register_instance(name, host_ip)
 
-    r = clean_dangling_contexts()
-    assert r[0] == "test"
+@mock_aws
+def test_clean_dangling_contexts_no_instances_running(aws_credentials, ec2_config, state_dir):
+    name = "test_instance"
+    host_ip = "10.10.10.10"
 
-    deregister_instance(name, host_ip)
+    register_instance(name, host_ip, CONFIG_DIR=state_dir)
 
+    clean_context = clean_dangling_contexts(CONFIG_DIR=state_dir, force=True)
+    assert clean_context[0] == name
+    assert StateStore(state_dir).all() == []
 
-def test_clean_dangling_contexts_instance_running_no_dangling_context(aws_credentials, ec2_config, mocker):
 
-    class minst:
-        public_ip_address = "10.10.10.10"
+@mock_aws
+def test_clean_dangling_contexts_instance_running(aws_credentials, ec2_config, state_dir):
+    inst = boto3.client("ec2").run_instances(ImageId="ami-12345678", MinCount=1, MaxCount=1)["Instances"][0]
 
-    m = mocker.patch("eki_dev.dev_machine._get_lst_instances")
-    m.return_value.iterator.return_value= [minst]
+    register_instance("test", "10.10.10.10", CONFIG_DIR=state_dir)
+    register_instance("live", inst["PublicIpAddress"], CONFIG_DIR=state_dir, instance_id=inst["InstanceId"])
 
-    name = "test"
-    host_ip = "10.10.10.10"
+    r = clean_dangling_contexts(CONFIG_DIR=state_dir, max_age=0)
+    assert r == ["test"]
+    assert [e["name"] for e in StateStore(state_dir).all()] == ["live"]
 
-    register_instance(name, host_ip)
 
-    r = clean_dangling_contexts()
-    assert len(r) == 0
+@mock_aws
+def test_clean_dangling_contexts_skips_fresh_entries(aws_credentials, ec2_config, state_dir):
+    register_instance("test", "10.10.10.10", CONFIG_DIR=state_dir)
+    calls = _count_describe_instances()
 
-    deregister_instance(name, host_ip)
+    # the entry was just registered, nothing to check
+    assert clean_dangling_contexts(CONFIG_DIR=state_dir) == []
+    assert calls == []
+    assert clean_dangling_contexts(CONFIG_DIR=state_dir, max_age=0) == ["test"]
+    assert len(calls) == 1
 
 
 @mock_aws
@@ -197,7 +242,7 @@ def test_terminate_instance(aws_credentials, ec2_config,bucket_with_project_tags
     )
     list_instances()
     terminate_instance(instance.id)
-    lst_inst = _get_lst_instances()
+    lst_inst = boto3.resource("ec2").instances
 
     assert list(lst_inst.all())[0].state["Name"] == "terminated"
 
@@ -215,7 +260,7 @@ def test_terminate_instance_incorrect_id(aws_credentials, ec2_config,bucket_with
     captured = capsys.readouterr().out.strip().split("\n")
     assert captured[-1] == "Instance incorrect_id not found. Instance not terminated."
     #Clean up
-    lst_inst = _get_lst_instances()
+    lst_inst = boto3.resource("ec2").instances
     terminate_instance(instance.id)
 
     assert list(lst_inst.all())[0].state["Name"] == "terminated"
@@ -224,3 +269,46 @@ def test_terminate_instance_incorrect_id(aws_credentials, ec2_config,bucket_with
 def test_terminate_instance_instance_none(aws_credentials, ec2_config,bucket_with_project_tags):
     clean_dangling_contexts()
     assert terminate_instance() is None
+
+
+@mock_aws
+def test_terminate_instances_bulk(aws_credentials, mocker, capsys):
+    ec2 = boto3.client("ec2")
+    ids = {}
+    for project in ["p1", "p1", "p2"]:
+        instance_id = ec2.run_instances(ImageId="ami-12345678", MinCount=1, MaxCount=1, InstanceType="t2.micro",
+                                        TagSpecifications=[{"ResourceType": "instance",
+                                                            "Tags": [{"Key": "project", "Value": project}]}]
+                                        )["Instances"][0]["InstanceId"]
+        ids.setdefault(project, []).append(instance_id)
+    mocker.patch("eki_dev.dev_machine.list_host_ip_for_all_contexts", return_value=[])
+    terminate = mocker.spy(AwsService.from_service("ec2").client, "terminate_instances")
+
+    assert sorted(terminate_instances(project="p1", wait=True)) == sorted(ids["p1"])
+    terminate.assert_called_once()
+    states = {i["InstanceId"]: i["State"]["Name"]
+              for r in ec2.describe_instances()["Reservations"] for i in r["Instances"]}
+    assert [states[i] for i in ids["p1"]] == ["terminated", "terminated"]
+    assert states[ids["p2"][0]] == "running"
+
+    assert terminate_instances(ids["p2"] + ["i-00000000000000000"]) == ids["p2"]
+    assert capsys.readouterr().out.strip().split("\n")[-1] == \
+        "Instance i-00000000000000000 not found. Instance not terminated."
+    assert terminate_instances(project="p1") == []
+
+
+@mock_aws
+def test_terminate_stopped_instance_cleans_up(aws_credentials, mocker):
+    ec2 = boto3.client("ec2")
+    instance_id = ec2.run_instances(ImageId="ami-12345678", MinCount=1, MaxCount=1)["Instances"][0]["InstanceId"]
+    register_instance("stopped_machine", "54.1.2.3", instance_id=instance_id)
+    ec2.stop_instances(InstanceIds=[instance_id])
+    # the context still points to the public ip the instance had before the stop
+    mocker.patch("eki_dev.dev_machine.list_host_ip_for_all_contexts", return_value=[("stopped_machine", "54.1.2.3")])
+    mremove = mocker.patch("eki_dev.dev_machine.remove_docker_context")
+
+    assert terminate_instances([instance_id]) == [instance_id]
+    mremove.assert_called_once_with("stopped_machine")
+    store = StateStore()
+    assert store.get("stopped_machine") is None
+    store.close()
@@ -1,5 +1,11 @@
+import time
+import threading
+
 import pytest
 import docker
+import paramiko
+from types import SimpleNamespace
+from docker.types.daemon import CancellableStream
 from moto import mock_aws
 
 from eki_dev.docker_utils import (
@@ -8,10 +14,15 @@ from eki_dev.docker_utils import (
     remove_docker_context,
     check_docker_context_does_not_exist,
     find_context_name_from_instance_ip,
-    _check_docker_installed,
     login_into_ecr,
-    list_host_ip_for_all_contexts
+    ecr_auth_config,
+    list_host_ip_for_all_contexts,
+    wait_for_log_pattern,
+    wait_for_token,
+    create_docker_context,
+    get_context_index
 )
+from eki_dev.aws_service import AwsService
 
 from fixtures import (
     aws_credentials,
@@ -32,14 +43,30 @@ def docker_context() -> docker.Context:
 
 
 @mock_aws
-def test_login_into_ecr(docker_registry, mocker):
+def test_login_into_ecr(docker_registry, mocker, tmp_path):
 
     mdockerclient = mocker.patch('docker.from_env')
     mdockerlogin = mocker.patch.object(docker.DockerClient, "login")
-    ecr_client = login_into_ecr(docker_registry)
+    ecr_client = login_into_ecr(docker_registry, CONFIG_DIR=str(tmp_path))
     assert ecr_client is not None
 
 
+@mock_aws
+def test_login_into_ecr_uses_cached_token(aws_credentials, docker_registry, mocker, tmp_path):
+    mdockerclient = mocker.patch('docker.from_env')
+    mdockerclient.return_value.login.return_value = {'Status': 'Login Succeeded'}
+    # moto issues tokens that expired in 2015
+    mocker.patch('eki_dev.credential_cache.time').time.return_value = 1388534400
+    mecr = mocker.spy(AwsService.from_service('ecr', region='us-west-1').client, "get_authorization_token")
+
+    login_into_ecr(docker_registry, CONFIG_DIR=str(tmp_path))
+    login_into_ecr(docker_registry, CONFIG_DIR=str(tmp_path))
+
+    assert mecr.call_count == 1
+    assert mdockerclient.return_value.login.call_count == 1
+    assert ecr_auth_config(docker_registry, CONFIG_DIR=str(tmp_path))["username"] == "AWS"
+
+
 @pytest.mark.parametrize("name, expected", [("default", "default")])
 def test_check_docker_context_exists(name, expected):
     with pytest.raises(docker.errors.ContextAlreadyExists) as e:
@@ -52,19 +79,6 @@ def test_check_docker_context_not_exists():
     assert check_docker_context_does_not_exist("non_existent_context")
 
 
-def test__check_docker_installed(mocker,):
-    m = mocker.patch('subprocess.Popen')
-    m.return_value.communicate.side_effect = [(" ", "command not found"), ("docker v23.test", "127")]
-
-
-    user = 'ubuntu'
-    host = '10.10.10.10'
-    m.return_value.returncode = 10
-    assert _check_docker_installed(user, host) == False
-    m.return_value.returncode = 0
-    assert _check_docker_installed(user, host) == True
-
-
 def test_list_docker_contexts(aws_credentials, ec2_config):
     ls_ctxt = list_docker_context()
     assert len(ls_ctxt) > 0
@@ -104,4 +118,123 @@ def test_find_context_name_from_instance_ip(docker_context):
 
 def test_list_host_ip_for_all_contexts():
     lst = list_host_ip_for_all_contexts()
-    assert isinstance(lst, list)
\ No newline at end of file
+    assert isinstance(lst, list)
+
+class FakeLogStream:
+    """Yields `chunks`, then blocks like a followed log until closed"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        yield from self.chunks
+        self.closed.wait()
+
+    def close(self):
+        self.closed.set()
+
+
+def test_wait_for_token_matches_across_chunks(mocker):
+    container = mocker.MagicMock()
+    stream = FakeLogStream([b"[I ServerApp] Jupyter Server is running at:\n[I ServerApp] http://127.0.0.1:8888/lab?to",
+                            b"ken=abc123\n[I ServerApp] Use Control-C to stop\n"])
+    container.logs.return_value = stream
+
+    start = time.monotonic()
+    assert wait_for_token(container, timeout=10) == "abc123"
+    assert time.monotonic() - start < 1
+    container.logs.assert_called_once_with(stream=True, follow=True)
+    assert stream.closed.is_set()
+
+
+def test_wait_for_log_pattern_timeout(mocker):
+    container = mocker.MagicMock()
+    container.logs.return_value = FakeLogStream([b"starting\n"])
+
+    start = time.monotonic()
+    assert wait_for_log_pattern(container, r"ready", timeout=0.2) is None
+    assert time.monotonic() - start < 2
+
+
+def test_wait_for_log_pattern_container_exits(mocker):
+    container = mocker.MagicMock()
+    container.logs.return_value = iter([b"line 1\n", b"listening on port 8787"])
+
+    match = wait_for_log_pattern(container, r"port (\d+)", timeout=10)
+    assert match.group(1) == "8787"
+    container.logs.return_value = iter([b"line 1\n"])
+    assert wait_for_log_pattern(container, r"port (\d+)", timeout=10) is None
+
+
+def _ssh_log_stream(mocker):
+    """a docker-py log stream read from a paramiko channel, as with an ssh:// docker client"""
+    channel = paramiko.Channel(1)
+    channel.transport = mocker.MagicMock()
+    channel.active = True
+    channel_file = paramiko.ChannelFile(channel, "rb")
+    response = SimpleNamespace(raw=SimpleNamespace(closed=False, _fp=SimpleNamespace(fp=channel_file)))
+    return channel, CancellableStream(iter(channel_file.readline, b""), response)
+
+
+def _log_reader_stops():
+    deadline = time.monotonic() + 2
+    while any(t.name == "log-reader" for t in threading.enumerate()):
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_wait_for_log_pattern_over_ssh(mocker):
+    container = mocker.MagicMock()
+    channel, container.logs.return_value = _ssh_log_stream(mocker)
+    channel.in_buffer.feed(b"[I ServerApp] http://127.0.0.1:8888/lab?token=abc123\n")
+
+    # closing the stream through docker-py raises for ssh streams
+    assert wait_for_token(container, timeout=10) == "abc123"
+    channel.in_buffer.feed(b"[I ServerApp] 200 GET /api\n")
+    assert _log_reader_stops()
+
+
+def test_wait_for_log_pattern_timeout_over_ssh(mocker):
+    container = mocker.MagicMock()
+    channel, container.logs.return_value = _ssh_log_stream(mocker)
+    channel.in_buffer.feed(b"starting\n")
+
+    start = time.monotonic()
+    assert wait_for_token(container, timeout=0.3) is None
+    assert time.monotonic() - start < 2
+    channel.in_buffer.feed(b"started\n")
+    assert _log_reader_stops()
+
+
+def test_context_index_is_built_once(mocker):
+    index = get_context_index()
+    index.invalidate()
+    spy = mocker.spy(docker.ContextAPI, "contexts")
+
+    try:
+        create_docker_context("test_index_context", host="5.6.7.8")
+        assert find_context_name_from_instance_ip("5.6.7.8") == "test_index_context"
+        assert ("test_index_context", "5.6.7.8") in list_host_ip_for_all_contexts()
+        with pytest.raises(docker.errors.ContextAlreadyExists):
+            check_docker_context_does_not_exist("test_index_context")
+        assert spy.call_count == 1
+
+        remaining = remove_docker_context("test_index_context")
+        assert all(c.Name != "test_index_context" for c in remaining)
+        assert find_context_name_from_instance_ip("5.6.7.8") is None
+        assert spy.call_count == 1
+    finally:
+        try:
+            docker.ContextAPI.remove_context("test_index_context")
+        except docker.errors.ContextNotFound:
+            pass
+
+
+def test_context_index_sees_contexts_of_other_processes(docker_context):
+    # the fixture creates the context directly, as another process would
+    assert find_context_name_from_instance_ip("1.2.3.4") == "test_context"
+    docker.ContextAPI.remove_context("test_context")
+    assert find_context_name_from_instance_ip("1.2.3.4") is None
@@ -0,0 +1,60 @@
+import json
+
+import boto3
+import docker
+import pytest
+from moto import mock_aws
+
+from aws_cluster.ec2_fleets import create_fleet, fleet_instance_names
+
+from fixtures import (
+    aws_credentials,
+    ec2_config,
+    aws_s3,
+    create_test_bucket,
+    bucket_with_project_tags
+)
+
+from eki_dev.utils import deregister_instance
+
+
+def _remove_contexts(fleet):
+    for m in fleet.instances:
+        docker.ContextAPI.remove_context(m["name"])
+        deregister_instance(m["name"], m["ip"])
+
+
+@mock_aws
+def test_create_fleet(aws_credentials, ec2_config, bucket_with_project_tags):
+    fleet = create_fleet(name="test_fleet",
+                         count=3,
+                         project_tag="dev",
+                         **json.loads(ec2_config)["Ec2Instance"]["Properties"])
+    try:
+        assert len(fleet) == 3
+        assert [m["name"] for m in fleet.instances] == fleet_instance_names("test_fleet", 3)
+        contexts = {ctx.Name for ctx in docker.ContextAPI.contexts()}
+        assert set(fleet_instance_names("test_fleet", 3)) <= contexts
+
+        ec2 = boto3.client("ec2")
+        reservations = ec2.describe_instances(InstanceIds=fleet.instance_ids)["Reservations"]
+        assert len(reservations) == 1
+        tags = {t["Key"]: t["Value"] for t in reservations[0]["Instances"][0]["Tags"]}
+        assert tags["fleet"] == "test_fleet"
+        assert tags["project"] == "dev"
+    finally:
+        _remove_contexts(fleet)
+
+
+@mock_aws
+def test_create_fleet_terminates_on_failure(aws_credentials, ec2_config, bucket_with_project_tags, mocker):
+    mocker.patch("aws_cluster.ec2_fleets.create_docker_context", side_effect=docker.errors.ContextException("boom"))
+    with pytest.raises(docker.errors.ContextException):
+        create_fleet(name="test_fleet",
+                     count=2,
+                     project_tag="dev",
+                     **json.loads(ec2_config)["Ec2Instance"]["Properties"])
+
+    states = [i["State"]["Name"]
+              for r in boto3.client("ec2").describe_instances()["Reservations"] for i in r["Instances"]]
+    assert states == ["terminated", "terminated"]
@@ -0,0 +1,138 @@
+import json
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from eki_dev.image_cache import (
+    DEVICE,
+    DIGEST_TAG,
+    IMAGE_TAG,
+    LABEL,
+    build_cache_snapshot,
+    image_digest,
+    image_is_current,
+    list_cache_snapshots,
+    lookup_image_cache,
+    refresh_cache_snapshot,
+    refresh_in_background,
+    with_image_cache
+)
+
+from fixtures import aws_credentials, ec2_config
+
+
+def _push_image(repository="data_explorer", tag="prod", layer="sha256:aaa"):
+    ecr = boto3.client("ecr")
+    try:
+        ecr.create_repository(repositoryName=repository)
+    except ecr.exceptions.RepositoryAlreadyExistsException:
+        pass
+    manifest = json.dumps({"schemaVersion": 2,
+                           "mediaType": "application/vnd.docker.distribution.manifest.v2+json",
+                           "layers": [{"digest": layer}]})
+    return ecr.put_image(repositoryName=repository, imageManifest=manifest,
+                         imageTag=tag)["image"]["imageId"]["imageDigest"]
+
+
+def _cache_snapshot(container, digest):
+    ec2 = boto3.client("ec2")
+    volume_id = ec2.create_volume(AvailabilityZone="us-east-1a", Size=30)["VolumeId"]
+    return ec2.create_snapshot(VolumeId=volume_id,
+                               TagSpecifications=[{"ResourceType": "snapshot",
+                                                   "Tags": [{"Key": IMAGE_TAG, "Value": container},
+                                                            {"Key": DIGEST_TAG, "Value": digest}]}]
+                               )["SnapshotId"]
+
+
+@mock_aws
+def test_lookup_image_cache(aws_credentials):
+    digest = _push_image()
+    assert image_digest("data_explorer:prod") == digest
+    assert lookup_image_cache("data_explorer:prod") == {"container": "data_explorer:prod", "digest": digest,
+                                                        "snapshot_id": None, "current": False}
+
+    snapshot_id = _cache_snapshot("data_explorer:prod", digest)
+    _cache_snapshot("other:prod", digest)
+    cache = lookup_image_cache("data_explorer:prod")
+    assert cache["snapshot_id"] == snapshot_id
+    assert cache["current"]
+
+    # a new push moves the tag, the old snapshot is still used but is stale
+    new_digest = _push_image(layer="sha256:bbb")
+    cache = lookup_image_cache("data_explorer:prod")
+    assert cache["digest"] == new_digest
+    assert cache["snapshot_id"] == snapshot_id
+    assert not cache["current"]
+
+
+def test_with_image_cache():
+    params = {"ImageId": "ami-12345678",
+              "BlockDeviceMappings": [{"DeviceName": "/dev/sda1", "Ebs": {"VolumeSize": 25}}],
+              "UserData": "#!/bin/sh\nsudo mkdir -p /home/ubuntu/efs"}
+    assert with_image_cache(None, **params) == params
+    assert with_image_cache({"snapshot_id": None}, **params) == params
+
+    cached = with_image_cache({"snapshot_id": "snap-123"}, **params)
+    assert cached["BlockDeviceMappings"][1] == {"DeviceName": DEVICE,
+                                                "Ebs": {"SnapshotId": "snap-123", "VolumeType": "gp3",
+                                                        "DeleteOnTermination": True}}
+    assert cached["UserData"].startswith(f"#!/bin/sh\nif [ -e /dev/disk/by-label/{LABEL} ]")
+    assert cached["UserData"].endswith("sudo mkdir -p /home/ubuntu/efs")
+    assert len(params["BlockDeviceMappings"]) == 1
+
+
+def test_image_is_current(mocker):
+    client = mocker.MagicMock()
+    client.images.get.return_value.attrs = {"RepoDigests": ["registry/data_explorer@sha256:aaa"]}
+    assert image_is_current(client, "registry/data_explorer", "prod", "sha256:aaa")
+    assert not image_is_current(client, "registry/data_explorer", "prod", "sha256:bbb")
+
+    client.images.get.side_effect = Exception("No such image")
+    assert not image_is_current(client, "registry/data_explorer", "prod", "sha256:aaa")
+
+
+def test_refresh_in_background_keeps_profile(mocker, monkeypatch, tmp_path):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    popen = mocker.patch("eki_dev.utils.subprocess.Popen")
+
+    refresh_in_background("data_explorer:prod", profile="gpu")
+    assert popen.call_args[0][0][2:6] == ["--profile", "gpu", "image-cache", "refresh"]
+
+
+@mock_aws
+def test_refresh_cache_snapshot_up_to_date(aws_credentials, mocker):
+    build = mocker.patch("eki_dev.image_cache.build_cache_snapshot", return_value="snap-new")
+    digest = _push_image()
+    snapshot_id = _cache_snapshot("data_explorer:prod", digest)
+
+    assert refresh_cache_snapshot("data_explorer:prod") == snapshot_id
+    build.assert_not_called()
+    assert refresh_cache_snapshot("data_explorer:prod", force=True) == "snap-new"
+
+
+@mock_aws
+def test_build_cache_snapshot(aws_credentials, ec2_config, mocker):
+    mocker.patch("eki_dev.image_cache.wait_until_ready")
+    run_command = mocker.patch("eki_dev.image_cache.run_command", return_value=(0, b"", b""))
+    mocker.patch("eki_dev.image_cache.get_docker_client")
+    login = mocker.patch("eki_dev.image_cache.login_into_ecr")
+    login.return_value.api.pull.return_value = iter([{"status": "Pull complete"}])
+    boto3.client("iam").create_instance_profile(InstanceProfileName="AccessECR")
+    digest = _push_image()
+    old = [_cache_snapshot("data_explorer:prod", "sha256:old") for _ in range(2)]
+
+    conf = json.loads(ec2_config)["Ec2Instance"]["Properties"]
+    snapshot_id = build_cache_snapshot("data_explorer:prod", keep=2, **conf)
+
+    assert "mkfs.ext4" in run_command.call_args_list[0].args[2]
+    login.return_value.api.pull.assert_called_once()
+    snapshots = list_cache_snapshots("data_explorer:prod")
+    assert snapshot_id in [s["SnapshotId"] for s in snapshots]
+    assert len(snapshots) == 2
+    tags = {t["Key"]: t["Value"] for s in snapshots if s["SnapshotId"] == snapshot_id for t in s["Tags"]}
+    assert tags[DIGEST_TAG] == digest
+
+    states = [i["State"]["Name"] for r in boto3.client("ec2").describe_instances()["Reservations"]
+              for i in r["Instances"]]
+    assert states in (["shutting-down"], ["terminated"])
@@ -0,0 +1,43 @@
+import os
+import stat
+import datetime
+
+from eki_dev.json_file import LockedJsonFile
+
+
+def _encode(obj):
+    if isinstance(obj, datetime.date):
+        return {"__date__": obj.isoformat()}
+    raise TypeError(type(obj))
+
+
+def _decode(obj):
+    return datetime.date.fromisoformat(obj["__date__"]) if "__date__" in obj else obj
+
+
+def test_read_write_remove(tmp_path):
+    config_dir = tmp_path / "cfg"
+    store = LockedJsonFile("store.json", CONFIG_DIR=str(config_dir), encode=_encode, decode=_decode)
+    with store.lock():
+        assert store.read() == {}
+
+    with store.lock(exclusive=True):
+        store.write({"day": datetime.date(2024, 5, 1)})
+    with store.lock():
+        assert store.read() == {"day": datetime.date(2024, 5, 1)}
+    assert stat.S_IMODE(os.stat(store.path).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(config_dir).st_mode) == 0o700
+    # the temporary file was renamed over the document
+    assert sorted(os.listdir(config_dir)) == ["store.json", "store.json.lock"]
+
+    store.remove()
+    store.remove()
+    assert not os.path.exists(store.path)
+
+
+def test_corrupt_file_reads_empty(tmp_path):
+    store = LockedJsonFile("store.json", CONFIG_DIR=str(tmp_path))
+    with open(store.path, "w", encoding='utf8') as f:
+        f.write("{not json")
+    with store.lock():
+        assert store.read() == {}
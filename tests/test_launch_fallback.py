@@ -0,0 +1,113 @@
+import json
+
+import docker
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_aws
+
+from fixtures import (aws_credentials,
+                      ec2_config,
+                      aws_s3,
+                      create_test_bucket,
+                      bucket_with_project_tags)
+
+from eki_dev.aws_service import AwsService
+from eki_dev.dev_machine import create_ec2_instance
+from eki_dev.launch_fallback import (
+    LaunchHistory,
+    launch_candidates,
+    launch_with_fallback,
+    with_candidate,
+)
+
+
+def _capacity_error(code="InsufficientInstanceCapacity"):
+    return ClientError({"Error": {"Code": code, "Message": "no capacity"}}, "RunInstances")
+
+
+def test_launch_candidates_order():
+    candidates = launch_candidates(["m5.large", "m5a.large"], ["subnet-a", "subnet-b"])
+    assert candidates == [("m5.large", "subnet-a"), ("m5.large", "subnet-b"),
+                          ("m5a.large", "subnet-a"), ("m5a.large", "subnet-b")]
+
+    candidates = launch_candidates(["m5.large", "m5a.large"], ["subnet-a", "subnet-b"],
+                                   preferred=("m5a.large", "subnet-b"))
+    assert candidates[0] == ("m5a.large", "subnet-b")
+    assert len(candidates) == 4
+
+
+def test_with_candidate_does_not_modify_params():
+    params = {"InstanceType": "t2.micro",
+              "NetworkInterfaces": [{"DeviceIndex": 0, "SubnetId": "subnet-a"}]}
+    candidate = with_candidate("m5.large", "subnet-b", **params)
+
+    assert candidate["InstanceType"] == "m5.large"
+    assert candidate["NetworkInterfaces"][0] == {"DeviceIndex": 0, "SubnetId": "subnet-b"}
+    assert params["NetworkInterfaces"][0]["SubnetId"] == "subnet-a"
+    assert with_candidate("m5.large", "subnet-b", InstanceType="t2.micro")["SubnetId"] == "subnet-b"
+
+
+def test_launch_with_fallback_remembers_success(tmp_path, mocker):
+    def launch(**params):
+        if (params["InstanceType"], params["SubnetId"]) != ("m5a.large", "subnet-b"):
+            raise _capacity_error()
+        return params
+
+    spy = mocker.Mock(side_effect=launch)
+    params = {"InstanceType": "m5.large", "SubnetId": "subnet-a"}
+    result = launch_with_fallback(spy, "us-west-1", ["m5a.large"], ["subnet-b"], CONFIG_DIR=str(tmp_path), **params)
+
+    assert (result["InstanceType"], result["SubnetId"]) == ("m5a.large", "subnet-b")
+    assert spy.call_count == 4
+    assert LaunchHistory(CONFIG_DIR=str(tmp_path)).last_success("us-west-1", ["m5.large", "m5a.large"]) == \
+        ("m5a.large", "subnet-b")
+
+    spy.reset_mock()
+    launch_with_fallback(spy, "us-west-1", ["m5a.large"], ["subnet-b"], CONFIG_DIR=str(tmp_path), **params)
+    assert spy.call_count == 1
+
+
+def test_launch_with_fallback_raises_other_errors(tmp_path, mocker):
+    launch = mocker.Mock(side_effect=_capacity_error("InvalidAMIID.NotFound"))
+
+    with pytest.raises(ClientError) as err:
+        launch_with_fallback(launch, "us-west-1", ["m5a.large"], CONFIG_DIR=str(tmp_path), InstanceType="m5.large")
+    assert err.value.response["Error"]["Code"] == "InvalidAMIID.NotFound"
+    assert launch.call_count == 1
+
+
+def test_launch_with_fallback_no_capacity_anywhere(tmp_path, mocker):
+    launch = mocker.Mock(side_effect=_capacity_error("Unsupported"))
+
+    with pytest.raises(ClientError):
+        launch_with_fallback(launch, "us-west-1", ["m5a.large"], CONFIG_DIR=str(tmp_path), InstanceType="m5.large")
+    assert launch.call_count == 2
+
+
+@mock_aws
+def test_create_ec2_instance_falls_back(aws_credentials, ec2_config, bucket_with_project_tags, mocker, tmp_path):
+    resource = AwsService.from_service("ec2").resource
+    create_instances = resource.create_instances
+
+    def short_of_t2(**params):
+        if params["InstanceType"].startswith("t2"):
+            raise _capacity_error()
+        return create_instances(**params)
+
+    mocker.patch.object(resource, "create_instances", side_effect=short_of_t2)
+    try:
+        instance = create_ec2_instance(name='test_fallback',
+                                       project_tag='dev',
+                                       instance_types=["t3.micro"],
+                                       **json.loads(ec2_config)["Ec2Instance"]["Properties"])
+    finally:
+        try:
+            docker.ContextAPI.remove_context('test_fallback')
+        except docker.errors.ContextNotFound:
+            pass
+
+    assert instance.instance_type == "t3.micro"
+    # recorded in the temporary home of the fixture
+    history = LaunchHistory()
+    assert history.file.path.startswith(str(tmp_path))
+    assert history.last_success("us-east-1", ["t2.micro.test", "t3.micro"])[0] == "t3.micro"
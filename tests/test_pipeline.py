@@ -0,0 +1,88 @@
+import time
+import threading
+
+import pytest
+
+from eki_dev.pipeline import Pipeline
+
+
+def test_pipeline_passes_dependency_results():
+    pipeline = Pipeline()
+    pipeline.add("a", lambda: 1)
+    pipeline.add("b", lambda: 2)
+    pipeline.add("c", lambda a, b: a + b, deps=("a", "b"))
+    results = pipeline.run()
+    assert results == {"a": 1, "b": 2, "c": 3}
+
+
+def test_pipeline_runs_independent_phases_concurrently():
+    barrier = threading.Barrier(3, timeout=5)
+    pipeline = Pipeline(max_workers=4)
+    for name in ("a", "b", "c"):
+        pipeline.add(name, barrier.wait)
+    pipeline.add("d", lambda **_: "done", deps=("a", "b", "c"))
+
+    assert pipeline.run()["d"] == "done"
+
+
+def test_pipeline_wall_time_follows_critical_path():
+    pipeline = Pipeline()
+    pipeline.add("boot", lambda: time.sleep(0.3))
+    pipeline.add("tags", lambda: time.sleep(0.1))
+    pipeline.add("credentials", lambda: time.sleep(0.2))
+    pipeline.add("pull", lambda **_: time.sleep(0.1), deps=("boot", "credentials"))
+    pipeline.add("run", lambda **_: None, deps=("pull", "tags"))
+    pipeline.run()
+
+    assert pipeline.duration < 0.55
+    assert pipeline.critical_path() == ["boot", "pull", "run"]
+
+
+def test_pipeline_stops_on_failure(capsys):
+    def fail():
+        raise KeyError("boom")
+
+    pipeline = Pipeline()
+    pipeline.add("a", fail)
+    pipeline.add("b", lambda: 1)
+    pipeline.add("c", lambda a, b: a + b, deps=("a", "b"))
+    with pytest.raises(KeyError):
+        pipeline.run()
+
+    assert pipeline.phases["a"].status == "failed"
+    assert pipeline.phases["c"].status == "skipped"
+
+    pipeline.report()
+    out = capsys.readouterr().out
+    assert "failed" in out and "skipped" in out
+
+
+def test_pipeline_interrupt_waits_for_running_phases(mocker):
+    from concurrent.futures import wait
+
+    interrupts = iter([KeyboardInterrupt()])
+
+    def interrupted_wait(fs, **kwargs):
+        # Ctrl-C while the main thread waits on the phases
+        for e in interrupts:
+            raise e
+        return wait(fs, **kwargs)
+
+    mocker.patch("eki_dev.pipeline.wait", side_effect=interrupted_wait)
+    pipeline = Pipeline(interrupt_timeout=0.5)
+    pipeline.add("launch", lambda: time.sleep(0.2) or "i-123")
+    pipeline.add("hang", lambda: time.sleep(2))
+    pipeline.add("running", lambda launch: launch, deps=("launch",))
+    with pytest.raises(KeyboardInterrupt):
+        pipeline.run()
+
+    # the launched instance can be cleaned up, the slow phase is not waited for beyond the timeout
+    assert pipeline.phases["launch"].result == "i-123"
+    assert pipeline.duration < 1.5
+    assert pipeline.phases["running"].status == "skipped"
+
+
+def test_pipeline_rejects_unknown_dependencies():
+    pipeline = Pipeline()
+    with pytest.raises(ValueError):
+        pipeline.add("a", lambda b: b, deps=("b",))
@@ -0,0 +1,79 @@
+import boto3
+import pytest
+from botocore.exceptions import EndpointConnectionError
+from moto import mock_aws
+
+from fixtures import (aws_credentials,
+                      aws_s3,
+                      create_test_bucket,
+                      bucket_with_project_tags)
+
+from eki_dev import project_tags
+from eki_dev.utils import check_project_tag, get_project_tags
+
+BUCKET = 'eki-dev-machine-config'
+
+
+def _count_get_object(cache):
+    calls = []
+    cache._client().meta.events.register("provide-client-params.s3.GetObject",
+                                         lambda params, **kw: calls.append(dict(params)))
+    return calls
+
+
+def test_tags_cached_within_max_age(bucket_with_project_tags):
+    cache = project_tags.configure(max_age=3600)
+    calls = _count_get_object(cache)
+
+    assert get_project_tags(BUCKET) == ['dev', 'eki_training', 'test_project']
+    assert get_project_tags(BUCKET) == ['dev', 'eki_training', 'test_project']
+    assert len(calls) == 1
+    assert cache.get(BUCKET)["etag"]
+
+
+def test_revalidation_not_modified(bucket_with_project_tags):
+    cache = project_tags.configure(max_age=0)
+    calls = _count_get_object(cache)
+    cache.tags(BUCKET)
+    etag = cache.get(BUCKET)["etag"]
+
+    tags, revalidated = cache.tags(BUCKET)
+
+    assert revalidated
+    assert tags == ['dev', 'eki_training', 'test_project']
+    assert len(calls) == 2
+    assert calls[1]["IfNoneMatch"] == etag
+
+
+def test_revalidation_modified(bucket_with_project_tags):
+    cache = project_tags.configure(max_age=0)
+    cache.tags(BUCKET)
+    boto3.client("s3").put_object(Bucket=BUCKET, Body=b'dev,new_project', Key="project_tags.txt")
+
+    assert cache.tags(BUCKET) == (['dev', 'new_project'], True)
+
+
+def test_offline_uses_cache(bucket_with_project_tags, mocker):
+    cache = project_tags.configure(max_age=0)
+    cache.tags(BUCKET)
+    mocker.patch.object(cache, "fetch", side_effect=EndpointConnectionError(endpoint_url="https://s3"))
+
+    assert cache.tags(BUCKET) == (['dev', 'eki_training', 'test_project'], False)
+
+
+def test_offline_without_cache_raises(bucket_with_project_tags, mocker):
+    cache = project_tags.configure()
+    mocker.patch.object(cache, "fetch", side_effect=EndpointConnectionError(endpoint_url="https://s3"))
+
+    with pytest.raises(EndpointConnectionError):
+        cache.tags(BUCKET)
+
+
+def test_check_project_tag_refreshes_on_miss(bucket_with_project_tags):
+    cache = project_tags.configure(max_age=3600)
+    check_project_tag('dev', bucket=BUCKET)
+    boto3.client("s3").put_object(Bucket=BUCKET, Body=b'dev,new_project', Key="project_tags.txt")
+
+    assert check_project_tag('new_project', bucket=BUCKET) == 'new_project'
+    with pytest.raises(Exception):
+        check_project_tag('unknown', bucket=BUCKET)
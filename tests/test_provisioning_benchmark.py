@@ -0,0 +1,33 @@
+import os
+import sys
+import json
+import subprocess
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         "benchmarks", "provisioning.py")
+
+
+def test_provisioning_benchmark(tmp_path):
+    output = tmp_path / "results.json"
+    argv = [sys.executable, BENCHMARK, "--scales", "1", "--ssh-latency", "0", "--docker-latency", "0",
+            "--pull-latency", "0", "--jupyter-latency", "0"]
+    proc = subprocess.run(argv + ["--json", "--output", str(output)], capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr
+    result = json.loads(proc.stdout)
+    assert json.loads(output.read_text()) == result
+
+    operations = result["scales"]["1"]["operations"]
+    assert list(operations) == ["create_ec2_instance", "create_instance_pull_start_server", "list_instances",
+                                "clean_dangling_contexts", "terminate_instance"]
+    assert operations["terminate_instance"]["invocations"] == 2
+    assert operations["create_instance_pull_start_server"]["endpoint_calls"]["docker"] == 3
+    assert operations["list_instances"]["aws_calls_by_operation"] == {"ec2.DescribeInstances": 1}
+    assert "jupyter" in result["scales"]["1"]["phases"]["create_instance_pull_start_server"]
+
+    # fewer AWS calls in the previous run is a regression
+    previous = json.loads(output.read_text())
+    previous["scales"]["1"]["operations"]["list_instances"]["aws_calls_per_invocation"] = 0
+    output.write_text(json.dumps(previous))
+    proc = subprocess.run(argv + ["--compare", str(output), "--tolerance", "100"], capture_output=True, text=True)
+    assert proc.returncode == 1
+    assert "list_instances x1: aws calls 0 -> 1.0" in proc.stderr
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+from eki_dev.pull_progress import PullProgress, pull_image
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+EVENTS = [
+    {"status": "Pulling from data_explorer", "id": "prod"},
+    {"status": "Pulling fs layer", "progressDetail": {}, "id": "aaa"},
+    {"status": "Already exists", "progressDetail": {}, "id": "bbb"},
+    {"status": "Downloading", "progressDetail": {"current": 1000000, "total": 4000000}, "id": "aaa"},
+    {"status": "Downloading", "progressDetail": {"current": 4000000, "total": 4000000}, "id": "aaa"},
+    {"status": "Download complete", "progressDetail": {}, "id": "aaa"},
+    {"status": "Extracting", "progressDetail": {"current": 2000000, "total": 8000000}, "id": "aaa"},
+    {"status": "Pull complete", "progressDetail": {}, "id": "aaa"},
+    {"status": "Digest: sha256:abc"},
+    {"status": "Status: Downloaded newer image for data_explorer:prod"},
+]
+
+
+def test_pull_progress_aggregates_layers():
+    clock = FakeClock()
+    progress = PullProgress(clock=clock)
+    for event in EVENTS:
+        progress.update(event)
+        clock.now += 0.5
+    progress.finish()
+
+    summary = progress.summary()
+    assert summary["bytes"] == 4000000
+    assert summary["duration_s"] == 5.0
+    assert summary["mb_per_s"] == 0.8
+    assert summary["cached_layers"] == 1
+    layers = {l["id"]: l for l in summary["layers"]}
+    assert set(layers) == {"aaa", "bbb"}
+    assert layers["aaa"]["status"] == "complete"
+    assert layers["aaa"]["download_s"] == 1.0
+    assert layers["aaa"]["extract_s"] == 0.5
+    assert layers["bbb"]["status"] == "cached"
+
+
+def test_pull_progress_snapshot():
+    progress = PullProgress()
+    progress.update(EVENTS[3])
+    assert progress.snapshot() == [("aaa", "downloading", 1000000, 4000000, 0, 0)]
+
+
+@pytest.mark.parametrize("mode", ["rich", "quiet", "json"])
+def test_pull_image(mode, mocker, capsys):
+    client = mocker.MagicMock()
+    client.api.pull.return_value = iter(EVENTS)
+
+    summary = pull_image(client, "registry/data_explorer", "prod", auth_config={"username": "AWS"}, mode=mode)
+
+    client.api.pull.assert_called_once_with(repository="registry/data_explorer", tag="prod", stream=True,
+                                            decode=True, auth_config={"username": "AWS"})
+    assert summary["bytes"] == 4000000
+    out = capsys.readouterr().out
+    if mode == "json":
+        assert json.loads(out)["bytes"] == 4000000
+    else:
+        assert "4.0 MB" in out
+
+
+def test_pull_image_error(mocker):
+    client = mocker.MagicMock()
+    client.api.pull.return_value = iter([EVENTS[1], {"error": "manifest unknown"}])
+
+    with pytest.raises(Exception, match="manifest unknown"):
+        pull_image(client, "registry/data_explorer", "prod", mode="quiet")
+
+
+def test_pull_image_unknown_mode(mocker):
+    with pytest.raises(ValueError):
+        pull_image(mocker.MagicMock(), "registry/data_explorer", "prod", mode="verbose")
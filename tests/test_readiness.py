@@ -0,0 +1,115 @@
+import time
+import socket
+import threading
+
+import paramiko
+import pytest
+
+from eki_dev.readiness import (
+    Probe,
+    TcpPortProbe,
+    SshBannerProbe,
+    CloudInitProbe,
+    backoff_delay,
+    wait_until_ready
+)
+
+
+class FlakyProbe(Probe):
+    def __init__(self, name, failures):
+        super().__init__(name)
+        self.failures = failures
+        self.attempts = 0
+
+    def check(self):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise ConnectionRefusedError()
+        return True
+
+
+@pytest.fixture
+def ssh_server():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+
+    def serve():
+        conn, _ = server.accept()
+        conn.sendall(b"SSH-2.0-OpenSSH_test\r\n")
+        conn.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield server.getsockname()[1]
+    server.close()
+
+
+def test_backoff_delay_bounds():
+    for attempt in range(10):
+        delay = backoff_delay(attempt, base_delay=0.1, max_delay=1.0)
+        expected = min(1.0, 0.1 * 2 ** attempt)
+        assert expected / 2 <= delay <= expected
+
+
+def test_wait_until_ready_retries_each_stage():
+    sleeps = []
+    probes = [FlakyProbe("a", failures=3), FlakyProbe("b", failures=0)]
+    report = wait_until_ready(probes, sleep=sleeps.append)
+
+    assert report.ready
+    assert [s["attempts"] for s in report.stages] == [4, 1]
+    assert len(sleeps) == 3
+    assert all(d <= 1.0 for d in sleeps)
+
+
+def test_wait_until_ready_deadline():
+    with pytest.raises(TimeoutError) as e:
+        wait_until_ready([FlakyProbe("never", failures=10 ** 6)], deadline=0.2)
+
+    assert e.value.report.stages[0]["ready"] is False
+
+
+def test_wait_until_ready_bounds_each_attempt(mocker):
+    def run_command(user, host, command, timeout):
+        time.sleep(timeout)
+        raise socket.timeout()
+
+    m = mocker.patch('eki_dev.readiness.run_command', side_effect=run_command)
+    probe = CloudInitProbe("ubuntu", "10.10.10.10")
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        wait_until_ready([probe], deadline=0.3)
+
+    assert time.monotonic() - start < 2
+    assert all(c.kwargs["timeout"] <= 0.3 for c in m.call_args_list)
+    assert probe.timeout == 1800
+
+
+def test_tcp_and_banner_probes(ssh_server):
+    assert SshBannerProbe("127.0.0.1", ssh_server).check()
+
+
+def test_tcp_probe_closed_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    with pytest.raises(OSError):
+        TcpPortProbe("127.0.0.1", port).check()
+
+
+def test_cloud_init_probe(mocker):
+    m = mocker.patch('eki_dev.readiness.run_command')
+    m.side_effect = paramiko.ssh_exception.NoValidConnectionsError({("10.10.10.10", 22): OSError()})
+    probe = CloudInitProbe("ubuntu", "10.10.10.10")
+    with pytest.raises(OSError):
+        probe.check()
+
+    m.side_effect = paramiko.SSHException("Error reading SSH protocol banner")
+    assert probe.check() is False
+
+    m.side_effect = None
+    m.return_value = (0, b"\nstatus: done\n", b"")
+    assert probe.check() is True
+    assert m.call_args[0][:3] == ("ubuntu", "10.10.10.10", "cloud-init status --wait")
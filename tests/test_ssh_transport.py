@@ -0,0 +1,102 @@
+import socket
+import threading
+
+import docker
+import paramiko
+import pytest
+from docker.constants import DEFAULT_DOCKER_API_VERSION
+
+from eki_dev import ssh_transport
+from eki_dev.ssh_transport import (
+    AcceptNewPolicy,
+    PooledSSHHTTPAdapter,
+    get_connection,
+    get_docker_client,
+    run_command,
+    close_all
+)
+
+
+@pytest.fixture
+def mock_ssh(mocker):
+    client = mocker.patch("paramiko.SSHClient").return_value
+    client.get_transport.return_value = None
+
+    def connect(**kwargs):
+        client.get_transport.return_value = mocker.MagicMock()
+
+    client.connect.side_effect = connect
+    stdout = mocker.MagicMock()
+    stdout.read.return_value = b"24.0.5\n"
+    stdout.channel.recv_exit_status.return_value = 0
+    client.exec_command.return_value = (None, stdout, mocker.MagicMock())
+    yield client
+    close_all()
+
+
+def test_run_command_reuses_transport(mock_ssh):
+    for _ in range(5):
+        assert run_command("ubuntu", "10.10.10.10", "docker info")[0] == 0
+
+    assert mock_ssh.connect.call_count == 1
+    assert mock_ssh.exec_command.call_count == 5
+    assert get_connection("ubuntu", "10.10.10.10") is get_connection("ubuntu", "10.10.10.10")
+
+
+def test_reconnects_dropped_transport(mock_ssh):
+    run_command("ubuntu", "10.10.10.10", "true")
+    mock_ssh.get_transport.return_value.is_active.return_value = False
+    run_command("ubuntu", "10.10.10.10", "true")
+
+    assert mock_ssh.connect.call_count == 2
+
+
+def test_run_command_timeout_closes_channel(mock_ssh):
+    # a command that keeps writing, like `cloud-init status --wait`
+    closed = threading.Event()
+    stdout = mock_ssh.exec_command.return_value[1]
+    stdout.channel.close.side_effect = closed.set
+    stdout.read.side_effect = lambda: closed.wait(5) and b"....."
+
+    with pytest.raises(socket.timeout):
+        run_command("ubuntu", "10.10.10.10", "cloud-init status --wait", timeout=0.1)
+    assert closed.is_set()
+
+
+def test_docker_client_uses_pooled_transport(mock_ssh, mocker):
+    mocker.patch.object(docker.APIClient, "version", return_value={"ApiVersion": "1.52"})
+    client = get_docker_client("ubuntu", "10.10.10.10")
+    assert get_docker_client("ubuntu", "10.10.10.10") is client
+
+    adapter = client.api.get_adapter("http+docker://ssh/version")
+    assert isinstance(adapter, PooledSSHHTTPAdapter)
+    assert client.api.get_adapter(f"http+docker://ssh/v{client.api.api_version}/containers/json") is adapter
+    assert adapter.ssh_client is get_connection("ubuntu", "10.10.10.10").client
+    assert mock_ssh.connect.call_count == 1
+
+
+def test_docker_api_version_negotiated_once_per_connection(mock_ssh, mocker):
+    # docker 29 serves API 1.44 and later only
+    mversion = mocker.patch.object(docker.APIClient, "version", return_value={"ApiVersion": "1.52"})
+    assert get_docker_client("ubuntu", "10.10.10.10").api.api_version == DEFAULT_DOCKER_API_VERSION
+    ssh_transport._DOCKER_CLIENTS.clear()
+    assert get_docker_client("ubuntu", "10.10.10.10").api.api_version == DEFAULT_DOCKER_API_VERSION
+    assert mversion.call_count == 1
+    assert mversion.call_args.kwargs == {"api_version": False}
+
+    # an older daemon gets its own version
+    mversion.return_value = {"ApiVersion": "1.43"}
+    assert get_docker_client("ubuntu", "10.10.10.11").api.api_version == "1.43"
+
+
+def test_accept_new_policy(tmp_path, mocker):
+    known_hosts = tmp_path / ".ssh" / "known_hosts"
+    key = mocker.MagicMock()
+    key.get_name.return_value = "ssh-ed25519"
+    key.get_base64.return_value = "AAAAtest"
+    client = mocker.MagicMock()
+
+    AcceptNewPolicy(str(known_hosts)).missing_host_key(client, "10.10.10.10", key)
+
+    assert known_hosts.read_text() == "10.10.10.10 ssh-ed25519 AAAAtest\n"
+    client.get_host_keys.return_value.add.assert_called_once()
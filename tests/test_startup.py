@@ -0,0 +1,16 @@
+import os
+import sys
+import json
+import subprocess
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         "benchmarks", "startup_time.py")
+
+
+def test_cli_startup_does_not_import_clients():
+    proc = subprocess.run([sys.executable, BENCHMARK, "--json", "--check"], capture_output=True, text=True)
+    result = json.loads(proc.stdout)
+    assert proc.returncode == 0, result
+    for command in result["commands"].values():
+        assert command["returncode"] == 0
+        assert command["heavy_modules"] == []
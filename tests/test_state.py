@@ -0,0 +1,85 @@
+import os
+import time
+import multiprocessing
+from pathlib import Path
+
+from eki_dev.state import StateStore
+
+
+def _config_dir(tmp_path):
+    # StateStore paths are relative to the home directory
+    return os.path.relpath(tmp_path, os.path.expanduser("~"))
+
+
+def _register(config_dir, n):
+    store = StateStore(config_dir)
+    for i in range(n):
+        store.upsert(f"{os.getpid()}-{i}", f"10.0.0.{i}")
+
+
+def test_upsert_get_remove(tmp_path):
+    store = StateStore(_config_dir(tmp_path))
+    store.upsert("dev", "1.2.3.4", instance_id="i-1", project="p", image="ami-1")
+    entry = store.get("dev")
+    assert (entry["instance_id"], entry["ip"], entry["context"], entry["image"]) == ("i-1", "1.2.3.4", "dev", "ami-1")
+
+    store.upsert("dev", "5.6.7.8", instance_id="i-2")
+    assert store.get("dev")["ip"] == "5.6.7.8"
+    assert store.get("dev")["created_at"] == entry["created_at"]
+    assert len(store.all()) == 1
+
+    assert store.remove("dev", "1.2.3.4") == 0
+    assert store.remove("dev", "5.6.7.8") == 1
+    assert store.get("dev") is None
+    assert store.conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_by_instance_ids(tmp_path):
+    store = StateStore(_config_dir(tmp_path))
+    store.upsert("a", "1.1.1.1", instance_id="i-1")
+    store.upsert("b", None, instance_id="i-2")
+    store.upsert("c", "3.3.3.3")
+    entries = store.by_instance_ids(["i-2", "i-1", "i-3"])
+    assert {k: e["name"] for k, e in entries.items()} == {"i-1": "a", "i-2": "b"}
+    assert store.by_instance_ids([]) == {}
+
+
+def test_stale_entries(tmp_path):
+    store = StateStore(_config_dir(tmp_path))
+    store.upsert("a", "1.1.1.1")
+    store.upsert("b", "2.2.2.2")
+    assert store.stale(300) == []
+    assert sorted(e["name"] for e in store.stale(-1)) == ["a", "b"]
+
+    store.conn.execute("UPDATE instances SET checked_at = ? WHERE name = 'a'", (time.time() - 600,))
+    assert [e["name"] for e in store.stale(300)] == ["a"]
+    store.mark_checked(["a"])
+    assert store.stale(300) == []
+
+
+def test_legacy_files_are_migrated(tmp_path):
+    Path(tmp_path, "dev@1.2.3.4").touch()
+    Path(tmp_path, "config").touch()
+
+    store = StateStore(_config_dir(tmp_path))
+    entry = store.get("dev")
+    assert entry["ip"] == "1.2.3.4"
+    # migrated entries have never been checked
+    assert [e["name"] for e in store.stale(300)] == ["dev"]
+    assert not Path(tmp_path, "dev@1.2.3.4").exists()
+    assert Path(tmp_path, "config").exists()
+
+    # files are only imported once
+    Path(tmp_path, "old@5.6.7.8").touch()
+    assert StateStore(_config_dir(tmp_path)).get("old") is None
+
+
+def test_concurrent_writers(tmp_path):
+    procs = [multiprocessing.Process(target=_register, args=(_config_dir(tmp_path), 20)) for _ in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+
+    assert len(StateStore(_config_dir(tmp_path)).all()) == 80
@@ -0,0 +1,92 @@
+import json
+
+import pytest
+from moto import mock_aws
+
+from eki_dev.storage import (
+    PER_BOOT_SCRIPT,
+    check_instance_store,
+    with_storage_profile,
+    efs_from_user_data,
+    mount_script,
+    container_volumes,
+    parse_fio,
+    check_storage
+)
+
+from fixtures import aws_credentials
+
+USER_DATA = ("#!/bin/sh\nsudo apt-get update -y\nsudo apt-get -y install nfs-common\n"
+             "sudo mkdir /home/ubuntu/efs\n"
+             "sudo mount -t nfs4 -o nfsvers=4.1 fs-123.efs.eu-west-1.amazonaws.com:/ /home/ubuntu/efs\n")
+
+FIO_REPORT = {"jobs": [{"jobname": "edamame-read", "read": {"bw_bytes": 524288000, "iops": 500.2}}]}
+
+
+def test_efs_from_user_data():
+    assert efs_from_user_data(USER_DATA) == "fs-123.efs.eu-west-1.amazonaws.com"
+    assert efs_from_user_data("#!/bin/sh\n") is None
+
+
+def test_with_storage_profile():
+    params = {"InstanceType": "t2.micro", "UserData": USER_DATA}
+    assert with_storage_profile(None, **params) == params
+
+    user_data = with_storage_profile("efs-cached", **params)["UserData"]
+    assert "sudo apt-get update -y" in user_data
+    assert "sudo mkdir /home/ubuntu/efs" not in user_data
+    assert "cachefilesd" in user_data
+    assert f"sudo {PER_BOOT_SCRIPT}" in user_data
+    assert "nconnect=8,fsc fs-123.efs.eu-west-1.amazonaws.com:/ /home/ubuntu/efs" in user_data
+
+    with pytest.raises(ValueError):
+        with_storage_profile("tmpfs", **params)
+    with pytest.raises(ValueError):
+        with_storage_profile("efs", UserData="#!/bin/sh\n")
+
+
+@mock_aws
+def test_nvme_scratch_needs_instance_store(aws_credentials):
+    assert check_instance_store("efs-cached", ["t2.micro"]) == ["t2.micro"]
+    assert check_instance_store("nvme-scratch", ["t2.micro", "m5d.large"]) == ["m5d.large"]
+
+    assert "mdadm" in with_storage_profile("nvme-scratch", InstanceType="m5d.large", UserData=USER_DATA)["UserData"]
+    with pytest.raises(ValueError):
+        with_storage_profile("nvme-scratch", InstanceType="t2.micro", UserData=USER_DATA)
+
+
+def test_mount_script():
+    efs = mount_script("efs", "fs")
+    assert "fsc" not in efs and "mdadm" not in efs
+    nvme = mount_script("nvme-scratch", "fs")
+    assert "mdadm --create /dev/md0" in nvme
+    # the array assembled again at reboot is stopped first, its file system kept
+    assert nvme.index("mdadm --stop") < nvme.index("mdadm --create")
+    assert "blkid $DEVICES > /dev/null || mkfs.ext4" in nvme
+    assert "dir /home/ubuntu/scratch/fscache" in nvme
+    assert nvme.index("/home/ubuntu/scratch/fscache") < nvme.index("mount -t nfs4")
+
+
+def test_container_volumes():
+    assert container_volumes() == ["/home/ubuntu/efs:/home/eki/efs"]
+    assert container_volumes("nvme-scratch") == ["/home/ubuntu/efs:/home/eki/efs",
+                                                 "/home/ubuntu/scratch:/home/eki/scratch"]
+
+
+def test_parse_fio():
+    assert parse_fio(json.dumps(FIO_REPORT)) == {"mb_per_s": 524.3, "iops": 500}
+
+
+def test_check_storage(mocker):
+    def run_command(user, host, command, timeout=None):
+        if "scratch" in command and "fio" in command:
+            return 1, b"", b"No such file or directory"
+        return 0, json.dumps(FIO_REPORT).encode(), b""
+
+    run = mocker.patch("eki_dev.storage.run_command", side_effect=run_command)
+    results = check_storage("ubuntu", "1.2.3.4", "nvme-scratch", size="10M", runtime=1)
+    assert results == {"/home/ubuntu/efs": {"mb_per_s": 524.3, "iops": 500},
+                       "/home/ubuntu/scratch": {"error": "No such file or directory"}}
+    # one fio run and one clean up per mount point
+    assert run.call_count == 4
+    assert "--size=10M" in run.call_args_list[0].args[2]
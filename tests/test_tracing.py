@@ -0,0 +1,131 @@
+import json
+
+import boto3
+import pytest
+from moto import mock_aws
+from botocore.exceptions import ClientError
+
+from eki_dev import tracing
+from eki_dev.aws_service import AwsService
+from eki_dev.pipeline import Pipeline
+from eki_dev.readiness import Probe, wait_until_ready
+
+from fixtures import aws_credentials
+
+
+class FlakyProbe(Probe):
+    def __init__(self, name, failures):
+        super().__init__(name)
+        self.failures = failures
+
+    def check(self):
+        self.failures -= 1
+        return self.failures < 0
+
+
+@pytest.fixture
+def trace_file(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    tracing.configure(path=str(path))
+    yield path
+    tracing.reset()
+
+
+def _spans(path) -> dict:
+    return {s["name"]: s for s in map(json.loads, path.read_text().splitlines())}
+
+
+def test_spans_are_nested_and_written_when_the_trace_ends(trace_file):
+    with tracing.span("edamame blank") as root:
+        with tracing.span("probe ssh-banner"):
+            pass
+        assert not trace_file.exists()
+        with pytest.raises(ValueError):
+            with tracing.span("docker login"):
+                raise ValueError("denied")
+
+    spans = _spans(trace_file)
+    assert len(spans) == 3
+    assert {s["trace_id"] for s in spans.values()} == {root.trace_id}
+    assert spans["edamame blank"]["parent_id"] is None
+    assert spans["probe ssh-banner"]["parent_id"] == root.span_id
+    assert spans["probe ssh-banner"]["outcome"] == "ok"
+    assert spans["docker login"]["outcome"] == "error"
+    assert spans["docker login"]["error"] == "ValueError: denied"
+    assert spans["edamame blank"]["duration_s"] >= spans["docker login"]["duration_s"]
+
+
+def test_tracing_disabled_by_default(tmp_path):
+    with tracing.span("edamame list"):
+        pass
+    assert not tracing.get_tracer().enabled
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_pipeline_phases_are_children_of_the_pipeline(trace_file):
+    pipeline = Pipeline("create_ec2_instance")
+    pipeline.add("iam_user", lambda: tracing.current_span().name)
+    pipeline.add("launch", lambda iam_user: iam_user, deps=("iam_user",))
+    with tracing.span("edamame blank"):
+        # phases run on the pipeline's threads
+        assert pipeline.run()["launch"] == "phase iam_user"
+
+    spans = _spans(trace_file)
+    assert spans["pipeline create_ec2_instance"]["parent_id"] == spans["edamame blank"]["span_id"]
+    for phase in ("phase iam_user", "phase launch"):
+        assert spans[phase]["parent_id"] == spans["pipeline create_ec2_instance"]["span_id"]
+    assert spans["phase launch"]["attributes"]["deps"] == ["iam_user"]
+
+
+def test_probe_spans_count_attempts(trace_file):
+    with tracing.span("readiness"):
+        wait_until_ready([FlakyProbe("tcp:22", 0), FlakyProbe("cloud-init", 2)], sleep=lambda _: None)
+
+    spans = _spans(trace_file)
+    assert spans["probe tcp:22"]["attempts"] == 1
+    assert spans["probe cloud-init"]["attempts"] == 3
+
+
+@mock_aws
+def test_aws_calls_are_traced(aws_credentials, trace_file):
+    boto3.client("s3").create_bucket(Bucket="eki-dev-machine-config")
+    with tracing.span("edamame list"):
+        s3 = AwsService.from_service("s3").client
+        s3.list_objects_v2(Bucket="eki-dev-machine-config")
+        with pytest.raises(ClientError):
+            s3.get_object(Bucket="eki-dev-machine-config", Key="missing")
+
+    spans = _spans(trace_file)
+    listing = spans["aws s3.ListObjectsV2"]
+    assert listing["parent_id"] == spans["edamame list"]["span_id"]
+    assert listing["outcome"] == "ok"
+    assert listing["attempts"] == 1
+    assert listing["attributes"]["http_status"] == 200
+    assert spans["aws s3.GetObject"]["outcome"] == "error"
+    assert spans["aws s3.GetObject"]["error"] == "NoSuchKey"
+
+
+def test_otlp_export(tmp_path):
+    path = tmp_path / "trace.json"
+    tracing.configure(path=str(path), format="otlp")
+    try:
+        with tracing.span("edamame explorer-machine", argv=["explorer-machine"]):
+            with tracing.span("docker pull") as pull:
+                pull.set(bytes=1024)
+    finally:
+        tracing.reset()
+
+    [export] = map(json.loads, path.read_text().splitlines())
+    [resource] = export["resourceSpans"]
+    assert resource["resource"]["attributes"] == [{"key": "service.name", "value": {"stringValue": "edamame"}}]
+    spans = {s["name"]: s for s in resource["scopeSpans"][0]["spans"]}
+    root, child = spans["edamame explorer-machine"], spans["docker pull"]
+    assert len(root["traceId"]) == 32 and len(root["spanId"]) == 16
+    assert "parentSpanId" not in root
+    assert child["parentSpanId"] == root["spanId"]
+    assert {"key": "bytes", "value": {"intValue": "1024"}} in child["attributes"]
+    assert child["status"] == {"code": 1}
+    assert int(child["endTimeUnixNano"]) >= int(child["startTimeUnixNano"])
+
+    with pytest.raises(ValueError):
+        tracing.configure(path=str(path), format="zipkin")
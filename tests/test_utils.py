@@ -1,10 +1,14 @@
 import copy
 import os.path
+import shutil
 import json
 from pathlib import Path
 import random
 import string
 
+import pytest
+import yaml
+
 from fixtures import (ec2_config,
                         aws_credentials,
                         aws_s3,
@@ -12,6 +16,7 @@ from fixtures import (ec2_config,
                       bucket_with_project_tags)
 from moto import mock_aws
 
+from eki_dev.state import StateStore
 from eki_dev.utils import (
     ssh_tunnel,
     ssh_splitter,
@@ -21,15 +26,16 @@ from eki_dev.utils import (
     get_project_tags,
     Config,
     generate_makefile,
-    update_dict
+    update_dict,
+    merge_config
 )
 
 
-def test_update_dict(mocker):
+def test_update_dict(mocker, tmp_path):
     user_conf = {}
     m = mocker.patch('importlib_resources.files')
     m.return_value = Path('.')
-    config = Config()
+    config = Config(path_config_dir=str(tmp_path))
 
     conf = copy.deepcopy(config.conf)
 
@@ -43,6 +49,19 @@ def test_update_dict(mocker):
     assert conf["Ec2Instance"]["Properties"]["KeyName"] == random_string
 
 
+def test_merge_config_shares_nothing():
+    conf = {"Ec2Instance": {"Properties": {"KeyName": "id_rsa", "InstanceType": "t2.micro"}},
+            "WarmPool": {"Size": 1}}
+    merged = merge_config(conf, {"Ec2Instance": {"Properties": {"KeyName": "mine"}}, "New": {"a": 1}})
+
+    assert merged["Ec2Instance"]["Properties"] == {"KeyName": "mine", "InstanceType": "t2.micro"}
+    assert merged["New"] == {"a": 1}
+    assert conf["Ec2Instance"]["Properties"]["KeyName"] == "id_rsa"
+    assert "New" not in conf
+    assert merged["WarmPool"] == conf["WarmPool"]
+    assert merged["WarmPool"] is not conf["WarmPool"]
+
+
 def test_generate_makefile():
     tmpl = generate_makefile("test_image", "test_repo", makefile_name='test_makefile')
     with open('test_makefile') as f:
@@ -56,7 +75,8 @@ class TestConfig:
     def setUp(self):
         pass
 
-    def test_constructor(self, mocker):
+    def test_constructor(self, mocker, monkeypatch, tmp_path):
+        monkeypatch.setenv("HOME", str(tmp_path))
         m = mocker.patch('importlib_resources.files')
         m.return_value = Path('.')
         config = Config()
@@ -64,10 +84,10 @@ class TestConfig:
         assert isinstance(config.conf, dict)
         assert isinstance(config.user_conf, dict)
 
-    def test_retrieve_config(self, mocker):
+    def test_retrieve_config(self, mocker, tmp_path):
         m = mocker.patch('importlib_resources.files')
         m.return_value = Path('.')
-        config = Config('.')
+        config = Config(str(tmp_path))
         dct_conf = config.retrieve_configuration()
 
         assert dct_conf is not config.conf
@@ -75,48 +95,75 @@ class TestConfig:
             "KeyName"]
         assert dct_conf["Ec2Instance"]["Properties"]["KeyName"] == config.user_conf["Ec2Instance"]["Properties"]["KeyName"]
 
-    def test_write_config(self, mocker):
+    def test_write_config(self, mocker, tmp_path):
         m = mocker.patch('importlib_resources.files')
         m.return_value = Path('.')
-        config = Config(path_config_dir='.')
+        config = Config(path_config_dir=str(tmp_path))
         random_string = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(10))
         config.conf["Ec2Instance"]["Properties"]["KeyName"] = random_string
         config.write_configuration()
 
-        config2 = Config(path_config_dir='.')
+        config2 = Config(path_config_dir=str(tmp_path))
         assert config2.conf["Ec2Instance"]["Properties"]['KeyName'] == random_string
-        try:
-            os.remove('config')
-        except FileNotFoundError:
-            pass
 
-    def test_write_user_config(self, mocker):
+    def test_write_user_config(self, mocker, tmp_path):
         m = mocker.patch('importlib_resources.files')
         m.return_value = Path('.')
-        config = Config(path_config_dir='.')
+        config = Config(path_config_dir=str(tmp_path))
         random_string = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(10))
         config.update_ssh_key_name(random_string)
         config.write_user_configuration()
 
-        config2 = Config(path_config_dir='.')
+        config2 = Config(path_config_dir=str(tmp_path))
         assert config2.user_conf["Ec2Instance"]["Properties"]['KeyName'] == random_string
-        try:
-            os.remove('config')
-        except FileNotFoundError:
-            pass
+
+    def test_config_cache(self, mocker, tmp_path):
+        mocker.patch('importlib_resources.files').return_value = Path('.')
+        user_conf = {"Ec2Instance": {"Properties": {"KeyName": "cached_key"}}}
+        (tmp_path / "config").write_text(yaml.dump(user_conf))
+        Config(path_config_dir=str(tmp_path))
+        cached = json.loads((tmp_path / "config.cache").read_text())
+        assert cached["user_conf"] == user_conf
+
+        load = mocker.spy(yaml, "load")
+        conf = Config(path_config_dir=str(tmp_path)).retrieve_configuration()
+        assert load.call_count == 0
+        assert conf["Ec2Instance"]["Properties"]["KeyName"] == "cached_key"
+
+        # any change of the user configuration invalidates the cache
+        user_conf["Ec2Instance"]["Properties"]["KeyName"] = "new_key_name"
+        (tmp_path / "config").write_text(yaml.dump(user_conf))
+        conf = Config(path_config_dir=str(tmp_path)).retrieve_configuration()
+        assert load.call_count == 2
+        assert conf["Ec2Instance"]["Properties"]["KeyName"] == "new_key_name"
+
+    def test_config_profile(self, mocker, tmp_path):
+        mocker.patch('importlib_resources.files').return_value = Path('.')
+        user_conf = {"Ec2Instance": {"Properties": {"KeyName": "key"}},
+                     "Profiles": {"gpu": {"Ec2Instance": {"Properties": {"InstanceType": "g4dn.xlarge"}}}}}
+        (tmp_path / "config").write_text(yaml.dump(user_conf))
+
+        for _ in range(2):
+            config = Config(path_config_dir=str(tmp_path))
+            conf = config.retrieve_configuration("gpu")
+            assert conf["Ec2Instance"]["Properties"]["InstanceType"] == "g4dn.xlarge"
+            assert conf["Ec2Instance"]["Properties"]["KeyName"] == "key"
+            assert config.retrieve_configuration()["Ec2Instance"]["Properties"]["InstanceType"] == "t2.micro"
+
+        with pytest.raises(ValueError):
+            config.retrieve_configuration("cpu")
 
     @mock_aws
-    def test_create_ssh_keys(self, mocker):
+    def test_create_ssh_keys(self, mocker, tmp_path):
         m = mocker.patch('importlib_resources.files')
         m.return_value = Path('.')
-        path_config_dir = '.'
+        path_config_dir = str(tmp_path)
         Config(path_config_dir=path_config_dir).create_ssh_keys("test_key")
 
         assert os.path.exists(os.path.expanduser('~/.ssh/test_key.pem'))
 
         assert Config(path_config_dir=path_config_dir).user_conf["Ec2Instance"]["Properties"]['KeyName'] == "test_key"
         os.remove(os.path.expanduser('~/.ssh/test_key.pem'))
-        os.remove('config')
 
 @mock_aws
 def test_get_project_tags(bucket_with_project_tags):
@@ -134,20 +181,37 @@ def test_add_instance_tags(ec2_config):
     assert instance_attrs['TagSpecifications'][0]['Tags'][2]['Key'] == 'project'
 
 
+def test_add_instance_tags_leaves_retrieved_configuration_alone(mocker, tmp_path):
+    mocker.patch('importlib_resources.files').return_value = Path('.')
+    config = Config(path_config_dir=str(tmp_path))
+    iam_user = {"UserName": "u", "UserId": "AID1"}
+    for project in ("p1", "p2"):
+        params = add_instance_tags(project, iam_user=iam_user, **config.retrieve_configuration()["Ec2Instance"]["Properties"])
+        keys = [t["Key"] for t in params["TagSpecifications"][0]["Tags"]]
+        assert sorted(keys) == ["project", "user", "user_id"]
+        assert params["TagSpecifications"][0]["Tags"][-1] == {"Key": "project", "Value": project}
+
+    conf = config.retrieve_configuration()
+    conf["Ec2Instance"]["Properties"]["InstanceType"] = "m5.large"
+    assert config.retrieve_configuration()["Ec2Instance"]["Properties"]["InstanceType"] == "t2.micro"
+    assert [t["Key"] for t in conf["Ec2Instance"]["Properties"]["TagSpecifications"][0]["Tags"]] == ["user"]
+
+
 def test_register_deregister_instance():
     user_folder = '.test_user'
     name = "test"
     host_ip = "10.01.01.01"
     home = os.path.expanduser("~")
 
-    register_instance(name, host_ip, CONFIG_DIR=user_folder)
+    register_instance(name, host_ip, CONFIG_DIR=user_folder, instance_id="i-123", project="dev")
 
-    assert os.path.exists(os.path.join(home, user_folder, name+"@"+host_ip))
+    entry = StateStore(user_folder).get(name)
+    assert (entry["ip"], entry["instance_id"], entry["project"], entry["context"]) == (host_ip, "i-123", "dev", name)
 
     deregister_instance(name, host_ip, CONFIG_DIR=user_folder)
-    assert not os.path.exists(os.path.join(home, user_folder, name + "@" + host_ip))
+    assert StateStore(user_folder).get(name) is None
 
-    os.rmdir(os.path.join(home, user_folder))
+    shutil.rmtree(os.path.join(home, user_folder))
 
 
 
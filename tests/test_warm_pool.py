@@ -0,0 +1,157 @@
+import json
+
+import boto3
+from moto import mock_aws
+
+from eki_dev.warm_pool import (
+    POOL_TAG,
+    STATE_TAG,
+    STORAGE_TAG,
+    claim_warm_instance,
+    list_warm_instances,
+    refill_pool,
+    sweep_abandoned_claims,
+    drain_pool,
+    refill_in_background,
+    _per_boot_mounts
+)
+
+from eki_dev.storage import with_storage_profile
+from eki_dev.dev_machine import terminate_instances
+from eki_dev.utils import get_iam_user
+
+from fixtures import aws_credentials, ec2_config
+
+
+def _tags(instance_id):
+    inst = boto3.client("ec2").describe_instances(InstanceIds=[instance_id])["Reservations"][0]["Instances"][0]
+    return {t["Key"]: t["Value"] for t in inst.get("Tags", [])}, inst["State"]["Name"]
+
+
+def _warm_instance(instance_type="t2.micro", storage="efs"):
+    ec2 = boto3.client("ec2")
+    instance_id = ec2.run_instances(ImageId="ami-12345678", MinCount=1, MaxCount=1, InstanceType=instance_type,
+                                    TagSpecifications=[{"ResourceType": "instance",
+                                                        "Tags": [{"Key": POOL_TAG, "Value": instance_type},
+                                                                 {"Key": STATE_TAG, "Value": "ready"},
+                                                                 {"Key": STORAGE_TAG, "Value": storage}]}]
+                                    )["Instances"][0]["InstanceId"]
+    ec2.stop_instances(InstanceIds=[instance_id])
+    return instance_id
+
+
+@mock_aws
+def test_claim_warm_instance(aws_credentials):
+    instance_id = _warm_instance()
+    iam_user = {"UserName": "test_user", "UserId": "AID123"}
+
+    assert claim_warm_instance("t3.large", "dev", iam_user=iam_user) is None
+    instance = claim_warm_instance("t2.micro", "dev", iam_user=iam_user)
+    assert instance.id == instance_id
+
+    tags, state = _tags(instance_id)
+    assert state in ("pending", "running")
+    assert tags == {"user": "test_user", "user_id": "AID123", "project": "dev"}
+    assert claim_warm_instance("t2.micro", "dev", iam_user=iam_user) is None
+
+
+@mock_aws
+def test_claim_matches_storage_profile(aws_credentials):
+    scratch = _warm_instance(storage="nvme-scratch")
+    iam_user = {"UserName": "test_user", "UserId": "AID123"}
+
+    # the efs volumes only would miss the scratch mount, and the other way around
+    assert claim_warm_instance("t2.micro", "dev", iam_user=iam_user) is None
+    assert claim_warm_instance("t2.micro", "dev", iam_user=iam_user, storage="efs-cached") is None
+    assert claim_warm_instance("t2.micro", "dev", iam_user=iam_user, storage="nvme-scratch").id == scratch
+    assert STORAGE_TAG not in _tags(scratch)[0]
+
+
+@mock_aws
+def test_claim_skips_instance_claimed_by_another_process(aws_credentials, mocker):
+    first, second = _warm_instance(), _warm_instance()
+    # another process starts the first instance between our listing and our claim
+    listed = list_warm_instances("t2.micro", pool_states=("ready",), instance_states=("stopped",))
+    boto3.client("ec2").start_instances(InstanceIds=[first])
+    mocker.patch("eki_dev.warm_pool.list_warm_instances", return_value=listed)
+
+    instance = claim_warm_instance("t2.micro", "dev", iam_user={"UserName": "u", "UserId": "i"})
+    assert instance.id == second
+
+
+@mock_aws
+def test_sweep_abandoned_claims(aws_credentials):
+    instance_id = _warm_instance()
+    # a claim that died right after starting the instance
+    boto3.client("ec2").start_instances(InstanceIds=[instance_id])
+
+    assert sweep_abandoned_claims("t2.micro") == []
+    assert sweep_abandoned_claims("t2.micro", grace=-1) == [instance_id]
+    tags, state = _tags(instance_id)
+    assert state in ("stopping", "stopped")
+    assert tags[STATE_TAG] == "ready"
+
+
+@mock_aws
+def test_refill_and_drain_pool(aws_credentials, ec2_config, mocker):
+    mprepare = mocker.patch("eki_dev.warm_pool._prepare_instance")
+    conf = json.loads(ec2_config)["Ec2Instance"]["Properties"]
+    boto3.client("iam").create_instance_profile(InstanceProfileName="AccessECR")
+
+    instance_ids = refill_pool("t2.micro", size=2, **conf)
+    assert len(instance_ids) == 2
+    assert mprepare.call_count == 2
+    for instance_id in instance_ids:
+        tags, state = _tags(instance_id)
+        assert state == "stopped"
+        assert tags[STATE_TAG] == "ready"
+        assert tags[STORAGE_TAG] == "efs"
+        assert "user" not in tags and "user_id" not in tags
+
+    assert refill_pool("t2.micro", size=2, **conf) == []
+    conf["UserData"] = "#!/bin/sh\nsudo mount -t nfs4 fs:/ /home/ubuntu/efs\n"
+    [cached] = refill_pool("t2.micro", size=1, storage="efs-cached", **conf)
+    assert _tags(cached)[0][STORAGE_TAG] == "efs-cached"
+    assert "cachefilesd" in mprepare.call_args[0][4]
+    instance_ids.append(cached)
+
+    assert sorted(drain_pool("t2.micro")) == sorted(instance_ids)
+    assert list_warm_instances("t2.micro") == []
+
+
+@mock_aws
+def test_remove_all_leaves_pool_alone(aws_credentials, ec2_config, mocker):
+    mocker.patch("eki_dev.warm_pool._prepare_instance")
+    conf = json.loads(ec2_config)["Ec2Instance"]["Properties"]
+    boto3.client("iam").create_instance_profile(InstanceProfileName="AccessECR")
+    [pooled] = refill_pool("t2.micro", size=1, **conf)
+    # `edamame remove --all` selects the instances of the caller
+    user = get_iam_user()["UserName"]
+    own = boto3.client("ec2").run_instances(ImageId="ami-12345678", MinCount=1, MaxCount=1,
+                                            TagSpecifications=[{"ResourceType": "instance",
+                                                                "Tags": [{"Key": "user", "Value": user}]}]
+                                            )["Instances"][0]["InstanceId"]
+
+    assert terminate_instances(user=user, fresh=True) == [own]
+    tags, state = _tags(pooled)
+    assert state == "stopped"
+    assert tags[STATE_TAG] == "ready"
+
+
+def test_refill_in_background_keeps_profile(mocker, monkeypatch, tmp_path):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    popen = mocker.patch("eki_dev.utils.subprocess.Popen")
+
+    refill_in_background("t2.micro", size=2, storage="efs", profile="gpu")
+    cmd = popen.call_args[0][0]
+    assert cmd[2:6] == ["--profile", "gpu", "warm-pool", "refill"]
+
+    refill_in_background("t2.micro", size=2, storage="efs")
+    assert "--profile" not in popen.call_args[0][0]
+
+
+def test_per_boot_mounts():
+    user_data = "#!/bin/sh\nsudo apt-get update -y\nsudo mkdir /home/ubuntu/efs\nsudo mount -t nfs4 fs:/ /home/ubuntu/efs"
+    assert _per_boot_mounts(user_data) == "#!/bin/sh\nsudo mount -t nfs4 fs:/ /home/ubuntu/efs\n"
+    # a storage profile installs its own per-boot script
+    assert _per_boot_mounts(with_storage_profile("efs-cached", UserData=user_data)["UserData"]) is None